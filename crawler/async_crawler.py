@@ -0,0 +1,196 @@
+import asyncio
+import concurrent.futures
+import datetime
+import logging
+import time
+import urllib.parse
+from typing import Callable, List, Optional, Set, Tuple, Union
+
+from .async_fetcher import AsyncFetcher
+from .canonicalizer import CanonicalizationReport, Canonicalizer, UrlCanonicalizer
+from .error_handler import ErrorHandler
+from .fetcher import RawContent
+from .handler import Handler, collect_links
+from .metrics import Metrics
+from .politeness import PolitenessScheduler, Rate
+from .state_manager import StateManager
+
+
+class AsyncCrawler:
+    """
+    Asynchronous counterpart to Crawler, which multiplexes many fetches on a single
+    event loop rather than dedicating a thread to each.
+
+    Fetches run on the event loop. Handlers run in an executor, so that parsing a
+    page does not hold up other fetches. The state manager and error handler are
+    only called from the event loop, so they need not be thread-safe.
+
+    A page's politeness slot is booked when it is popped, and its URL stays claimed
+    while it waits for the slot. So pages are only popped while the last one popped
+    can start within `max_wait`, rather than up to `max_in_flight` at once, which
+    with a long crawl delay could leave URLs waiting past their lease.
+    """
+
+    def __init__(self,
+                 fetcher: AsyncFetcher,
+                 handler: Handler,
+                 state_manager: StateManager,
+                 error_handler: ErrorHandler,
+                 crawl_delay: datetime.timedelta = datetime.timedelta(0),
+                 max_in_flight: int = 100,
+                 executor: Optional[concurrent.futures.Executor] = None,
+                 scheduler: Optional[PolitenessScheduler] = None,
+                 canonicalizer: Optional[Canonicalizer] = None,
+                 metrics: Optional[Metrics] = None,
+                 raw_content: bool = False,
+                 max_wait: datetime.timedelta = datetime.timedelta(minutes=1)):
+        """
+        :param fetcher: Fetcher to be used to fetch URLs.
+        :param handler: Handler to process fetched URLs.
+        :param state_manager: Manages the crawl queue.
+        :param error_handler: Determines how any errors raised during crawl are handled.
+        :param crawl_delay: Minimum time between requests to the same host.
+        :param max_in_flight: How many pages to crawl at once.
+        :param executor: Where to run the handler. Defaults to the event loop's default executor. Use a
+            ProcessPoolExecutor to parse several pages at once, in which case the handler must be picklable.
+        :param scheduler: Decides when each request may be made. Overrides `crawl_delay` if given.
+        :param canonicalizer: Rewrites URLs before they are enqueued. Defaults to rewrites that are safe for any site.
+        :param metrics: Records how long each stage of the crawl takes. Defaults to keeping metrics in memory.
+        :param raw_content: Whether to fetch pages as bytes and pass them to the handler's handle_raw(), rather than
+            decoding them first. Saves decoding each page twice, if the handler's parser decodes it anyway.
+        :param max_wait: How far ahead to book politeness slots. Together with the longest crawl delay, this is
+            how long a popped URL can wait before it is fetched, so it should be well within any lease the state
+            manager holds popped URLs for.
+        """
+        if max_in_flight < 1:
+            raise ValueError(f'Need at least one page in flight, got {max_in_flight}')
+        self.fetcher = fetcher
+        self.handler = handler
+        self.state_manager = state_manager
+        self.error_handler = error_handler
+        self.crawl_delay = crawl_delay
+        self.max_in_flight = max_in_flight
+        self.executor = executor
+        self.scheduler = scheduler or PolitenessScheduler(Rate(crawl_delay))
+        self.canonicalizer = canonicalizer or UrlCanonicalizer()
+        self.canonicalization_report = CanonicalizationReport()
+        self.metrics = metrics or Metrics()
+        self.raw_content = raw_content
+        self.max_wait = max_wait
+
+    def _enqueue_many(self, links: List[Tuple[str, str]]) -> None:
+        """
+        Enqueues newly discovered URLs, after canonicalizing them.
+        :param links: (current_url, new_url) pairs, as passed to the enqueue callback.
+        """
+        urls = []
+        for current_url, new_url in links:
+            # Resolves relative URLs relative to the current URL. If new_url is
+            # absolute, then current_url will be ignored.
+            url = urllib.parse.urljoin(current_url, new_url)
+            canonical_url = self.canonicalizer.canonicalize(url)
+            self.canonicalization_report.record(url, canonical_url)
+            urls.append(canonical_url)
+        self.metrics.set_gauge('canonicalization_fetches_saved', self.canonicalization_report.fetches_saved)
+        with self.metrics.time('state_enqueue'):
+            self.state_manager.enqueue_many(urls)
+
+    def _retry_fn(self, url: str) -> Callable[[], None]:
+        def retry_fn() -> None:
+            return self._enqueue_many([('', url)])
+
+        return retry_fn
+
+    def _collect_links(self, content: Union[str, RawContent], url: str, route: str) -> List[Tuple[str, str]]:
+        with self.metrics.handling(route):
+            return collect_links(self.handler, content, url)
+
+    async def _handle(self, content: Union[str, RawContent], url: str, route: str) -> List[Tuple[str, str]]:
+        loop = asyncio.get_running_loop()
+        with self.metrics.time('handle', route):
+            if self.executor is None:
+                return await loop.run_in_executor(None, self._collect_links, content, url, route)
+            # Stages the handler times itself are not recorded, as it may be running in another process.
+            return await loop.run_in_executor(self.executor, collect_links, self.handler, content, url)
+
+    async def _process(self, url: str, wait: float) -> None:
+        """
+        :param url: URL to crawl.
+        :param wait: How many seconds until its politeness slot.
+        """
+        route = self.metrics.route(url)
+        with self.metrics.time('wait', route):
+            await asyncio.sleep(wait)
+        print(f'Processing url: {url}')
+        try:
+            with self.metrics.time('fetch', route):
+                if self.raw_content:
+                    content = await self.fetcher.fetch_raw(url)
+                else:
+                    content = await self.fetcher.fetch(url)
+            # The handler runs on another thread, so collect its links and enqueue them here.
+            links = await self._handle(content, url, route)
+            self._enqueue_many(links)
+            with self.metrics.time('state_mark'):
+                self.state_manager.mark_completed(url)
+            self.metrics.increment('pages_completed', route)
+        except Exception as e:
+            with self.metrics.time('state_mark'):
+                self.state_manager.mark_failed(url, e)
+            self.metrics.increment('pages_failed', route)
+            self.error_handler.handle(e, self._retry_fn(url))
+        finally:
+            self.metrics.maybe_export()
+
+    def _try_pop(self) -> Optional[str]:
+        with self.metrics.time('state_pop'):
+            return self.state_manager.try_pop()
+
+    async def crawl(self, roots: List[str]) -> None:
+        """
+        Initiates a crawl beginning at a given URL and continuing until there are
+        no more pages to discover.
+        :param roots: URLs from which to begin crawling
+        """
+
+        # TODO: Check constraints from robot.txt before starting.
+        self._enqueue_many([('', root) for root in roots])
+
+        in_flight: Set[asyncio.Task] = set()
+        # When the last page popped will be within max_wait of its politeness slot.
+        pop_after = 0.0
+        try:
+            while True:
+                # How long until a failed page can be retried, if the queue runs out before then, or until
+                # another page can be popped.
+                timeout = None
+                while len(in_flight) < self.max_in_flight:
+                    pause = pop_after - time.monotonic()
+                    if pause > 0:
+                        timeout = pause
+                        break
+                    url = self._try_pop()
+                    if url is None:
+                        retry_delay = self.state_manager.retry_delay()
+                        if retry_delay is not None:
+                            timeout = retry_delay.total_seconds()
+                        break
+                    wait = self.scheduler.reserve(url)
+                    pop_after = time.monotonic() + wait - self.max_wait.total_seconds()
+                    in_flight.add(asyncio.create_task(self._process(url, wait)))
+                if not in_flight:
+                    if timeout is None:
+                        return
+                    await asyncio.sleep(timeout)
+                    continue
+                done, in_flight = await asyncio.wait(in_flight, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    task.result()  # Propagates anything the error handler raised.
+        finally:
+            for task in in_flight:
+                task.cancel()
+            self.state_manager.flush()
+            logging.getLogger(type(self).__name__).info(
+                'Canonicalization rewrote %d discovered URLs, saving up to %d fetches',
+                self.canonicalization_report.rewritten, self.canonicalization_report.fetches_saved)
+            self.metrics.export()
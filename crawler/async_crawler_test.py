@@ -0,0 +1,318 @@
+import asyncio
+import datetime
+import json
+import re
+import time
+from typing import Callable, Dict, Optional
+
+import pytest
+
+from .async_crawler import AsyncCrawler
+from .async_fetcher import AsyncFetcher
+from .async_http_fetcher import AsyncHttpFetcher
+from .backoff import Backoff
+from .canonicalizer import UrlCanonicalizer
+from .crawler_test import FakeHandler, FakeStateManager, FlushRecordingStateManager, RawHandler, TryPopOnlyStateManager
+from .error_handler import LoggingHandler, RetryingHandler, ThrowingHandler
+from .fetcher import RawContent
+from .metrics import Metrics, timed
+from .sqlite_state_manager import SqlStateManager
+
+
+class FakeAsyncFetcher(AsyncFetcher):
+    def __init__(self, return_values: Dict[str, str], error: Optional[Exception] = None, delay: float = 0):
+        self.return_values = return_values
+        self.error = error
+        self.delay = delay
+
+    async def fetch(self, url: str) -> str:
+        await asyncio.sleep(self.delay)
+        if self.error:
+            raise self.error
+        return self.return_values[url]
+
+
+def test_crawl_root():
+    f = FakeAsyncFetcher({'root': 'foo'})
+    processed = []
+    h = FakeHandler(lambda content, url, callback: processed.append(f'{url}: {content}'))
+
+    asyncio.run(AsyncCrawler(f, h, FakeStateManager(), ThrowingHandler()).crawl(['root']))
+
+    assert processed == ['root: foo']
+
+
+def test_crawl_discovered_pages():
+    f = FakeAsyncFetcher({'root': 'foo', 'a': 'bar', 'b': 'baz', 'c': 'qux', 'd': 'quux'})
+    processed = []
+
+    def handle(content: str, url: str, callback: Callable[[str, str], None]) -> None:
+        processed.append(f'{url}: {content}')
+        if content == 'foo':
+            callback('', 'a')
+            callback('', 'b')
+        elif content == 'bar':
+            callback('', 'c')
+        elif content == 'baz':
+            callback('', 'd')
+
+    asyncio.run(AsyncCrawler(f, FakeHandler(handle), FakeStateManager(), ThrowingHandler()).crawl(['root']))
+
+    assert sorted(processed) == ['a: bar', 'b: baz', 'c: qux', 'd: quux', 'root: foo']
+
+
+def test_resolve_relative_urls():
+    f = FakeAsyncFetcher({'http://root.com/': 'foo', 'http://root.com/a': 'bar', 'http://root.com/b/c': 'baz'})
+    processed = []
+
+    def handle(content: str, url: str, callback: Callable[[str, str], None]) -> None:
+        processed.append(url)
+        if content == 'foo':
+            callback('http://root.com/', 'a')
+            callback('http://root.com/', 'b/c')
+
+    asyncio.run(
+        AsyncCrawler(f, FakeHandler(handle), FakeStateManager(), ThrowingHandler()).crawl(['http://root.com/']))
+
+    assert sorted(processed) == ['http://root.com/', 'http://root.com/a', 'http://root.com/b/c']
+
+
+def test_fetches_concurrently():
+    urls = [f'http://root.com/{i}' for i in range(50)]
+    f = FakeAsyncFetcher({url: 'foo' for url in urls}, delay=0.2)
+    processed = []
+    h = FakeHandler(lambda content, url, callback: processed.append(url))
+
+    start = time.time()
+    asyncio.run(AsyncCrawler(f, h, FakeStateManager(), ThrowingHandler()).crawl(urls))
+    end = time.time()
+
+    assert sorted(processed) == sorted(urls)
+    assert end - start < 1
+
+
+def test_limits_pages_in_flight():
+    urls = [f'http://root.com/{i}' for i in range(4)]
+    f = FakeAsyncFetcher({url: 'foo' for url in urls}, delay=0.2)
+    h = FakeHandler(lambda content, url, callback: None)
+
+    start = time.time()
+    asyncio.run(AsyncCrawler(f, h, FakeStateManager(), ThrowingHandler(), max_in_flight=2).crawl(urls))
+    end = time.time()
+
+    assert end - start >= 0.4
+
+
+def test_invalid_max_in_flight():
+    with pytest.raises(ValueError, match='at least one page'):
+        AsyncCrawler(FakeAsyncFetcher({}), FakeHandler(lambda content, url, callback: None), FakeStateManager(),
+                     ThrowingHandler(), max_in_flight=0)
+
+
+def test_crawl_delay_per_host():
+    urls = ['http://a.com/1', 'http://a.com/2', 'http://b.com/1', 'http://b.com/2']
+    f = FakeAsyncFetcher({url: 'foo' for url in urls})
+    h = FakeHandler(lambda content, url, callback: None)
+    crawl_delay = datetime.timedelta(seconds=0.25)
+
+    start = time.time()
+    asyncio.run(AsyncCrawler(f, h, FakeStateManager(), ThrowingHandler(), crawl_delay=crawl_delay).crawl(urls))
+    end = time.time()
+
+    assert crawl_delay.total_seconds() <= end - start < 2 * crawl_delay.total_seconds()
+
+
+def test_pops_only_pages_that_can_start_soon():
+    urls = [f'http://root.com/{i}' for i in range(8)]
+    m = FakeStateManager()
+    popped = {}
+    pop_next = m.pop_next
+
+    def record_pop() -> str:
+        url = pop_next()
+        popped[url] = time.monotonic()
+        return url
+
+    m.pop_next = record_pop
+    f = FakeAsyncFetcher({url: 'foo' for url in urls})
+    waits = []
+
+    async def fetch(url: str) -> str:
+        waits.append(time.monotonic() - popped[url])
+        return 'foo'
+
+    f.fetch = fetch
+    h = FakeHandler(lambda content, url, callback: None)
+
+    asyncio.run(AsyncCrawler(f, h, m, ThrowingHandler(), crawl_delay=datetime.timedelta(seconds=0.05),
+                             max_wait=datetime.timedelta(seconds=0.1)).crawl(urls))
+
+    assert len(waits) == len(urls)
+    assert max(waits) < 0.2
+
+def test_error_fetching():
+    f = FakeAsyncFetcher({}, ValueError('foo'))
+    h = FakeHandler(lambda page, url, callback: None)
+
+    with pytest.raises(ValueError, match='foo'):
+        asyncio.run(AsyncCrawler(f, h, FakeStateManager(), ThrowingHandler()).crawl(['root']))
+
+
+def test_error_handling():
+    f = FakeAsyncFetcher({'root': 'foo'})
+
+    def handle(page: str, url: str, callback: Callable[[str, str], None]) -> None:
+        raise ValueError('bar')
+
+    with pytest.raises(ValueError, match='bar'):
+        asyncio.run(AsyncCrawler(f, FakeHandler(handle), FakeStateManager(), ThrowingHandler()).crawl(['root']))
+
+
+class EventualAsyncFetcher(AsyncFetcher):
+    def __init__(self, failures: int):
+        self.counter = 0
+        self.failures = failures
+
+    async def fetch(self, url: str) -> str:
+        self.counter += 1
+        if self.counter == self.failures:
+            return 'foo'
+        raise ValueError('oh no')
+
+
+def test_retry_failures():
+    processed = []
+    h = FakeHandler(lambda content, url, callback: processed.append(f'{url}: {content}'))
+    f = EventualAsyncFetcher(failures=3)
+    m = FakeStateManager(max_failures=3)
+
+    asyncio.run(AsyncCrawler(f, h, m, RetryingHandler(LoggingHandler())).crawl(['root']))
+
+    assert processed == ['root: foo']
+
+
+def test_retry_waits_for_backoff(tmp_path):
+    processed = []
+    h = FakeHandler(lambda content, url, callback: processed.append(f'{url}: {content}'))
+    m = SqlStateManager(tmp_path / 'queue.db', backoff=Backoff(datetime.timedelta(milliseconds=200), jitter=0))
+    start = time.monotonic()
+
+    asyncio.run(AsyncCrawler(EventualAsyncFetcher(failures=2), h, m, RetryingHandler(LoggingHandler())).crawl(['root']))
+
+    assert processed == ['root: foo']
+    assert time.monotonic() - start >= 0.2
+
+
+def test_crawl_httpbin(httpbin, tmp_path):
+    processed = []
+
+    def handle(content: str, url: str, callback: Callable[[str, str], None]) -> None:
+        processed.append(url)
+        for link in re.findall(r"href='([^']+)'", content):
+            callback(url, link)
+
+    state_manager = SqlStateManager(tmp_path / 'queue.db')
+
+    async def crawl():
+        fetcher = AsyncHttpFetcher()
+        try:
+            await AsyncCrawler(fetcher, FakeHandler(handle), state_manager, ThrowingHandler()).crawl(
+                [httpbin.url + '/links/3/0'])
+        finally:
+            await fetcher.close()
+
+    asyncio.run(crawl())
+
+    assert sorted(processed) == [httpbin.url + f'/links/3/{i}' for i in range(3)]
+
+
+def test_canonicalize_discovered_urls(tmp_path):
+    f = FakeAsyncFetcher({'http://root.com/': 'foo',
+                          'http://root.com/a': 'bar',
+                          'http://root.com/b?id=1&depth=8': 'baz'})
+    processed = []
+
+    def handle(content: str, url: str, callback: Callable[[str, str], None]) -> None:
+        processed.append(url)
+        if content == 'foo':
+            callback(url, 'a#top')
+            callback(url, 'HTTP://ROOT.COM:80/a')
+            callback(url, '/b?id=1&depth=8&depth=8')
+
+    c = AsyncCrawler(f, FakeHandler(handle), SqlStateManager(tmp_path / 'queue.db'), ThrowingHandler(),
+                     canonicalizer=UrlCanonicalizer(dedupe_query=True))
+    asyncio.run(c.crawl(['http://root.com']))
+
+    assert sorted(processed) == ['http://root.com/', 'http://root.com/a', 'http://root.com/b?id=1&depth=8']
+    assert c.canonicalization_report.fetches_saved == 1
+
+
+def test_metrics():
+    f = FakeAsyncFetcher({'http://root.com/index': 'foo', 'http://root.com/view/a': 'bar'})
+
+    def handle(content: str, url: str, callback: Callable[[str, str], None]) -> None:
+        if content == 'foo':
+            callback(url, 'view/a')
+            callback(url, 'view/b')
+        else:
+            with timed('write'):
+                pass
+
+    m = Metrics(lambda url: url.split('/')[3])
+    asyncio.run(AsyncCrawler(f, FakeHandler(handle), FakeStateManager(), LoggingHandler(),
+                             metrics=m).crawl(['http://root.com/index']))
+
+    got = json.loads(m.to_json())
+    assert got['counters'] == {'pages_completed': {'index': 1, 'view': 1}, 'pages_failed': {'view': 1}}
+    assert got['stages']['wait']['view']['count'] == 2
+    assert got['stages']['fetch']['view']['count'] == 2
+    assert got['stages']['handle']['view']['count'] == 1
+    assert got['stages']['write']['view']['count'] == 1
+    assert got['stages']['state_pop']['']['count'] >= 3  # Some find the queue empty.
+    assert got['stages']['state_mark']['']['count'] == 3
+
+
+def test_metrics_exported_at_end_of_crawl(tmp_path):
+    path = tmp_path / 'metrics.prom'
+    f = FakeAsyncFetcher({'root': 'foo'})
+    m = Metrics(export_path=path, export_format=Metrics.Format.PROMETHEUS, export_interval=datetime.timedelta(hours=1))
+
+    asyncio.run(AsyncCrawler(f, FakeHandler(lambda content, url, callback: None), FakeStateManager(),
+                             ThrowingHandler(), metrics=m).crawl(['root']))
+
+    assert 'crawler_pages_completed_total{route=""} 1\n' in path.read_text()
+
+
+def test_pops_with_try_pop():
+    f = FakeAsyncFetcher({'root': 'foo', 'a': 'bar', 'b': 'baz'})
+    processed = []
+
+    def handle(content: str, url: str, callback: Callable[[str, str], None]) -> None:
+        processed.append(url)
+        if url == 'root':
+            callback(url, 'a')
+            callback(url, 'b')
+
+    asyncio.run(AsyncCrawler(f, FakeHandler(handle), TryPopOnlyStateManager(), ThrowingHandler()).crawl(['root']))
+
+    assert sorted(processed) == ['a', 'b', 'root']
+
+
+def test_flush_state_at_end_of_crawl():
+    f = FakeAsyncFetcher({}, error=ConnectionError('oops'))
+    m = FlushRecordingStateManager()
+
+    with pytest.raises(ConnectionError):
+        asyncio.run(AsyncCrawler(f, FakeHandler(lambda content, url, callback: None), m,
+                                 ThrowingHandler()).crawl(['root']))
+
+    assert m.flushes == 1
+
+
+def test_raw_content():
+    f = FakeAsyncFetcher({'root': 'caf\u00e9'})
+    h = RawHandler()
+
+    asyncio.run(AsyncCrawler(f, h, FakeStateManager(), ThrowingHandler(), raw_content=True).crawl(['root']))
+
+    assert h.handled == [('root', RawContent(b'caf\xc3\xa9', 'utf-8'))]
@@ -0,0 +1,27 @@
+import abc
+
+from .fetcher import RawContent
+
+
+class AsyncFetcher(abc.ABC):
+    """
+    Interface for fetching content from some source URL without blocking the event loop,
+    so that many fetches can be in flight at once.
+    """
+
+    @abc.abstractmethod
+    async def fetch(self, url: str) -> str:
+        """
+        :param url: The URL to be fetched.
+        :return: The raw content of the fetched URL, as a string.
+        """
+        raise NotImplementedError('Cannot fetch from abstract base class AsyncFetcher')
+
+    async def fetch_raw(self, url: str) -> RawContent:
+        """
+        Fetches content without decoding it, like Fetcher.fetch_raw(). Defaults to encoding what fetch() returns as
+        UTF-8.
+        :param url: The URL to be fetched.
+        :return: The content of the fetched URL, as bytes, with its declared encoding.
+        """
+        return RawContent((await self.fetch(url)).encode('utf-8'), 'utf-8')
@@ -0,0 +1,108 @@
+import asyncio
+import ssl
+import urllib.parse
+from typing import Awaitable, Callable, Optional, TypeVar
+
+import aiohttp
+
+from .async_fetcher import AsyncFetcher
+from .fetch_error import FetchError, HttpStatusError, parse_retry_after
+from .fetcher import RawContent
+
+_T = TypeVar('_T')
+
+
+class AsyncHttpFetcher(AsyncFetcher):
+    """
+    Fetches pages from URLs over HTTP or HTTPs, sharing one connection pool between
+    all fetches on the event loop. Raises the same exceptions as HttpFetcher.
+    """
+
+    def __init__(self,
+                 user_agent: str = '',
+                 timeout_seconds: float = 1.0,
+                 max_connections_per_host: int = 0,
+                 ssl_context: Optional[ssl.SSLContext] = None):
+        """
+        :param user_agent: User agent to report when fetching pages.
+        :param timeout_seconds: How long to wait to connect, and between bytes of the response.
+        :param max_connections_per_host: Limit on simultaneous connections to one host. 0 means no limit.
+        :param ssl_context: Used to verify HTTPs connections. Defaults to the system certificates.
+        """
+        self.user_agent = user_agent
+        self.timeout_seconds = timeout_seconds
+        self.max_connections_per_host = max_connections_per_host
+        self.ssl_context = ssl_context
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        # Sessions belong to the event loop they were created on, so wait until we have one.
+        if self._session is None:
+            headers = {}
+            if self.user_agent:
+                headers['User-Agent'] = self.user_agent
+            self._session = aiohttp.ClientSession(
+                headers=headers,
+                timeout=aiohttp.ClientTimeout(
+                    total=None,
+                    sock_connect=self.timeout_seconds,
+                    sock_read=self.timeout_seconds),
+                connector=aiohttp.TCPConnector(
+                    limit=0,
+                    limit_per_host=self.max_connections_per_host,
+                    ssl=self.ssl_context))
+        return self._session
+
+    async def close(self) -> None:
+        """
+        Closes any open connections. The fetcher can still be used afterwards.
+        """
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def fetch(self, url) -> str:
+        """
+        :param url: An HTTP or HTTPs URL to be fetched. Redirects will be followed.
+        :return: The raw content of the fetched URL, as a string. If the response does not say how it is encoded,
+            the encoding is guessed from the whole body.
+        :raises FetchError: If the page could not be fetched, saying whether it is worth trying again.
+        """
+        return await self._get(url, aiohttp.ClientResponse.text)
+
+    async def fetch_raw(self, url) -> RawContent:
+        """
+        :param url: An HTTP or HTTPs URL to be fetched. Redirects will be followed.
+        :return: The body of the response, as bytes, with the charset from its Content-Type, if it gave one.
+        :raises FetchError: If the page could not be fetched, saying whether it is worth trying again.
+        """
+        return await self._get(url, _read_raw)
+
+    async def _get(self, url, read: Callable[[aiohttp.ClientResponse], Awaitable[_T]]) -> _T:
+        """
+        :param read: Reads the body of the response, while the connection is still open.
+        """
+        if not url:
+            raise ValueError('Cannot fetch empty URL')
+        if urllib.parse.urlsplit(url).scheme not in ('http', 'https'):
+            raise NotImplementedError('Cannot fetch non-HTTP url: ' + url)
+        try:
+            async with self._get_session().get(url, raise_for_status=True) as response:
+                return await read(response)
+        except aiohttp.TooManyRedirects as e:
+            # Redirect loops don't fix themselves.
+            raise FetchError(str(e), transient=False) from e
+        except aiohttp.ClientResponseError as e:
+            retry_after = parse_retry_after(e.headers.get('Retry-After')) if e.headers else None
+            raise HttpStatusError(str(e), e.status, retry_after) from e
+        except asyncio.TimeoutError as e:
+            # Checked before connection errors, since aiohttp's timeouts are both.
+            raise TimeoutError(e)
+        except aiohttp.ClientConnectionError as e:
+            raise FetchError(str(e)) from e
+        except aiohttp.ClientError as e:
+            raise RuntimeError(e)
+
+
+async def _read_raw(response: aiohttp.ClientResponse) -> RawContent:
+    return RawContent(await response.read(), response.charset)
@@ -0,0 +1,122 @@
+import asyncio
+import ssl
+
+import pytest
+import pytest_httpbin.certs
+
+from .async_http_fetcher import AsyncHttpFetcher
+from .fetch_error import HttpStatusError
+from .fetcher import RawContent
+
+
+def fetch(fetcher: AsyncHttpFetcher, url: str) -> str:
+    async def run():
+        try:
+            return await fetcher.fetch(url)
+        finally:
+            await fetcher.close()
+
+    return asyncio.run(run())
+
+
+def test_fetch_http(httpbin):
+    response = fetch(AsyncHttpFetcher(), httpbin.url + '/get')
+    assert isinstance(response, str)
+    assert len(response) > 0
+
+
+def test_send_user_agent(httpbin):
+    response = fetch(AsyncHttpFetcher(user_agent='foo'), httpbin.url + '/headers')
+    assert '"User-Agent":"foo"' in response
+
+
+def test_fetch_many_at_once(httpbin):
+    fetcher = AsyncHttpFetcher(max_connections_per_host=2)
+
+    async def run():
+        try:
+            return await asyncio.gather(*[fetcher.fetch(httpbin.url + f'/anything/{i}') for i in range(10)])
+        finally:
+            await fetcher.close()
+
+    responses = asyncio.run(run())
+    assert len(responses) == 10
+    assert all(f'/anything/{i}' in response for i, response in enumerate(responses))
+
+
+def test_raise_on_empty_url():
+    with pytest.raises(ValueError, match='empty'):
+        fetch(AsyncHttpFetcher(), '')
+
+
+def test_raise_on_no_url():
+    with pytest.raises(ValueError, match='empty'):
+        fetch(AsyncHttpFetcher(), None)
+
+
+def test_raise_on_bad_protocol():
+    with pytest.raises(NotImplementedError, match='Cannot fetch'):
+        fetch(AsyncHttpFetcher(), 'ftp://example.com')
+
+
+def test_raise_on_connection_error(httpbin):
+    with pytest.raises(ConnectionError, match='Cannot connect'):
+        fetch(AsyncHttpFetcher(timeout_seconds=0.001), 'http://127.0.0.1')
+
+
+def test_raise_on_too_many_redirects(httpbin):
+    with pytest.raises(ConnectionError):
+        fetch(AsyncHttpFetcher(), httpbin.url + '/redirect/11')
+
+
+def test_raise_on_http_error(httpbin):
+    with pytest.raises(ConnectionError, match='404'):
+        fetch(AsyncHttpFetcher(), httpbin.url + '/status/404')
+
+
+@pytest.mark.parametrize('status_code, transient', [(404, False), (503, True)])
+def test_http_error_status(httpbin, status_code, transient):
+    with pytest.raises(HttpStatusError) as e:
+        fetch(AsyncHttpFetcher(), httpbin.url + f'/status/{status_code}')
+    assert e.value.status_code == status_code
+    assert e.value.transient == transient
+
+
+def test_raise_on_timeout(httpbin):
+    with pytest.raises(TimeoutError):
+        fetch(AsyncHttpFetcher(timeout_seconds=0.001), httpbin.url + '/delay/0.002')
+
+
+def test_fetch_https(httpbin_secure):
+    fetcher = AsyncHttpFetcher(ssl_context=ssl.create_default_context(cafile=pytest_httpbin.certs.where()))
+    response = fetch(fetcher, httpbin_secure.url + '/get')
+    assert isinstance(response, str)
+    assert len(response) > 0
+
+
+def test_raise_on_https_error(httpbin_secure):
+    fetcher = AsyncHttpFetcher(ssl_context=ssl.create_default_context(cafile=pytest_httpbin.certs.where()))
+    with pytest.raises(ConnectionError, match='404'):
+        fetch(fetcher, httpbin_secure.url + '/status/404')
+
+
+def fetch_raw(fetcher: AsyncHttpFetcher, url: str) -> RawContent:
+    async def run():
+        try:
+            return await fetcher.fetch_raw(url)
+        finally:
+            await fetcher.close()
+
+    return asyncio.run(run())
+
+
+def test_fetch_raw(httpbin):
+    response = fetch_raw(AsyncHttpFetcher(), httpbin.url + '/encoding/utf8')
+    assert '\u2200'.encode('utf-8') in response.content
+    assert response.encoding == 'utf-8'
+
+
+def test_fetch_raw_without_charset(httpbin):
+    response = fetch_raw(AsyncHttpFetcher(), httpbin.url + '/bytes/16')
+    assert len(response.content) == 16
+    assert response.encoding is None
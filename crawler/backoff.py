@@ -0,0 +1,67 @@
+import datetime
+import random
+from typing import Optional
+
+from .fetch_error import FetchError
+
+
+class Backoff:
+    """
+    Decides how long to wait before retrying a URL that failed, doubling the wait
+    after each failure up to a limit. Part of each wait is random, so that URLs
+    which failed together, such as during an outage, are not all retried together.
+    """
+
+    def __init__(self,
+                 initial: datetime.timedelta = datetime.timedelta(seconds=30),
+                 maximum: datetime.timedelta = datetime.timedelta(hours=1),
+                 multiplier: float = 2,
+                 jitter: float = 0.5,
+                 rng: Optional[random.Random] = None):
+        """
+        :param initial: Wait after the first failure.
+        :param maximum: Longest wait, however many times a URL has failed.
+        :param multiplier: How much longer each wait is than the one before.
+        :param jitter: Fraction of each wait that is random. 0 waits exactly, and 1 waits anywhere up to the full
+            time.
+        :param rng: Source of randomness, for tests.
+        """
+        if multiplier < 1:
+            raise ValueError(f'Multiplier must be at least 1, got {multiplier}')
+        if not 0 <= jitter <= 1:
+            raise ValueError(f'Jitter must be between 0 and 1, got {jitter}')
+        self.initial = initial
+        self.maximum = maximum
+        self.multiplier = multiplier
+        self.jitter = jitter
+        self._rng = rng or random.Random()
+
+    def delay(self, failures: int) -> datetime.timedelta:
+        """
+        :param failures: How many times the URL has failed, including this time.
+        :return: How long to wait before trying it again.
+        """
+        seconds = self.initial.total_seconds()
+        for _ in range(1, failures):
+            seconds *= self.multiplier
+            # Stop early, or enough failures would overflow.
+            if seconds >= self.maximum.total_seconds():
+                break
+        seconds = min(seconds, self.maximum.total_seconds())
+        return datetime.timedelta(seconds=seconds * (1 - self.jitter * self._rng.random()))
+
+
+def wait_before_retry(backoff: Optional[Backoff],
+                      failures: int,
+                      error: Optional[Exception] = None) -> Optional[datetime.timedelta]:
+    """
+    :param backoff: How to space out retries, if at all.
+    :param failures: How many times the URL has failed, including this time.
+    :param error: Why it failed this time, if known.
+    :return: How long to wait before trying the URL again, which is at least as long as the server asked for. None
+        if there is no need to wait.
+    """
+    wait = backoff.delay(failures) if backoff is not None else None
+    if isinstance(error, FetchError) and error.retry_after is not None:
+        wait = max(wait or datetime.timedelta(0), error.retry_after)
+    return wait
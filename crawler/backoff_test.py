@@ -0,0 +1,51 @@
+import datetime
+import random
+
+import pytest
+
+from .backoff import Backoff
+
+
+def test_doubles_after_each_failure():
+    b = Backoff(datetime.timedelta(seconds=1), jitter=0)
+
+    assert [b.delay(failures).total_seconds() for failures in range(1, 5)] == [1, 2, 4, 8]
+
+
+def test_custom_multiplier():
+    b = Backoff(datetime.timedelta(seconds=1), multiplier=3, jitter=0)
+
+    assert b.delay(3) == datetime.timedelta(seconds=9)
+
+
+def test_limited_to_maximum():
+    b = Backoff(datetime.timedelta(seconds=1), maximum=datetime.timedelta(seconds=5), jitter=0)
+
+    assert b.delay(4) == datetime.timedelta(seconds=5)
+    assert b.delay(10000) == datetime.timedelta(seconds=5)
+
+
+def test_jitter():
+    b = Backoff(datetime.timedelta(seconds=10), jitter=0.5, rng=random.Random(1))
+
+    delays = [b.delay(1).total_seconds() for _ in range(100)]
+
+    assert all(5 <= delay <= 10 for delay in delays)
+    assert len(set(delays)) == 100
+
+
+def test_full_jitter():
+    b = Backoff(datetime.timedelta(seconds=10), jitter=1, rng=random.Random(1))
+
+    assert min(b.delay(1).total_seconds() for _ in range(100)) < 1
+
+
+@pytest.mark.parametrize("jitter", [-0.1, 1.1])
+def test_invalid_jitter(jitter):
+    with pytest.raises(ValueError, match='Jitter'):
+        Backoff(jitter=jitter)
+
+
+def test_invalid_multiplier():
+    with pytest.raises(ValueError, match='Multiplier'):
+        Backoff(multiplier=0.5)
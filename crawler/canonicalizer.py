@@ -0,0 +1,136 @@
+import abc
+import re
+import string
+import urllib.parse
+from typing import Set
+
+_PERCENT_ESCAPE = re.compile(r'%([0-9a-fA-F]{2})')
+_UNRESERVED = frozenset(string.ascii_letters + string.digits + '-._~')
+_DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+class Canonicalizer(abc.ABC):
+    """
+    Interface for rewriting URLs into a canonical form before they are enqueued, so
+    that different spellings of the same page are only crawled once.
+    """
+
+    @abc.abstractmethod
+    def canonicalize(self, url: str) -> str:
+        """
+        :param url: An absolute URL.
+        :return: The canonical form of the URL.
+        """
+        raise NotImplementedError('Cannot canonicalize from abstract base class Canonicalizer')
+
+
+class IdentityCanonicalizer(Canonicalizer):
+    """
+    Leaves URLs exactly as they were found.
+    """
+
+    def canonicalize(self, url: str) -> str:
+        return url
+
+
+def _normalize_escape(match: re.Match) -> str:
+    char = chr(int(match.group(1), 16))
+    if char in _UNRESERVED:
+        return char
+    return f'%{match.group(1).upper()}'
+
+
+class UrlCanonicalizer(Canonicalizer):
+    """
+    Applies rewrites that are safe for any site: lower-cases the scheme and host,
+    drops default ports and fragments, gives empty HTTP paths a slash, and writes
+    percent-escapes in upper case, decoding those that did not need escaping.
+
+    Rewrites that only hold for some sites can be switched on.
+    """
+
+    def __init__(self,
+                 dedupe_query: bool = False,
+                 sort_query: bool = False,
+                 strip_trailing_slash: bool = False):
+        """
+        :param dedupe_query: Drop repeated parameters that have the same name and value as an earlier one.
+        :param sort_query: Sort parameters by name. Parameters with the same name keep their order.
+        :param strip_trailing_slash: Drop slashes from the end of the path, unless that would leave it empty.
+        """
+        self.dedupe_query = dedupe_query
+        self.sort_query = sort_query
+        self.strip_trailing_slash = strip_trailing_slash
+
+    @staticmethod
+    def _netloc(parts: urllib.parse.SplitResult) -> str:
+        if not parts.hostname:
+            return parts.netloc
+        try:
+            port = parts.port
+        except ValueError:
+            return parts.netloc  # Not a valid port, so leave it for the fetcher to complain about.
+        netloc = parts.hostname
+        if ':' in netloc:
+            netloc = f'[{netloc}]'  # IPv6
+        if port is not None and port != _DEFAULT_PORTS.get(parts.scheme):
+            netloc = f'{netloc}:{port}'
+        userinfo, at, _ = parts.netloc.rpartition('@')
+        return userinfo + at + netloc
+
+    def _path(self, parts: urllib.parse.SplitResult) -> str:
+        path = _PERCENT_ESCAPE.sub(_normalize_escape, parts.path)
+        if not path and parts.netloc and parts.scheme in _DEFAULT_PORTS:
+            return '/'
+        if self.strip_trailing_slash:
+            path = path.rstrip('/') or path[:1]
+        return path
+
+    def _query(self, parts: urllib.parse.SplitResult) -> str:
+        query = _PERCENT_ESCAPE.sub(_normalize_escape, parts.query)
+        if not (self.dedupe_query or self.sort_query):
+            return query
+        # Work on the raw parameters, so that we don't change how they are encoded.
+        params = [param for param in query.split('&') if param]
+        if self.dedupe_query:
+            params = list(dict.fromkeys(params))
+        if self.sort_query:
+            params.sort(key=lambda param: param.partition('=')[0])
+        return '&'.join(params)
+
+    def canonicalize(self, url: str) -> str:
+        parts = urllib.parse.urlsplit(url)
+        return urllib.parse.urlunsplit((parts.scheme, self._netloc(parts), self._path(parts), self._query(parts), ''))
+
+
+class CanonicalizationReport:
+    """
+    Keeps track of the URLs a canonicalizer rewrote, to show how much crawling it saved.
+    """
+
+    def __init__(self):
+        # How many discovered URLs were rewritten.
+        self.rewritten = 0
+        # Distinct URLs as they were discovered, and distinct URLs they were rewritten to. Hashes take less memory
+        # than the URLs themselves, and a collision only miscounts by one.
+        self._spellings: Set[int] = set()
+        self._pages: Set[int] = set()
+
+    def record(self, url: str, canonical_url: str) -> None:
+        """
+        :param url: A discovered URL.
+        :param canonical_url: What the canonicalizer rewrote it to.
+        """
+        if url != canonical_url:
+            self.rewritten += 1
+        self._spellings.add(hash(url))
+        self._pages.add(hash(canonical_url))
+
+    @property
+    def fetches_saved(self) -> int:
+        """
+        Every distinct spelling of a page but one would otherwise have been a separate
+        entry in the queue. Each spelling is rewritten to only one page, so this is how
+        many more spellings there were than pages.
+        """
+        return len(self._spellings) - len(self._pages)
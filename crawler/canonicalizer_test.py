@@ -0,0 +1,96 @@
+import pytest
+
+from .canonicalizer import CanonicalizationReport, IdentityCanonicalizer, UrlCanonicalizer
+
+
+@pytest.mark.parametrize(
+    ["url", "expected"],
+    [
+        ('http://root.com/', 'http://root.com/'),
+        ('http://root.com', 'http://root.com/'),
+        ('HTTP://Root.COM/Path', 'http://root.com/Path'),
+        ('http://root.com:80/a', 'http://root.com/a'),
+        ('https://root.com:443/a', 'https://root.com/a'),
+        ('http://root.com:8080/a', 'http://root.com:8080/a'),
+        ('http://user:pw@Root.com:80/a', 'http://user:pw@root.com/a'),
+        ('http://[::1]:8080/a', 'http://[::1]:8080/a'),
+        ('http://root.com/a#section', 'http://root.com/a'),
+        ('http://root.com/a?b=c#section', 'http://root.com/a?b=c'),
+        ('http://root.com/King%20Edward', 'http://root.com/King%20Edward'),
+        ('http://root.com/a%2fb', 'http://root.com/a%2Fb'),
+        ('http://root.com/%7Euser/%41bc', 'http://root.com/~user/Abc'),
+        ('http://root.com/a?name=x%2cy', 'http://root.com/a?name=x%2Cy'),
+        ('http://root.com/a/', 'http://root.com/a/'),
+        ('http://root.com/a?z=1&a=2', 'http://root.com/a?z=1&a=2'),
+        ('http://root.com/a?id=1&depth=8&depth=8', 'http://root.com/a?id=1&depth=8&depth=8'),
+        ('root', 'root'),
+        ('mailto:someone@root.com', 'mailto:someone@root.com'),
+        ('http://root.com:notaport/a', 'http://root.com:notaport/a'),
+    ]
+)
+def test_default_rules(url, expected):
+    assert UrlCanonicalizer().canonicalize(url) == expected
+
+
+@pytest.mark.parametrize(
+    ["url", "expected"],
+    [
+        ('http://root.com/a?id=1&depth=8&depth=8', 'http://root.com/a?id=1&depth=8'),
+        ('http://root.com/a?id=1&depth=8&depth=8&depth=8', 'http://root.com/a?id=1&depth=8'),
+        ('http://root.com/a?id=1&depth=8&depth=4', 'http://root.com/a?id=1&depth=8&depth=4'),
+        ('http://root.com/a?id=1&&depth=8', 'http://root.com/a?id=1&depth=8'),
+        ('http://root.com/a?id=1&depth=%38&depth=8', 'http://root.com/a?id=1&depth=8'),
+    ]
+)
+def test_dedupe_query(url, expected):
+    assert UrlCanonicalizer(dedupe_query=True).canonicalize(url) == expected
+
+
+@pytest.mark.parametrize(
+    ["url", "expected"],
+    [
+        ('http://root.com/a?z=1&a=2', 'http://root.com/a?a=2&z=1'),
+        ('http://root.com/a?b=2&a=1&b=1', 'http://root.com/a?a=1&b=2&b=1'),
+        ('http://root.com/a?b&a=1', 'http://root.com/a?a=1&b'),
+    ]
+)
+def test_sort_query(url, expected):
+    assert UrlCanonicalizer(sort_query=True).canonicalize(url) == expected
+
+
+@pytest.mark.parametrize(
+    ["url", "expected"],
+    [
+        ('http://root.com/a/', 'http://root.com/a'),
+        ('http://root.com/a//', 'http://root.com/a'),
+        ('http://root.com/a/?b=c', 'http://root.com/a?b=c'),
+        ('http://root.com/', 'http://root.com/'),
+        ('http://root.com', 'http://root.com/'),
+    ]
+)
+def test_strip_trailing_slash(url, expected):
+    assert UrlCanonicalizer(strip_trailing_slash=True).canonicalize(url) == expected
+
+
+def test_identity():
+    assert IdentityCanonicalizer().canonicalize('HTTP://Root.com:80/a/#b') == 'HTTP://Root.com:80/a/#b'
+
+
+def test_report():
+    r = CanonicalizationReport()
+    r.record('http://root.com/a', 'http://root.com/a')
+    r.record('http://root.com/a#b', 'http://root.com/a')
+    r.record('http://root.com/a#b', 'http://root.com/a')
+    r.record('http://root.com/a#c', 'http://root.com/a')
+
+    assert r.rewritten == 3
+    assert r.fetches_saved == 2
+
+
+def test_report_only_spelling_saves_nothing():
+    r = CanonicalizationReport()
+    r.record('http://root.com/a#b', 'http://root.com/a')
+    r.record('http://root.com/c', 'http://root.com/c')
+
+    assert r.rewritten == 1
+    assert r.fetches_saved == 0
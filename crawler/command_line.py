@@ -0,0 +1,167 @@
+import concurrent.futures
+import contextlib
+import datetime
+import logging
+import pathlib
+from typing import Callable, Iterable, Optional
+
+from absl import flags
+
+from .backoff import Backoff
+from .canonicalizer import Canonicalizer
+from .crawler import Crawler
+from .error_handler import LoggingHandler, RetryingHandler
+from .handler import Handler
+from .http_fetcher import HttpFetcher
+from .metrics import Metrics
+from .politeness import PolitenessScheduler, Rate
+from .sharded_state_manager import ShardedStateManager
+from .sqlite_state_manager import SqlStateManager
+from .visited_set import BloomFilter
+
+FLAGS = flags.FLAGS
+
+
+def define_flags(root_url: str, user_agent: str, crawl_delay_seconds: int) -> None:
+    """
+    Defines the flags every site's crawl takes, for run() to read. Call this once, when the site's main module is
+    imported.
+    :param root_url: Default URL to begin the crawl at.
+    :param user_agent: Default user agent to report when fetching pages.
+    :param crawl_delay_seconds: Default time between requests to the site, in seconds.
+    """
+    flags.DEFINE_string('root_url', root_url, 'URL to begin the crawl at.')
+    flags.DEFINE_string('state_root', '', 'Path to directory used to manage queue state.')
+    flags.DEFINE_string('output_root', '', 'Path to write output files under.')
+    flags.DEFINE_string('user_agent', user_agent, 'User agent to report when fetching pages.')
+    flags.DEFINE_integer('max_page_bytes', 10 * 1024 * 1024, 'Largest page to download, in bytes. 0 means no limit.',
+                         lower_bound=0)
+    flags.DEFINE_integer('fetch_deadline_seconds', 60, 'Longest to spend downloading one page, in seconds. 0 means no '
+                         'limit.', lower_bound=0)
+    flags.DEFINE_integer('crawl_delay_seconds', crawl_delay_seconds, 'Average time between requests to the site, in '
+                         'seconds.', lower_bound=0)
+    flags.DEFINE_integer('crawl_burst', 1, 'How many requests may be made to the site back-to-back, after a quiet '
+                         'spell.', lower_bound=1)
+    flags.DEFINE_integer('num_workers', 1, 'How many pages to crawl at once. Requests to each host are still spaced '
+                         'out by the crawl delay.', lower_bound=1)
+    flags.DEFINE_integer('prefetch_depth', 0, 'How many pages each worker fetches ahead, while handling the current '
+                         'one.', lower_bound=0)
+    flags.DEFINE_integer('handler_processes', 0, 'How many processes to parse pages in. 0 parses pages in the worker '
+                         'threads that fetched them.', lower_bound=0)
+    flags.DEFINE_integer('max_failures_per_url', 3, 'How many times to try crawling a single URL before giving up.',
+                         lower_bound=0)
+    flags.DEFINE_bool('requeue_failed', False, 'Before crawling, give pages that failed too many times on earlier '
+                      'runs another go.')
+    flags.DEFINE_integer('retry_backoff_seconds', 60, 'How long to wait before retrying a page after it first fails, '
+                         'in seconds. Doubles after each failure, and is partly random. 0 retries straight away.',
+                         lower_bound=0)
+    flags.DEFINE_integer('retry_backoff_max_seconds', 3600, 'Longest to wait before retrying a page, in seconds.',
+                         lower_bound=0)
+    flags.DEFINE_integer('lease_seconds', 600, 'How long a URL being crawled is held back from other crawlers sharing '
+                         'the state database. Should be longer than a page can spend waiting, being fetched and being '
+                         'handled.', lower_bound=0)
+    flags.DEFINE_bool('group_commit', True, 'Commit changes to crawl state in batches, with write-ahead logging. Much '
+                      'cheaper, but a crash may lose the last few changes, so a few pages may be crawled again.')
+    flags.DEFINE_integer('commit_every', 100, 'With group commits, the most changes to batch together.',
+                         lower_bound=1)
+    flags.DEFINE_integer('commit_interval_ms', 200, 'With group commits, the longest a change waits to be committed, '
+                         'in milliseconds.', lower_bound=0)
+    flags.DEFINE_integer('visited_filter_capacity', 0, 'If set, remember crawled URLs in a Bloom filter sized for '
+                         'this many URLs, rather than in the state database. Takes a few bytes per URL, but a few '
+                         'pages are wrongly skipped.', lower_bound=0)
+    flags.DEFINE_float('visited_filter_false_positive_rate', 1e-4, 'Chance that the visited filter wrongly skips a '
+                       'page.', lower_bound=0, upper_bound=1)
+    flags.DEFINE_string('metrics_path', '', 'Path to periodically write timings for each stage of the crawl to. Not '
+                        'written if empty.')
+    flags.DEFINE_enum('metrics_format', 'json', ['json', 'prometheus'], 'Format to write metrics in.')
+    flags.DEFINE_integer('metrics_interval_seconds', 60, 'How often to write metrics, in seconds.', lower_bound=0)
+    flags.DEFINE_integer('num_shards', 1, 'How many processes the crawl is split between. Each keeps its own crawl '
+                         'state, and the crawl delay is stretched so that together they keep to it. Every shard must '
+                         'be started, and each process keeps going until they have all run out of pages.',
+                         lower_bound=1)
+    flags.DEFINE_integer('shard_index', 0, 'Which shard this process crawls, from 0.', lower_bound=0)
+
+
+def run(name: str,
+        handler_factory: Callable[[pathlib.Path], Handler],
+        route: Callable[[str], Optional[str]],
+        host: str,
+        url_prefixes: Iterable[str],
+        content_types: Iterable[str],
+        canonicalizer: Canonicalizer) -> None:
+    """
+    Crawls a site, as configured by the flags from define_flags().
+    :param name: Names the files the crawl state is kept in, under the state root.
+    :param handler_factory: Makes the handler, given the output root.
+    :param route: Names the route each URL belongs to, for metrics.
+    :param host: The site's host, which every request is spaced out for.
+    :param url_prefixes: Shared by almost every URL on the site, so the state manager stores them compactly.
+    :param content_types: Media types the handler can use. Nothing else is downloaded.
+    :param canonicalizer: Rewrites discovered URLs, in whatever ways the site allows.
+    """
+    if not FLAGS.state_root:
+        raise ValueError('State root must be provided')
+    if not FLAGS.output_root:
+        raise ValueError('Output root must be provided')
+    if not FLAGS.root_url:
+        raise ValueError('Root URL must be provided')
+    state_root = pathlib.Path(FLAGS.state_root)
+
+    handler = handler_factory(pathlib.Path(FLAGS.output_root))
+    durability = SqlStateManager.Durability.FULL
+    if FLAGS.group_commit:
+        durability = SqlStateManager.Durability.GROUP_COMMIT
+    # Each shard keeps its state in files of its own.
+    shard_suffix = f'_{FLAGS.shard_index}' if FLAGS.num_shards > 1 else ''
+    backoff = None
+    if FLAGS.retry_backoff_seconds:
+        backoff = Backoff(datetime.timedelta(seconds=FLAGS.retry_backoff_seconds),
+                          datetime.timedelta(seconds=FLAGS.retry_backoff_max_seconds))
+    visited_set = None
+    if FLAGS.visited_filter_capacity:
+        visited_set = BloomFilter(FLAGS.visited_filter_capacity, FLAGS.visited_filter_false_positive_rate,
+                                  state_root / f'{name}{shard_suffix}_visited.bloom')
+    state_manager = SqlStateManager(state_root / f'{name}{shard_suffix}.db',
+                                    max_failures_per_url=FLAGS.max_failures_per_url,
+                                    lease=datetime.timedelta(seconds=FLAGS.lease_seconds),
+                                    durability=durability,
+                                    commit_every=FLAGS.commit_every,
+                                    commit_interval=datetime.timedelta(milliseconds=FLAGS.commit_interval_ms),
+                                    visited_set=visited_set,
+                                    url_prefixes=url_prefixes,
+                                    backoff=backoff)
+    if FLAGS.requeue_failed:
+        logging.info('Requeued %d failed pages', state_manager.requeue_dead_letters())
+    crawl_state = state_manager
+    if FLAGS.num_shards > 1:
+        # Every URL is on the same site, so spread them across shards by the whole URL.
+        crawl_state = ShardedStateManager(state_manager, FLAGS.shard_index, FLAGS.num_shards,
+                                          state_root / f'{name}_inbox', ShardedStateManager.Partition.URL)
+    crawl_rate = Rate(datetime.timedelta(seconds=FLAGS.crawl_delay_seconds * FLAGS.num_shards), FLAGS.crawl_burst)
+    scheduler = PolitenessScheduler(crawl_rate, {host: crawl_rate})
+
+    metrics = Metrics(route,
+                      export_path=pathlib.Path(FLAGS.metrics_path) if FLAGS.metrics_path else None,
+                      export_format=Metrics.Format[FLAGS.metrics_format.upper()],
+                      export_interval=datetime.timedelta(seconds=FLAGS.metrics_interval_seconds))
+
+    # Keep a connection open for every thread that may be fetching, so none has to reconnect.
+    fetcher = HttpFetcher(FLAGS.user_agent, max_connections_per_host=FLAGS.num_workers * (FLAGS.prefetch_depth + 1),
+                          max_body_bytes=FLAGS.max_page_bytes, content_types=content_types,
+                          deadline_seconds=FLAGS.fetch_deadline_seconds)
+    try:
+        with contextlib.ExitStack() as stack:
+            handler_executor = None
+            if FLAGS.handler_processes:
+                handler_executor = stack.enter_context(
+                    concurrent.futures.ProcessPoolExecutor(FLAGS.handler_processes))
+            c = Crawler(fetcher, handler, crawl_state,
+                        RetryingHandler(LoggingHandler()), num_workers=FLAGS.num_workers,
+                        handler_executor=handler_executor, scheduler=scheduler, prefetch_depth=FLAGS.prefetch_depth,
+                        canonicalizer=canonicalizer, metrics=metrics, raw_content=True)
+            c.crawl([FLAGS.root_url])
+    finally:
+        fetcher.close()
+        if crawl_state is not state_manager:
+            crawl_state.close()
+        state_manager.close()
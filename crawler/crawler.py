@@ -1,14 +1,34 @@
+import collections
+import concurrent.futures
 import datetime
+import logging
+import threading
 import time
 import urllib.parse
-from typing import Callable, List
+from typing import Callable, Counter, Deque, List, NamedTuple, Optional, Set, Tuple, Union
 
+from .canonicalizer import CanonicalizationReport, Canonicalizer, UrlCanonicalizer
 from .error_handler import ErrorHandler
-from .fetcher import Fetcher
-from .handler import Handler
+from .fetcher import Fetcher, RawContent
+from .handler import Handler, collect_links
+from .metrics import Metrics
+from .politeness import PolitenessScheduler, Rate
 from .state_manager import StateManager
 
 
+class _Page(NamedTuple):
+    """
+    A URL popped from the queue, waiting to be crawled by a worker.
+    """
+    url: str
+    # Fetch running in the background, if we are prefetching.
+    fetch: Optional[concurrent.futures.Future]
+    # Whether the URL was already being crawled when it was popped.
+    duplicate: bool
+    # When its politeness slot begins, by the monotonic clock. Duplicates book a slot once they need one.
+    start_at: Optional[float] = None
+
+
 class Crawler:
     """
     Framework for crawling URLs beginning at a certain root, and adding new URLs
@@ -16,6 +36,21 @@ class Crawler:
 
     This class is generic and handles the orchestration logic. It delegates to
     handlers for fetching URLs, processing their content, and handling errors.
+
+    Pages can be crawled by several worker threads at once. Calls to the state
+    manager are serialized, so it does not need to be thread-safe itself, but the
+    fetcher, handler and error handler may be called from several threads.
+
+    Each worker can also fetch a few pages ahead in the background, so that the
+    next page is downloading while the current one is being handled. A page's
+    politeness slot is booked when it is popped, and its URL stays claimed while it
+    waits for the slot, so pages are only popped while the last one popped can
+    start within `max_wait`, as in AsyncCrawler.
+
+    Parsing pages is usually CPU-bound, so threads alone will not make it faster.
+    Given a handler executor such as a ProcessPoolExecutor, pages are fetched here
+    and handled there, with discovered URLs sent back to be enqueued. The handler
+    must then be picklable.
     """
 
     def __init__(self,
@@ -23,19 +58,64 @@ class Crawler:
                  handler: Handler,
                  state_manager: StateManager,
                  error_handler: ErrorHandler,
-                 crawl_delay: datetime.timedelta = datetime.timedelta(0)):
+                 crawl_delay: datetime.timedelta = datetime.timedelta(0),
+                 num_workers: int = 1,
+                 handler_executor: Optional[concurrent.futures.Executor] = None,
+                 scheduler: Optional[PolitenessScheduler] = None,
+                 prefetch_depth: int = 0,
+                 canonicalizer: Optional[Canonicalizer] = None,
+                 metrics: Optional[Metrics] = None,
+                 raw_content: bool = False,
+                 max_wait: datetime.timedelta = datetime.timedelta(minutes=1)):
         """
         :param fetcher: Fetcher to be used to fetch URLs.
         :param handler: Handler to process fetched URLs.
         :param state_manager: Manages the crawl queue.
         :param error_handler: Determines how any errors raised during crawl are handled.
-        :param crawl_delay: Specifies how long to wait before making each request.
+        :param crawl_delay: Minimum time between requests to the same host.
+        :param num_workers: How many pages to crawl at once.
+        :param handler_executor: Where to run the handler. Defaults to the worker thread that fetched the page.
+        :param scheduler: Decides when each request may be made. Overrides `crawl_delay` if given.
+        :param prefetch_depth: How many pages each worker fetches ahead, while handling the current one.
+        :param canonicalizer: Rewrites URLs before they are enqueued. Defaults to rewrites that are safe for any site.
+        :param metrics: Records how long each stage of the crawl takes. Defaults to keeping metrics in memory.
+        :param raw_content: Whether to fetch pages as bytes and pass them to the handler's handle_raw(), rather than
+            decoding them first. Saves decoding each page twice, if the handler's parser decodes it anyway.
+        :param max_wait: How far ahead to book politeness slots. Together with the longest crawl delay, this is
+            how long a popped URL can wait before it is fetched, so it should be well within any lease the state
+            manager holds popped URLs for.
         """
+        if num_workers < 1:
+            raise ValueError(f'Need at least one worker, got {num_workers}')
+        if prefetch_depth < 0:
+            raise ValueError(f'Cannot prefetch a negative number of pages, got {prefetch_depth}')
         self.fetcher = fetcher
         self.handler = handler
         self.state_manager = state_manager
         self.error_handler = error_handler
         self.crawl_delay = crawl_delay
+        self.num_workers = num_workers
+        self.handler_executor = handler_executor
+        self.scheduler = scheduler or PolitenessScheduler(Rate(crawl_delay))
+        self.prefetch_depth = prefetch_depth
+        self.canonicalizer = canonicalizer or UrlCanonicalizer()
+        self.canonicalization_report = CanonicalizationReport()
+        self.metrics = metrics or Metrics()
+        self.raw_content = raw_content
+        self.max_wait = max_wait
+
+        # Guards the state manager, and lets idle workers wait for more URLs.
+        self._lock = threading.Condition()
+        self._in_flight = 0
+        self._stopped = False
+        # When the last page popped will be within max_wait of its politeness slot.
+        self._pop_after = 0.0
+        # URLs being crawled, and how many more times each has been popped meanwhile.
+        self._unsettled: Set[str] = set()
+        self._duplicates: Counter[str] = collections.Counter()
+        # URLs crawled successfully, whose duplicates have not been marked completed yet.
+        self._succeeded: Set[str] = set()
+        self._fetch_executor: Optional[concurrent.futures.ThreadPoolExecutor] = None
 
     def _enqueue_fn(self) -> Callable[[str, str], None]:
         """
@@ -45,19 +125,196 @@ class Crawler:
         """
 
         def put_fn(current_url, new_url: str) -> None:
-            # Resolves relative URLs relative to the current URL. If new_url is
-            # absolute, then current_url will be ignored.
-            url = urllib.parse.urljoin(current_url, new_url)
-            self.state_manager.enqueue(url)
+            self._enqueue_many([(current_url, new_url)])
 
         return put_fn
 
+    def _enqueue_many(self, links: List[Tuple[str, str]]) -> None:
+        """
+        Enqueues several URLs at once, in the same way as `_enqueue_fn`. URLs are
+        canonicalized first, so that different spellings of the same page are deduplicated.
+        :param links: (current_url, new_url) pairs, as passed to the enqueue callback.
+        """
+        # Resolves relative URLs relative to the current URL. If new_url is
+        # absolute, then current_url will be ignored.
+        urls = [urllib.parse.urljoin(current_url, new_url) for current_url, new_url in links]
+        canonical_urls = [self.canonicalizer.canonicalize(url) for url in urls]
+        with self._lock:
+            for url, canonical_url in zip(urls, canonical_urls):
+                self.canonicalization_report.record(url, canonical_url)
+            self.metrics.set_gauge('canonicalization_fetches_saved', self.canonicalization_report.fetches_saved)
+            with self.metrics.time('state_enqueue'):
+                self.state_manager.enqueue_many(canonical_urls)
+            self._lock.notify_all()
+
     def _retry_fn(self, url: str) -> Callable[[], None]:
         def retry_fn() -> None:
             return self._enqueue_fn()('', url)
 
         return retry_fn
 
+    def _pop(self) -> Optional[_Page]:
+        """
+        Takes the next URL from the queue, and starts fetching it if we are prefetching.
+        Must be called with the lock held.
+        :return: The popped page, or None if the queue is empty.
+        """
+        with self.metrics.time('state_pop'):
+            url = self.state_manager.try_pop()
+        if url is None:
+            return None
+        self._in_flight += 1
+        if url in self._unsettled:
+            # Some state managers hand out a URL again before it has been marked. Don't fetch it
+            # twice at once, but wait to see how the first attempt went.
+            self._duplicates[url] += 1
+            return _Page(url, None, True)
+        self._unsettled.add(url)
+        wait = self.scheduler.reserve(url)
+        start_at = time.monotonic() + wait
+        self._pop_after = start_at - self.max_wait.total_seconds()
+        fetch = None
+        if self._fetch_executor is not None:
+            fetch = self._fetch_executor.submit(self._fetch, url, start_at)
+        return _Page(url, fetch, False, start_at)
+
+    def _mark(self, url: str, succeeded: bool, error: Optional[Exception] = None) -> None:
+        with self._lock, self.metrics.time('state_mark'):
+            if succeeded:
+                self.state_manager.mark_completed(url)
+            else:
+                self.state_manager.mark_failed(url, error)
+
+    def _fill(self, window: Deque[_Page]) -> None:
+        """
+        Tops up a worker's window of pages. Blocks until there is a page in the window, or
+        the crawl is over. Other workers may still discover new pages while the queue is
+        empty, so we only give up once nothing is in flight, and no failed pages are
+        waiting to be retried.
+        :param window: Pages this worker has popped but not yet processed, in order.
+        """
+        with self._lock:
+            while not self._stopped:
+                pause = 0.0
+                while len(window) <= self.prefetch_depth:
+                    pause = self._pop_after - time.monotonic()
+                    if pause > 0:
+                        break
+                    page = self._pop()
+                    if page is None:
+                        break
+                    window.append(page)
+                if window:
+                    return
+                if pause > 0:
+                    self._lock.wait(pause)
+                    continue
+                retry_delay = self.state_manager.retry_delay()
+                if retry_delay is None:
+                    if self._in_flight == 0:
+                        return
+                    self._lock.wait()
+                else:
+                    self._lock.wait(retry_delay.total_seconds())
+
+    def _await_original(self, url: str) -> bool:
+        """
+        Waits until the first attempt at a duplicate URL has been settled. If it succeeded,
+        the duplicate is marked completed too.
+        :return: Whether the duplicate still needs to be crawled.
+        """
+        with self._lock:
+            while url in self._unsettled and not self._stopped:
+                self._lock.wait()
+            self._duplicates[url] -= 1
+            if not self._duplicates[url]:
+                del self._duplicates[url]
+            if self._stopped:
+                return False
+            if url in self._succeeded:
+                if url not in self._duplicates:
+                    self._succeeded.remove(url)
+                with self.metrics.time('state_mark'):
+                    self.state_manager.mark_completed(url)
+                return False
+            self._unsettled.add(url)
+            return True
+
+    def _settle(self, url: str, succeeded: bool) -> None:
+        with self._lock:
+            self._unsettled.discard(url)
+            if succeeded and url in self._duplicates:
+                self._succeeded.add(url)
+            self._lock.notify_all()
+
+    def _fetch(self, url: str, start_at: Optional[float]) -> Union[str, RawContent]:
+        """
+        :param start_at: When the politeness slot booked for the URL begins, if one was booked.
+        """
+        route = self.metrics.route(url)
+        with self.metrics.time('wait', route):
+            if start_at is None:
+                self.scheduler.wait(url)
+            else:
+                time.sleep(max(0.0, start_at - time.monotonic()))
+        print(f'Processing url: {url}')
+        with self.metrics.time('fetch', route):
+            if self.raw_content:
+                return self.fetcher.fetch_raw(url)
+            return self.fetcher.fetch(url)
+
+    def _process(self, page: _Page) -> None:
+        url = page.url
+        if page.duplicate and not self._await_original(url):
+            return
+        succeeded = False
+        try:
+            content = page.fetch.result() if page.fetch else self._fetch(url, page.start_at)
+            self._handle(content, url)
+            self._mark(url, True)
+            succeeded = True
+        except Exception as e:
+            self._mark(url, False, e)
+            self.error_handler.handle(e, self._retry_fn(url))
+        finally:
+            self._settle(url, succeeded)
+            self.metrics.increment('pages_completed' if succeeded else 'pages_failed', self.metrics.route(url))
+            self.metrics.maybe_export()
+
+    def _handle(self, content: Union[str, RawContent], url: str) -> None:
+        # Links are collected and enqueued together once the page is handled, which is
+        # much cheaper for state managers that write each enqueue to disk.
+        route = self.metrics.route(url)
+        with self.metrics.time('handle', route):
+            if self.handler_executor is None:
+                with self.metrics.handling(route):
+                    links = collect_links(self.handler, content, url)
+            else:
+                # Other workers carry on fetching while we wait. Stages the handler times itself
+                # are not recorded, as it may be running in another process.
+                links = self.handler_executor.submit(collect_links, self.handler, content, url).result()
+        self._enqueue_many(links)
+
+    def _work(self) -> None:
+        window: Deque[_Page] = collections.deque()
+        try:
+            while True:
+                self._fill(window)
+                if not window or self._stopped:
+                    return
+                try:
+                    self._process(window.popleft())
+                finally:
+                    with self._lock:
+                        self._in_flight -= 1
+                        self._lock.notify_all()
+        except BaseException:
+            # Stop the other workers too, so errors can propagate out of crawl().
+            with self._lock:
+                self._stopped = True
+                self._lock.notify_all()
+            raise
+
     def crawl(self, roots: List[str]) -> None:
         """
         Initiates a crawl beginning at a given URL and continuing until there are
@@ -66,18 +323,28 @@ class Crawler:
         """
 
         # TODO: Check constraints from robot.txt before starting.
-        for root in roots:
-            self.state_manager.enqueue(root)
-
-        # TODO: Multithreading to parallelize.
-        while not self.state_manager.is_finished():
-            url = self.state_manager.pop_next()
-            time.sleep(self.crawl_delay.total_seconds())
-            print(f'Processing url: {url}')
-            try:
-                content = self.fetcher.fetch(url)
-                self.handler.handle(content, url, self._enqueue_fn())
-                self.state_manager.mark_completed(url)
-            except Exception as e:
-                self.state_manager.mark_failed(url)
-                self.error_handler.handle(e, self._retry_fn(url))
+        self._enqueue_many([('', root) for root in roots])
+
+        self._stopped = False
+        if self.prefetch_depth:
+            self._fetch_executor = concurrent.futures.ThreadPoolExecutor(self.num_workers * (self.prefetch_depth + 1))
+        try:
+            if self.num_workers == 1:
+                self._work()
+                return
+
+            with concurrent.futures.ThreadPoolExecutor(self.num_workers) as executor:
+                workers = [executor.submit(self._work) for _ in range(self.num_workers)]
+                for worker in workers:
+                    worker.result()
+        finally:
+            with self._lock:
+                self.state_manager.flush()
+            if self._fetch_executor is not None:
+                # Don't wait for prefetches that were abandoned when the crawl stopped early.
+                self._fetch_executor.shutdown(wait=False, cancel_futures=True)
+                self._fetch_executor = None
+            logging.getLogger(type(self).__name__).info(
+                'Canonicalization rewrote %d discovered URLs, saving up to %d fetches',
+                self.canonicalization_report.rewritten, self.canonicalization_report.fetches_saved)
+            self.metrics.export()
@@ -1,14 +1,24 @@
+import concurrent.futures
 import datetime
+import json
+import os
 import queue
+import threading
 import time
-from typing import Callable, Dict, Optional, Set
+from typing import Callable, Dict, Iterable, List, Optional, Set
 
 import pytest
 
+from .backoff import Backoff
+from .canonicalizer import IdentityCanonicalizer, UrlCanonicalizer
 from .crawler import Crawler
 from .error_handler import LoggingHandler, ThrowingHandler, RetryingHandler
-from .fetcher import Fetcher
+from .fetch_error import HttpStatusError
+from .fetcher import Fetcher, RawContent
 from .handler import Handler
+from .metrics import Metrics, timed
+from .politeness import PolitenessScheduler, Rate
+from .sqlite_state_manager import SqlStateManager
 from .state_manager import StateManager
 
 
@@ -48,7 +58,7 @@ class FakeStateManager(StateManager):
     def pop_next(self) -> str:
         return self.queue.get_nowait()
 
-    def mark_failed(self, url: str) -> None:
+    def mark_failed(self, url: str, error: Optional[Exception] = None) -> None:
         self.failed[url] = self.failed.get(url, 0) + 1
 
     def mark_completed(self, url: str) -> None:
@@ -147,7 +157,44 @@ def test_crawl_delay():
     end = time.time()
 
     assert len(processed) == 3
-    assert end - start > len(processed) * crawl_delay.total_seconds()
+    # No need to wait before the first request.
+    assert end - start > (len(processed) - 1) * crawl_delay.total_seconds()
+
+
+def test_crawl_delay_not_added_to_handling_time():
+    f = FakeFetcher({'root': 'foo', 'a': 'bar', 'b': 'baz'})
+
+    def handle(content: str, url: str, callback: Callable[[str, str], None]) -> None:
+        time.sleep(0.2)
+        if content == 'foo':
+            callback('', 'a')
+            callback('', 'b')
+
+    crawl_delay = datetime.timedelta(seconds=0.25)
+
+    start = time.time()
+    Crawler(f, FakeHandler(handle), FakeStateManager(), ThrowingHandler(), crawl_delay=crawl_delay).crawl(['root'])
+    end = time.time()
+
+    # Two delays, then handling the last page.
+    assert end - start < 2 * crawl_delay.total_seconds() + 0.2 + 0.15
+
+
+def test_scheduler():
+    urls = ['http://a.com/1', 'http://a.com/2', 'http://a.com/3', 'http://b.com/1', 'http://b.com/2']
+    f = FakeFetcher({url: 'foo' for url in urls})
+    processed = []
+    h = FakeHandler(lambda content, url, callback: processed.append(url))
+    scheduler = PolitenessScheduler(Rate(datetime.timedelta(seconds=10)),
+                                    {'a.com': Rate(datetime.timedelta(seconds=0.1), burst=2),
+                                     'b.com': Rate(datetime.timedelta(seconds=0.2))})
+
+    start = time.time()
+    Crawler(f, h, FakeStateManager(), ThrowingHandler(), scheduler=scheduler).crawl(urls)
+    end = time.time()
+
+    assert processed == urls
+    assert 0.3 <= end - start < 0.6
 
 
 def test_error_fetching():
@@ -200,3 +247,598 @@ def test_exhaust_failures():
     Crawler(f, h, m, RetryingHandler(LoggingHandler())).crawl(['root'])
 
     assert processed == []
+
+
+@pytest.mark.parametrize('num_workers', [1, 2])
+def test_retry_waits_for_backoff(tmp_path, num_workers):
+    processed = []
+    h = FakeHandler(lambda content, url, callback: processed.append(f'{url}: {content}'))
+    m = SqlStateManager(tmp_path / 'queue.db', backoff=Backoff(datetime.timedelta(milliseconds=200), jitter=0))
+    start = time.monotonic()
+
+    Crawler(EventualFetcher(failures=2), h, m, RetryingHandler(LoggingHandler()), num_workers=num_workers).crawl(
+        ['root'])
+
+    assert processed == ['root: foo']
+    assert time.monotonic() - start >= 0.2
+
+
+def test_permanent_failure_not_refetched(tmp_path):
+    f = FakeFetcher({}, HttpStatusError('404 Client Error', 404))
+    fetched = []
+    f.fetch = lambda url: fetched.append(url) or FakeFetcher.fetch(f, url)
+    m = SqlStateManager(tmp_path / 'queue.db', max_failures_per_url=3)
+
+    Crawler(f, FakeHandler(lambda content, url, callback: None), m, RetryingHandler(LoggingHandler())).crawl(['root'])
+
+    assert fetched == ['root']
+
+
+def test_restart_recrawls_leased_urls(tmp_path):
+    db_path = tmp_path / 'queue.db'
+    m = SqlStateManager(db_path, lease=datetime.timedelta(milliseconds=200))
+    m.enqueue_many(['a', 'b'])
+    m.pop_next()
+    m.close()
+    f = RecordingFetcher()
+
+    Crawler(f, FakeHandler(lambda content, url, callback: None), SqlStateManager(db_path), ThrowingHandler()).crawl([])
+
+    assert f.fetched == ['b', 'a']
+
+def test_invalid_num_workers():
+    with pytest.raises(ValueError, match='at least one worker'):
+        Crawler(FakeFetcher({}), FakeHandler(lambda content, url, callback: None), FakeStateManager(),
+                ThrowingHandler(), num_workers=0)
+
+
+def test_crawl_concurrently():
+    pages = {'root': 'foo', 'a': 'bar', 'b': 'baz', 'c': 'qux'}
+    f = FakeFetcher(pages)
+    processed = []
+
+    def handle(content: str, url: str, callback: Callable[[str, str], None]) -> None:
+        time.sleep(0.2)
+        processed.append(url)
+        if url == 'root':
+            callback('', 'a')
+            callback('', 'b')
+            callback('', 'c')
+
+    start = time.time()
+    Crawler(f, FakeHandler(handle), FakeStateManager(), ThrowingHandler(), num_workers=3).crawl(['root'])
+    end = time.time()
+
+    assert sorted(processed) == sorted(pages)
+    # Root on its own, then the three pages it discovered all at once.
+    assert end - start < 3 * 0.2
+
+
+def test_crawl_concurrently_waits_for_discovered_pages():
+    f = FakeFetcher({'root': 'foo', 'a': 'bar', 'b': 'baz', 'c': 'qux', 'd': 'quux'})
+    processed = []
+
+    def handle(content: str, url: str, callback: Callable[[str, str], None]) -> None:
+        # Other workers find the queue empty while this page is being handled.
+        time.sleep(0.1)
+        processed.append(url)
+        if content == 'foo':
+            callback('', 'a')
+        elif content == 'bar':
+            callback('', 'b')
+            callback('', 'c')
+        elif content == 'qux':
+            callback('', 'd')
+
+    Crawler(f, FakeHandler(handle), FakeStateManager(), ThrowingHandler(), num_workers=4).crawl(['root'])
+
+    assert sorted(processed) == ['a', 'b', 'c', 'd', 'root']
+
+
+def test_crawl_delay_per_host():
+    urls = ['http://a.com/1', 'http://a.com/2', 'http://b.com/1', 'http://b.com/2']
+    f = FakeFetcher({url: 'foo' for url in urls})
+    processed = []
+    h = FakeHandler(lambda content, url, callback: processed.append(url))
+    crawl_delay = datetime.timedelta(seconds=0.25)
+
+    start = time.time()
+    Crawler(f, h, FakeStateManager(), ThrowingHandler(), crawl_delay=crawl_delay, num_workers=4).crawl(urls)
+    end = time.time()
+
+    assert sorted(processed) == urls
+    # Two requests to each host, but the hosts are crawled side by side.
+    assert crawl_delay.total_seconds() <= end - start < 2 * crawl_delay.total_seconds()
+
+
+def test_error_stops_concurrent_crawl():
+    f = FakeFetcher({'root': 'foo'})
+
+    def handle(page: str, url: str, callback: Callable[[str, str], None]) -> None:
+        raise ValueError('bar')
+
+    with pytest.raises(ValueError, match='bar'):
+        Crawler(f, FakeHandler(handle), FakeStateManager(), ThrowingHandler(), num_workers=3).crawl(['root'])
+
+
+class ChildProcessHandler(Handler):
+    """
+    Handler that can be pickled, and which refuses to run in the process that created it.
+    """
+
+    def __init__(self, links: Dict[str, List[str]]):
+        self.links = links
+        self.parent_pid = os.getpid()
+
+    def handle(self, content: str, url: str, enqueue_callback: Callable[[str, str], None]) -> None:
+        if os.getpid() == self.parent_pid:
+            raise ValueError('Handled in parent process')
+        for link in self.links.get(url, []):
+            enqueue_callback(url, link)
+
+
+class RecordingFetcher(Fetcher):
+    def __init__(self):
+        self.fetched = []
+
+    def fetch(self, url: str) -> str:
+        self.fetched.append(url)
+        return 'foo'
+
+
+def test_handle_in_process_pool():
+    f = RecordingFetcher()
+    h = ChildProcessHandler({'http://root.com/': ['a', 'b'], 'http://root.com/a': ['/c']})
+
+    with concurrent.futures.ProcessPoolExecutor(2) as executor:
+        Crawler(f, h, FakeStateManager(), ThrowingHandler(), num_workers=2, handler_executor=executor).crawl(
+            ['http://root.com/'])
+
+    assert sorted(f.fetched) == ['http://root.com/', 'http://root.com/a', 'http://root.com/b', 'http://root.com/c']
+
+
+def test_handle_in_process_pool_error():
+    f = RecordingFetcher()
+    h = ChildProcessHandler({})
+    # Unpicklable handlers can't be sent to other processes.
+    h.lock = threading.Lock()
+
+    with concurrent.futures.ProcessPoolExecutor(1) as executor:
+        with pytest.raises(TypeError, match='pickle'):
+            Crawler(f, h, FakeStateManager(), ThrowingHandler(), handler_executor=executor).crawl(['root'])
+
+
+class SlowFetcher(Fetcher):
+    def __init__(self, delay: float, error_urls: Optional[Set[str]] = None):
+        self.delay = delay
+        self.error_urls = error_urls or set()
+        self.fetched = []
+
+    def fetch(self, url: str) -> str:
+        time.sleep(self.delay)
+        self.fetched.append(url)
+        if url in self.error_urls:
+            self.error_urls.remove(url)
+            raise ValueError('oh no')
+        return f'content of {url}'
+
+
+class RecordingStateManager(FakeStateManager):
+    def __init__(self):
+        super().__init__()
+        self.completed = []
+
+    def mark_completed(self, url: str) -> None:
+        self.completed.append(url)
+
+
+def test_invalid_prefetch_depth():
+    with pytest.raises(ValueError, match='negative'):
+        Crawler(FakeFetcher({}), FakeHandler(lambda content, url, callback: None), FakeStateManager(),
+                ThrowingHandler(), prefetch_depth=-1)
+
+
+def test_prefetch_overlaps_fetching_and_handling():
+    urls = ['a', 'b', 'c', 'd']
+    f = SlowFetcher(0.2)
+    processed = []
+
+    def handle(content: str, url: str, callback: Callable[[str, str], None]) -> None:
+        time.sleep(0.2)
+        processed.append(content)
+
+    start = time.time()
+    Crawler(f, FakeHandler(handle), FakeStateManager(), ThrowingHandler(), prefetch_depth=1).crawl(urls)
+    end = time.time()
+
+    assert processed == [f'content of {url}' for url in urls]
+    # Only the first fetch happens on its own.
+    assert end - start < 0.2 + 4 * 0.2 + 0.2
+
+
+def test_prefetch_keeps_order():
+    f = FakeFetcher({'root': 'foo', 'a': 'bar', 'b': 'baz', 'c': 'qux', 'd': 'quux'})
+    processed = []
+
+    def handle(content: str, url: str, callback: Callable[[str, str], None]) -> None:
+        processed.append(f'{url}: {content}')
+        if content == 'foo':
+            callback('', 'a')
+            callback('', 'b')
+        elif content == 'bar':
+            callback('', 'c')
+        elif content == 'baz':
+            callback('', 'd')
+
+    Crawler(f, FakeHandler(handle), FakeStateManager(), ThrowingHandler(), prefetch_depth=2).crawl(['root'])
+
+    assert processed == ['root: foo', 'a: bar', 'b: baz', 'c: qux', 'd: quux']
+
+
+def test_prefetch_respects_crawl_delay():
+    urls = ['a', 'b', 'c', 'd']
+    f = SlowFetcher(0)
+    crawl_delay = datetime.timedelta(seconds=0.1)
+
+    start = time.time()
+    Crawler(f, FakeHandler(lambda content, url, callback: None), FakeStateManager(), ThrowingHandler(),
+            crawl_delay=crawl_delay, prefetch_depth=3).crawl(urls)
+    end = time.time()
+
+    assert f.fetched == urls
+    assert end - start >= 3 * crawl_delay.total_seconds()
+
+
+def test_prefetch_duplicate_is_not_fetched_again():
+    f = SlowFetcher(0.1)
+    m = RecordingStateManager()
+    processed = []
+    h = FakeHandler(lambda content, url, callback: processed.append(url))
+
+    Crawler(f, h, m, ThrowingHandler(), prefetch_depth=2).crawl(['a', 'a', 'b'])
+
+    assert f.fetched == ['a', 'b']
+    assert processed == ['a', 'b']
+    # Every pop is still accounted for.
+    assert sorted(m.completed) == ['a', 'a', 'b']
+
+
+def test_prefetch_duplicate_is_crawled_if_original_failed():
+    f = SlowFetcher(0.1, error_urls={'a'})
+    m = RecordingStateManager()
+    processed = []
+    h = FakeHandler(lambda content, url, callback: processed.append(url))
+
+    Crawler(f, h, m, LoggingHandler(), prefetch_depth=2).crawl(['a', 'a', 'b'])
+
+    assert sorted(f.fetched) == ['a', 'a', 'b']
+    assert sorted(processed) == ['a', 'b']
+    assert m.failed == {'a': 1}
+    assert sorted(m.completed) == ['a', 'b']
+
+
+def test_prefetch_with_several_workers():
+    urls = [f'http://root.com/{i}' for i in range(12)]
+    f = SlowFetcher(0.1)
+    processed = []
+    lock = threading.Lock()
+
+    def handle(content: str, url: str, callback: Callable[[str, str], None]) -> None:
+        time.sleep(0.1)
+        with lock:
+            processed.append(url)
+
+    start = time.time()
+    Crawler(f, FakeHandler(handle), FakeStateManager(), ThrowingHandler(), num_workers=3,
+            prefetch_depth=1).crawl(urls)
+    end = time.time()
+
+    assert sorted(processed) == sorted(urls)
+    assert end - start < 12 * 0.2 / 3
+
+
+def test_prefetch_error_stops_crawl():
+    f = SlowFetcher(0.05, error_urls={'b'})
+
+    with pytest.raises(ValueError, match='oh no'):
+        Crawler(f, FakeHandler(lambda content, url, callback: None), FakeStateManager(), ThrowingHandler(),
+                prefetch_depth=2).crawl(['a', 'b', 'c', 'd'])
+
+
+def test_prefetch_pops_only_pages_that_can_start_soon():
+    urls = [f'http://root.com/{i}' for i in range(8)]
+    m = FakeStateManager()
+    popped = {}
+    pop_next = m.pop_next
+
+    def record_pop() -> str:
+        url = pop_next()
+        popped[url] = time.monotonic()
+        return url
+
+    m.pop_next = record_pop
+    waits = []
+
+    class WaitRecordingFetcher(Fetcher):
+        def fetch(self, url: str) -> str:
+            waits.append(time.monotonic() - popped[url])
+            return 'foo'
+
+    Crawler(WaitRecordingFetcher(), FakeHandler(lambda content, url, callback: None), m, ThrowingHandler(),
+            crawl_delay=datetime.timedelta(seconds=0.05), num_workers=2, prefetch_depth=3,
+            max_wait=datetime.timedelta(seconds=0.1)).crawl(urls)
+
+    assert len(waits) == len(urls)
+    assert max(waits) < 0.2
+
+
+def test_prefetch_does_not_outlast_lease(tmp_path):
+    db_path = tmp_path / 'queue.db'
+    urls = [f'http://root.com/{i}' for i in range(8)]
+    lease = datetime.timedelta(seconds=0.5)
+    setup = SqlStateManager(db_path, lease=lease)
+    setup.enqueue_many(urls)
+    setup.close()
+    fetchers = [RecordingFetcher(), RecordingFetcher()]
+
+    def crawl(f: Fetcher) -> None:
+        m = SqlStateManager(db_path, lease=lease)
+        try:
+            # Without max_wait, each crawler would pop its whole window at once, and the last page would wait
+            # 7 crawl delays for its slot.
+            Crawler(f, FakeHandler(lambda content, url, callback: None), m, ThrowingHandler(),
+                    crawl_delay=datetime.timedelta(seconds=0.2), num_workers=2, prefetch_depth=3,
+                    max_wait=datetime.timedelta(seconds=0.1)).crawl([])
+        finally:
+            m.close()
+
+    with concurrent.futures.ThreadPoolExecutor(2) as executor:
+        for crawled in [executor.submit(crawl, f) for f in fetchers]:
+            crawled.result()
+
+    assert sorted(fetchers[0].fetched + fetchers[1].fetched) == sorted(urls)
+
+class BatchRecordingStateManager(FakeStateManager):
+    def __init__(self):
+        super().__init__()
+        self.batches = []
+
+    def enqueue_many(self, urls: Iterable[str]) -> None:
+        urls = list(urls)
+        self.batches.append(urls)
+        super().enqueue_many(urls)
+
+
+def test_enqueue_links_once_per_page():
+    f = FakeFetcher({'http://root.com/': 'foo', 'http://root.com/a': 'bar', 'http://root.com/b': 'baz'})
+    m = BatchRecordingStateManager()
+
+    def handle(content: str, url: str, callback: Callable[[str, str], None]) -> None:
+        if content == 'foo':
+            callback(url, 'a')
+            callback(url, '/b')
+
+    Crawler(f, FakeHandler(handle), m, ThrowingHandler()).crawl(['http://root.com/'])
+
+    assert m.batches == [['http://root.com/'], ['http://root.com/a', 'http://root.com/b'], [], []]
+
+
+def test_no_links_enqueued_if_handler_fails():
+    f = FakeFetcher({'root': 'foo', 'a': 'bar'})
+    processed = []
+
+    def handle(content: str, url: str, callback: Callable[[str, str], None]) -> None:
+        processed.append(url)
+        callback('', 'a')
+        raise ValueError('oh no')
+
+    Crawler(f, FakeHandler(handle), FakeStateManager(), LoggingHandler()).crawl(['root'])
+
+    assert processed == ['root']
+
+
+def test_canonicalize_discovered_urls(tmp_path):
+    f = RecordingFetcher()
+
+    def handle(content: str, url: str, callback: Callable[[str, str], None]) -> None:
+        if url == 'http://root.com/':
+            callback(url, 'a#top')
+            callback(url, 'a#bottom')
+            callback(url, 'HTTP://ROOT.COM:80/a')
+            callback(url, '/b?id=1&depth=8&depth=8')
+            callback(url, '/b?id=1&depth=8')
+
+    c = Crawler(f, FakeHandler(handle), SqlStateManager(tmp_path / 'queue.db'), ThrowingHandler(),
+                canonicalizer=UrlCanonicalizer(dedupe_query=True))
+    c.crawl(['http://Root.com'])
+
+    assert f.fetched == ['http://root.com/', 'http://root.com/a', 'http://root.com/b?id=1&depth=8']
+    assert c.canonicalization_report.rewritten == 5
+    # The root and /b were each linked in only one other spelling.
+    assert c.canonicalization_report.fetches_saved == 3
+
+
+def test_custom_canonicalizer():
+    f = RecordingFetcher()
+
+    def handle(content: str, url: str, callback: Callable[[str, str], None]) -> None:
+        if url == 'http://root.com/':
+            callback(url, 'a#top')
+
+    c = Crawler(f, FakeHandler(handle), FakeStateManager(), ThrowingHandler(), canonicalizer=IdentityCanonicalizer())
+    c.crawl(['http://root.com/'])
+
+    assert f.fetched == ['http://root.com/', 'http://root.com/a#top']
+    assert c.canonicalization_report.rewritten == 0
+
+
+def test_metrics():
+    f = FakeFetcher({'http://root.com/index': 'foo', 'http://root.com/view/a': 'bar', 'http://root.com/view/b': 'baz'})
+
+    def handle(content: str, url: str, callback: Callable[[str, str], None]) -> None:
+        if content == 'foo':
+            callback(url, 'view/a')
+            callback(url, 'view/b')
+            callback(url, 'view/c')
+        else:
+            with timed('write'):
+                pass
+
+    m = Metrics(lambda url: url.split('/')[3])
+    Crawler(f, FakeHandler(handle), FakeStateManager(), LoggingHandler(), metrics=m).crawl(['http://root.com/index'])
+
+    got = json.loads(m.to_json())
+    assert got['counters'] == {'pages_completed': {'index': 1, 'view': 2}, 'pages_failed': {'view': 1}}
+    assert got['stages']['wait']['view']['count'] == 3
+    assert got['stages']['fetch']['view']['count'] == 3
+    assert got['stages']['handle']['view']['count'] == 2
+    assert got['stages']['write'] == {'view': got['stages']['write']['view']}
+    assert got['stages']['write']['view']['count'] == 2
+    assert got['stages']['state_pop']['']['count'] == 5  # The last finds the queue empty.
+    assert got['stages']['state_mark']['']['count'] == 4
+    assert got['stages']['state_enqueue']['']['count'] == 4  # Once for the roots, then once per page handled.
+
+
+def test_metrics_with_handler_executor():
+    f = FakeFetcher({'http://root.com/index': 'foo'})
+
+    def handle(content: str, url: str, callback: Callable[[str, str], None]) -> None:
+        with timed('write'):
+            pass
+
+    m = Metrics(lambda url: url.split('/')[3])
+    with concurrent.futures.ThreadPoolExecutor(1) as executor:
+        Crawler(f, FakeHandler(handle), FakeStateManager(), ThrowingHandler(), handler_executor=executor,
+                metrics=m).crawl(['http://root.com/index'])
+
+    got = json.loads(m.to_json())
+    assert got['stages']['handle']['index']['count'] == 1
+    assert 'write' not in got['stages']
+
+
+def test_metrics_exported_at_end_of_crawl(tmp_path):
+    path = tmp_path / 'metrics.json'
+    f = FakeFetcher({'root': 'foo'})
+    m = Metrics(export_path=path, export_interval=datetime.timedelta(hours=1))
+
+    Crawler(f, FakeHandler(lambda content, url, callback: None), FakeStateManager(), ThrowingHandler(),
+            metrics=m).crawl(['root'])
+
+    assert json.loads(path.read_text())['counters'] == {'pages_completed': {'': 1}}
+
+
+def test_metrics_exported_if_crawl_fails(tmp_path):
+    path = tmp_path / 'metrics.json'
+    f = FakeFetcher({}, error=ConnectionError('oops'))
+    m = Metrics(export_path=path)
+
+    with pytest.raises(ConnectionError):
+        Crawler(f, FakeHandler(lambda content, url, callback: None), FakeStateManager(), ThrowingHandler(),
+                metrics=m).crawl(['root'])
+
+    assert json.loads(path.read_text())['counters'] == {'pages_failed': {'': 1}}
+
+
+def test_metrics_include_canonicalization():
+    f = RecordingFetcher()
+
+    def handle(content: str, url: str, callback: Callable[[str, str], None]) -> None:
+        if url == 'http://root.com/':
+            callback(url, 'a')
+            callback(url, 'a#top')
+
+    m = Metrics()
+    Crawler(f, FakeHandler(handle), FakeStateManager(), ThrowingHandler(), metrics=m).crawl(['http://root.com/'])
+
+    assert json.loads(m.to_json())['gauges'] == {'canonicalization_fetches_saved': 1}
+
+
+class TryPopOnlyStateManager(FakeStateManager):
+    def is_finished(self) -> bool:
+        raise AssertionError('Should check for URLs and pop them at once')
+
+    def pop_next(self) -> str:
+        raise AssertionError('Should check for URLs and pop them at once')
+
+    def try_pop(self) -> Optional[str]:
+        try:
+            return self.queue.get_nowait()
+        except queue.Empty:
+            return None
+
+
+@pytest.mark.parametrize("num_workers", [1, 3])
+def test_pops_with_try_pop(num_workers):
+    f = FakeFetcher({'root': 'foo', 'a': 'bar', 'b': 'baz'})
+    processed = []
+
+    def handle(content: str, url: str, callback: Callable[[str, str], None]) -> None:
+        processed.append(url)
+        if url == 'root':
+            callback(url, 'a')
+            callback(url, 'b')
+
+    Crawler(f, FakeHandler(handle), TryPopOnlyStateManager(), ThrowingHandler(),
+            num_workers=num_workers).crawl(['root'])
+
+    assert sorted(processed) == ['a', 'b', 'root']
+
+
+class FlushRecordingStateManager(FakeStateManager):
+    def __init__(self):
+        super().__init__()
+        self.flushes = 0
+
+    def flush(self) -> None:
+        self.flushes += 1
+
+
+def test_flush_state_at_end_of_crawl():
+    f = FakeFetcher({'root': 'foo'})
+    m = FlushRecordingStateManager()
+
+    Crawler(f, FakeHandler(lambda content, url, callback: None), m, ThrowingHandler()).crawl(['root'])
+
+    assert m.flushes == 1
+
+
+def test_flush_state_if_crawl_fails():
+    f = FakeFetcher({}, error=ConnectionError('oops'))
+    m = FlushRecordingStateManager()
+
+    with pytest.raises(ConnectionError):
+        Crawler(f, FakeHandler(lambda content, url, callback: None), m, ThrowingHandler(),
+                num_workers=2).crawl(['root'])
+
+    assert m.flushes == 1
+
+
+class RawHandler(Handler):
+    def __init__(self):
+        self.handled = []
+
+    def handle(self, content: str, url: str, enqueue_callback: Callable[[str, str], None]) -> None:
+        raise AssertionError('Should have been handled raw')
+
+    def handle_raw(self, content: RawContent, url: str, enqueue_callback: Callable[[str, str], None]) -> None:
+        self.handled.append((url, content))
+
+
+def test_raw_content():
+    f = FakeFetcher({'root': 'caf\u00e9'})
+    h = RawHandler()
+
+    Crawler(f, h, FakeStateManager(), ThrowingHandler(), raw_content=True).crawl(['root'])
+
+    assert h.handled == [('root', RawContent(b'caf\xc3\xa9', 'utf-8'))]
+
+
+def test_raw_content_decoded_for_handler():
+    f = FakeFetcher({'root': 'caf\u00e9'})
+    processed = []
+    h = FakeHandler(lambda content, url, callback: processed.append(content))
+
+    Crawler(f, h, FakeStateManager(), ThrowingHandler(), raw_content=True,
+            handler_executor=concurrent.futures.ThreadPoolExecutor(1)).crawl(['root'])
+
+    assert processed == ['caf\u00e9']
@@ -2,6 +2,8 @@ import abc
 import logging
 from typing import Callable
 
+from .fetch_error import is_permanent
+
 
 class ErrorHandler(abc.ABC):
     """
@@ -38,11 +40,14 @@ class LoggingHandler(ErrorHandler):
 class RetryingHandler(ErrorHandler):
     """
     Uses callback to add failed URL back to the queue, then delegates to other handler.
+    State managers given a Backoff hold the URL back until it has waited long enough.
+    URLs whose fetch failed permanently, such as with 404 Not Found, are not retried.
     """
 
     def __init__(self, handler: ErrorHandler):
         self.handler = handler
 
     def handle(self, err: Exception, retry_callback: Callable[[], None]) -> None:
-        retry_callback()
+        if not is_permanent(err):
+            retry_callback()
         self.handler.handle(err, retry_callback)
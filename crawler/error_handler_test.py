@@ -1,6 +1,7 @@
 import pytest
 
 from .error_handler import LoggingHandler, ThrowingHandler, RetryingHandler
+from .fetch_error import HttpStatusError
 
 
 def noop_callback():
@@ -27,3 +28,26 @@ def test_retrying(caplog):
 
     assert output == ['bar']
     assert 'foo' in caplog.text
+
+
+def test_retrying_skips_permanent_failures(caplog):
+    output = []
+
+    def callback() -> None:
+        output.append('bar')
+
+    RetryingHandler(LoggingHandler()).handle(HttpStatusError('404 Client Error', 404), callback)
+
+    assert output == []
+    assert '404' in caplog.text
+
+
+def test_retrying_transient_failures():
+    output = []
+
+    def callback() -> None:
+        output.append('bar')
+
+    RetryingHandler(LoggingHandler()).handle(HttpStatusError('503 Server Error', 503), callback)
+
+    assert output == ['bar']
@@ -0,0 +1,75 @@
+import datetime
+import email.utils
+from typing import Optional
+
+# Statuses that mean the server might succeed if asked again later. Anything else is the same every time.
+TRANSIENT_STATUS_CODES = frozenset([408, 425, 429, 500, 502, 503, 504])
+# Longest wait a Retry-After header is taken at. Longer ones are still waited for, but only this long.
+MAX_RETRY_AFTER = datetime.timedelta(days=1)
+
+
+class FetchError(ConnectionError):
+    """
+    Raised by fetchers when a page could not be fetched, saying whether it is worth
+    trying again, and how long the server asked us to wait first. A ConnectionError,
+    so code that only expects those still catches it.
+    """
+
+    def __init__(self, message: str, transient: bool = True, retry_after: Optional[datetime.timedelta] = None):
+        """
+        :param message: What went wrong.
+        :param transient: Whether fetching the page again might work.
+        :param retry_after: How long the server asked us to wait before trying again, if it said.
+        """
+        super().__init__(message)
+        self.transient = transient
+        self.retry_after = retry_after
+
+
+class HttpStatusError(FetchError):
+    """
+    Raised when a server responds with an error status. Server errors and rate
+    limits are transient, but others, such as 404 Not Found, are permanent.
+    """
+
+    def __init__(self, message: str, status_code: int, retry_after: Optional[datetime.timedelta] = None):
+        """
+        :param message: What went wrong.
+        :param status_code: HTTP status of the response.
+        :param retry_after: How long the server asked us to wait before trying again, if it said.
+        """
+        super().__init__(message, status_code in TRANSIENT_STATUS_CODES, retry_after)
+        self.status_code = status_code
+
+
+def is_permanent(err: BaseException) -> bool:
+    """
+    :return: Whether `err` says the fetch will fail however many times it is tried.
+    """
+    return isinstance(err, FetchError) and not err.transient
+
+
+def parse_retry_after(value: Optional[str],
+                      now: Optional[datetime.datetime] = None) -> Optional[datetime.timedelta]:
+    """
+    Parses a Retry-After header, which is either a number of seconds or an HTTP date.
+    :param value: The header, if there was one.
+    :param now: Time to measure dates from. Defaults to the current time.
+    :return: How long to wait, at most MAX_RETRY_AFTER, or None if there was no header or it could not be parsed.
+    """
+    if not value:
+        return None
+    value = value.strip()
+    # HTTP only allows ASCII digits. isdigit() is also true for characters such as '²', which int() rejects.
+    if value.isascii() and value.isdigit():
+        # Compared as a number first, since timedelta overflows on huge values.
+        return datetime.timedelta(seconds=min(int(value), MAX_RETRY_AFTER.total_seconds()))
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError, OverflowError):
+        return None
+    if when.tzinfo is None:
+        # HTTP dates are always in GMT, but obsolete formats may not say so.
+        when = when.replace(tzinfo=datetime.timezone.utc)
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    return min(max(datetime.timedelta(0), when - now), MAX_RETRY_AFTER)
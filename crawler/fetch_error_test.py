@@ -0,0 +1,55 @@
+import datetime
+
+import pytest
+
+from .fetch_error import MAX_RETRY_AFTER, FetchError, HttpStatusError, is_permanent, parse_retry_after
+
+
+def test_fetch_error_is_connection_error():
+    with pytest.raises(ConnectionError, match='oh no'):
+        raise FetchError('oh no')
+
+
+@pytest.mark.parametrize('status_code', [408, 425, 429, 500, 502, 503, 504])
+def test_transient_status(status_code):
+    err = HttpStatusError('oh no', status_code)
+
+    assert err.transient
+    assert not is_permanent(err)
+
+
+@pytest.mark.parametrize('status_code', [400, 401, 403, 404, 410, 501])
+def test_permanent_status(status_code):
+    err = HttpStatusError('oh no', status_code)
+
+    assert not err.transient
+    assert is_permanent(err)
+
+
+def test_other_errors_not_permanent():
+    assert not is_permanent(ValueError('oh no'))
+    assert not is_permanent(ConnectionError('oh no'))
+    assert not is_permanent(FetchError('oh no'))
+    assert is_permanent(FetchError('oh no', transient=False))
+
+
+def test_parse_retry_after_seconds():
+    assert parse_retry_after('120') == datetime.timedelta(seconds=120)
+    assert parse_retry_after(' 5 ') == datetime.timedelta(seconds=5)
+
+
+def test_parse_retry_after_date():
+    now = datetime.datetime(2015, 10, 21, 7, 28, tzinfo=datetime.timezone.utc)
+
+    assert parse_retry_after('Wed, 21 Oct 2015 07:30:00 GMT', now) == datetime.timedelta(minutes=2)
+    assert parse_retry_after('Wed, 21 Oct 2015 07:00:00 GMT', now) == datetime.timedelta(0)
+
+
+@pytest.mark.parametrize('value', [None, '', 'soon', '-5', '1.5', '\u00b2', '\u0663'])
+def test_parse_retry_after_invalid(value):
+    assert parse_retry_after(value) is None
+
+
+@pytest.mark.parametrize('value', ['99999999999999999', '86401', 'Fri, 31 Dec 9999 23:59:59 GMT'])
+def test_parse_retry_after_clamped(value):
+    assert parse_retry_after(value) == MAX_RETRY_AFTER
@@ -1,4 +1,20 @@
 import abc
+from typing import NamedTuple, Optional
+
+
+class RawContent(NamedTuple):
+    """
+    Content of a fetched URL, as it was sent, before being decoded into a string.
+    """
+    content: bytes
+    # Character encoding the source declared for the content, if any, such as the charset in an HTTP Content-Type.
+    encoding: Optional[str]
+
+    def decode(self) -> str:
+        """
+        :return: The content as a string, assuming UTF-8 if no encoding was declared.
+        """
+        return self.content.decode(self.encoding or 'utf-8', errors='replace')
 
 
 class Fetcher(abc.ABC):
@@ -13,3 +29,12 @@ class Fetcher(abc.ABC):
         :return: The raw content of the fetched URL, as a string.
         """
         raise NotImplementedError('Cannot fetch from abstract base class Fetcher')
+
+    def fetch_raw(self, url: str) -> RawContent:
+        """
+        Fetches content without decoding it, for handlers that can decode it more cheaply themselves, such as while
+        parsing it. Defaults to encoding what fetch() returns as UTF-8.
+        :param url: The URL to be fetched.
+        :return: The content of the fetched URL, as bytes, with its declared encoding.
+        """
+        return RawContent(self.fetch(url).encode('utf-8'), 'utf-8')
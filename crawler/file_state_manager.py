@@ -1,14 +1,58 @@
+import bisect
+import copy
+import datetime
+import gzip
+import heapq
+import operator
+import os
 import pathlib
 import queue
-from typing import Dict, Optional, Set
+import time
+from typing import IO, Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple, Union
 
+from .backoff import Backoff, wait_before_retry
+from .fetch_error import is_permanent
 from .state_manager import StateManager
+from .url_codec import FrontCoder, FrontDecoder, front_decode
+from .visited_set import VisitedSet
+
+_strip_newline = operator.methodcaller('rstrip', '\n')
 
 
 class FileStateManager(StateManager):
     """
     Maintains crawl state using in-memory collections, which are also written to
     log files with one URL per line. This allows resuming the crawl if interrupted.
+
+    The queue log keeps every URL ever enqueued, with a counter of how many lines
+    at the start are finished, followed by any other lines that finished out of
+    order. URLs can finish out of order when several are in progress at once, or
+    when a failed URL waits for its backoff while later ones are popped, so only
+    lines that are not finished are queued again on restart. Compacting rewrites
+    the queue log to only the unfinished URLs, so that it grows with the queue
+    rather than the whole crawl. It can also move the visited log into a sorted,
+    compressed snapshot.
+
+    Visited URLs are kept in a set, unless a more compact VisitedSet is given. If
+    that set is persistent, the visited log is only appended to, not read back.
+
+    Logs can be front-coded, writing each URL as how much it shares with the URL
+    on the line before, and the rest of it. Links found on the same page share
+    most of their characters, so this makes the logs several times smaller. Logs
+    written without front coding can be resumed with it, but not the other way
+    round.
+
+    With a window size, only that many queued URLs are held in memory, and the
+    rest are read from the queue log as they are needed, so memory does not grow
+    with the queue. Enqueued URLs are then deduplicated against a set of every URL
+    ever enqueued, which can be a compact VisitedSet too. Only FIFO queues can be
+    paged like this, since the log is in the order URLs were enqueued.
+
+    Given a Backoff, a URL that fails and is enqueued again waits outside the queue
+    until its backoff has passed. Backoffs are only kept in memory, so URLs that
+    are waiting when the crawl is restarted can be popped straight away. Failures
+    the fetcher says are permanent are not retried, and waits the server asks for
+    are kept to, with or without a Backoff.
     """
 
     def __init__(self,
@@ -16,98 +60,427 @@ class FileStateManager(StateManager):
                  visited_path: pathlib.Path,
                  queue_path: pathlib.Path,
                  queue_counter_path: pathlib.Path,
-                 max_failures_per_url: int = 3):
-        self._visited: Set[str] = set()
+                 max_failures_per_url: int = 3,
+                 compact_after: int = 0,
+                 visited_snapshot_path: Optional[pathlib.Path] = None,
+                 visited_set: Optional[VisitedSet] = None,
+                 front_coding: bool = False,
+                 window_size: int = 0,
+                 seen_set: Optional[VisitedSet] = None,
+                 backoff: Optional[Backoff] = None):
+        """
+        :param queue_type: Type of queue to hold URLs in memory, which decides the order they are popped in.
+        :param visited_path: Log of URLs that have been crawled.
+        :param queue_path: Log of URLs that have been enqueued.
+        :param queue_counter_path: Which lines of the queue log are finished: how many at the start, then the
+            numbers of any others, one per line.
+        :param max_failures_per_url: How many times to try crawling a URL before giving up on it.
+        :param compact_after: Compact once this many lines of the queue log are finished. 0 only compacts when
+            compact() is called.
+        :param visited_snapshot_path: Where to keep a snapshot of the visited log when compacting. If not given,
+            the visited log is left alone.
+        :param visited_set: Where to remember visited URLs. Defaults to a set of every URL, kept in memory.
+        :param front_coding: Whether to front-code the logs. Once enabled, it must stay enabled for the same logs.
+        :param window_size: Most queued URLs to hold in memory. 0 holds the whole queue in memory.
+        :param seen_set: With a window size, where to remember URLs that have been enqueued. Defaults to a set of
+            every URL, kept in memory. If not persistent, it is rebuilt from the queue log on restart.
+        :param backoff: How long to wait before popping a URL again after it fails. Defaults to not waiting.
+        """
+        if compact_after < 0:
+            raise ValueError(f'Cannot compact after a negative number of URLs, got {compact_after}')
+        if visited_set is not None and visited_snapshot_path is not None:
+            raise ValueError('Cannot snapshot a custom visited set')
+        if window_size < 0:
+            raise ValueError(f'Window size cannot be negative, got {window_size}')
+        if window_size and issubclass(queue_type, (queue.LifoQueue, queue.PriorityQueue)):
+            raise ValueError('Only FIFO queues can be paged from the queue log')
+        if seen_set is not None and not window_size:
+            raise ValueError('Seen set is only used with a window size')
+        self._queue_path = queue_path
+        self._visited_path = visited_path
+        self._visited_snapshot_path = visited_snapshot_path
+        self._compact_after = compact_after
+        self._visited: Union[Set[str], VisitedSet] = set() if visited_set is None else visited_set
         self._queue = queue_type()
+        # Same URLs as the queue, so we can check whether a URL is queued without scanning it.
+        self._queued: Set[str] = set()
+        # How many lines at the start of the queue log are finished, and which lines after those are.
         self._queue_counter: int = 0
-        self._in_progress: Optional[str] = None
+        self._finished_lines: Set[int] = set()
+        # How many lines are in the queue log, and which line each queued or in progress URL was read from.
+        self._lines = 0
+        self._line_of: Dict[str, int] = {}
+        self._in_progress: Set[str] = set()
         self._failed: Dict[str, int] = {}
         self._max_failures_per_url = max_failures_per_url
+        self._front_coding = front_coding
+        # Logs are appended to in separate sequences, so each needs its own coder.
+        self._queue_coder = FrontCoder()
+        self._visited_coder = FrontCoder()
+        self._window_size = window_size
+        # URLs ever enqueued, and failed URLs that have been enqueued again since, when paging the queue.
+        self._seen: Union[Set[str], VisitedSet] = set() if seen_set is None else seen_set
+        self._retried: Set[str] = set()
+        # Where the next URL to page in is in the queue log, how many lines are before it, and how many unfinished
+        # lines are after it.
+        self._queue_reader: Optional[IO[bytes]] = None
+        self._queue_decoder = FrontDecoder()
+        self._read = 0
+        self._unread = 0
+        self._backoff = backoff
+        # When failed URLs may be popped again, and a heap of those that have been enqueued again and are waiting.
+        self._not_before: Dict[str, float] = {}
+        self._waiting: List[Tuple[float, str]] = []
+
+        if visited_snapshot_path is not None and visited_snapshot_path.exists():
+            with gzip.open(visited_snapshot_path, 'rt') as f:
+                self._visited.update(self._urls(f))
 
         try:
-            self._visited_file = open(visited_path, 'r+')
-            self._visited.update(set(self._visited_file.read().splitlines()))
+            if visited_set is not None and visited_set.persistent:
+                self._visited_file = open(visited_path, 'a')
+            else:
+                self._visited_file = open(visited_path, 'r+')
+                self._visited.update(self._urls(self._visited_file))
         except FileNotFoundError:
             print(f'No existing checkpoint file at {visited_path}')
             self._visited_file = open(visited_path, 'a')  # Only ever visit more pages
 
         try:
             self._queue_counter_file = open(queue_counter_path, 'r+')
-            self._queue_counter = int(self._queue_counter_file.read())
+            counter, *finished_lines = map(int, self._queue_counter_file.read().split())
+            self._queue_counter = counter
+            for line in finished_lines:
+                self._finish_line(line)
         except (FileNotFoundError, ValueError):
             print(f'No valid existing queue counter file at {visited_path}')
             self._queue_counter_file = open(queue_counter_path, 'w')  # Only ever visit more pages
-            self._queue_counter_file.write(str(self._queue_counter))
-            self._queue_counter_file.flush()
 
+        if window_size:
+            self._restore_window()
+        else:
+            self._restore_queue()
+        # Lines that finished out of order may have been appended, so start from a tidy file.
+        self._write_counter()
+
+    def _restore_queue(self) -> None:
+        """
+        Puts every URL from the queue log that is not finished back on the queue.
+        """
         try:
-            self._queue_file = open(queue_path, 'r+')
-            queue_lines = self._queue_file.read().splitlines()[self._queue_counter:]
-            self._in_progress = next(iter(queue_lines), None)
-            for url in queue_lines:
-                self._queue.put(url)
+            self._queue_file = open(self._queue_path, 'r+')
         except FileNotFoundError:
-            print(f'No existing queue file at {queue_path}')
-            self._queue_file = open(queue_path, 'w')
+            print(f'No existing queue file at {self._queue_path}')
+            self._queue_file = open(self._queue_path, 'w')
+            return
+        for line, url in enumerate(self._urls(self._queue_file)):
+            self._lines += 1
+            if line < self._queue_counter or line in self._finished_lines:
+                continue
+            # Visited URLs can only be here if we crashed while compacting, after resetting the counter. So can
+            # a URL that failed, and then was enqueued again.
+            if url in self._visited or url in self._queued:
+                self._finish_line(line)
+                continue
+            if not self._queued:
+                self._in_progress.add(url)
+            self._queue.put_nowait(url)
+            self._queued.add(url)
+            self._line_of[url] = line
+
+    def _restore_window(self) -> None:
+        """
+        Positions the queue reader after the finished URLs, and fills the window from there.
+        """
+        self._queue_file = open(self._queue_path, 'a')
+        rebuild_seen = not (isinstance(self._seen, VisitedSet) and self._seen.persistent)
+        self._open_queue_reader(self._queue_counter, rebuild_seen)
+        # Count what is left, without moving the reader. Lines that finished out of order are passed over when
+        # they are read, so they are not left to read.
+        self._lines = self._read
+        with open(self._queue_path, 'rb') as f:
+            f.seek(self._queue_reader.tell())
+            decoder = copy.copy(self._queue_decoder)
+            for line in f:
+                if self._lines not in self._finished_lines:
+                    self._unread += 1
+                self._lines += 1
+                if rebuild_seen:
+                    self._seen.add(self._decode(decoder, line))
+        self._fill_window()
+        if self._queue.qsize():
+            self._in_progress.add(self._queue.queue[0])
 
-    def _update_counter(self):
-        self._queue_counter += 1
+    def _open_queue_reader(self, skip: int, rebuild_seen: bool = False) -> None:
+        """
+        Opens the queue log for paging, after its first `skip` URLs.
+        """
+        if self._queue_reader is not None:
+            self._queue_reader.close()
+        self._queue_reader = open(self._queue_path, 'rb')
+        self._queue_decoder = FrontDecoder()
+        self._read = 0
+        for _ in range(skip):
+            url = self._read_queue_url()
+            if url is None:
+                return
+            if rebuild_seen:
+                self._seen.add(url)
+
+    def _decode(self, decoder: FrontDecoder, line: bytes) -> str:
+        url = _strip_newline(line.decode())
+        return decoder.decode(url) if self._front_coding else url
+
+    def _read_queue_url(self) -> Optional[str]:
+        line = self._queue_reader.readline()
+        if not line:
+            return None
+        self._read += 1
+        return self._decode(self._queue_decoder, line)
+
+    def _fill_window(self) -> None:
+        while self._queue.qsize() < self._window_size and self._unread:
+            url = self._read_queue_url()
+            if url is None:
+                # Nothing is left to read, whatever the count says.
+                self._unread = 0
+                return
+            line = self._read - 1
+            if line in self._finished_lines:
+                continue
+            self._unread -= 1
+            # Visited URLs can only be here if we crashed while compacting, after resetting the counter.
+            if (url in self._visited or url in self._in_progress
+                    or self._failed.get(url, 0) >= self._max_failures_per_url):
+                self._finish_line(line)
+                continue
+            self._line_of[url] = line
+            self._schedule(url)
+
+    def _schedule(self, url: str) -> None:
+        """
+        Puts `url` on the queue, unless it is waiting to be retried.
+        """
+        not_before = self._not_before.pop(url, None)
+        if not_before is not None and not_before > time.monotonic():
+            heapq.heappush(self._waiting, (not_before, url))
+        else:
+            self._queue.put(url)
+
+    def _release_waiting(self) -> None:
+        now = time.monotonic()
+        while self._waiting and self._waiting[0][0] <= now:
+            self._queue.put(heapq.heappop(self._waiting)[1])
+
+    def _urls(self, f: IO[str]) -> Iterator[str]:
+        """
+        Reads a log one line at a time, so that we never hold more than one copy of it in memory.
+        """
+        lines = map(_strip_newline, f)
+        return front_decode(lines) if self._front_coding else lines
+
+    def _line(self, coder: FrontCoder, url: str) -> str:
+        if self._front_coding:
+            return f'{coder.encode(url)}\n'
+        return f'{url}\n'
+
+    def _write_counter(self) -> None:
         self._queue_counter_file.seek(0)
-        self._queue_counter_file.write(str(self._queue_counter))
+        self._queue_counter_file.write('\n'.join(map(str, [self._queue_counter, *sorted(self._finished_lines)])))
         self._queue_counter_file.truncate()
         self._queue_counter_file.flush()
 
+    def _finish_line(self, line: int) -> None:
+        """
+        Marks a line of the queue log finished in memory, moving the counter past any finished lines at the start.
+        """
+        self._finished_lines.add(line)
+        while self._queue_counter in self._finished_lines:
+            self._finished_lines.remove(self._queue_counter)
+            self._queue_counter += 1
+
+    def _update_counter(self, line: int) -> None:
+        self._finish_line(line)
+        if self._finished_lines:
+            # Lines finishing out of order are appended, which costs the same however many there are. The
+            # counter at the start of the file falls behind, but catches up when the file is read back.
+            self._queue_counter_file.write(f'\n{line}')
+            self._queue_counter_file.flush()
+        else:
+            self._write_counter()
+        if self._compact_after and self._queue_counter + len(self._finished_lines) >= self._compact_after:
+            self.compact()
+
+    def _replace(self, path: pathlib.Path, urls: Iterable[str], open_fn: Callable[..., IO[str]] = open) -> None:
+        """
+        Atomically replaces the file at `path` with one URL per line.
+        """
+        temp_path = path.with_name(f'{path.name}.tmp')
+        coder = FrontCoder()
+        with open_fn(temp_path, 'wt') as f:
+            f.writelines(self._line(coder, url) for url in urls)
+        # Make sure the contents are on disk before the rename is, or a crash could leave an empty file.
+        with open(temp_path, 'rb') as f:
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+
+    def compact(self) -> None:
+        """
+        Rewrites the queue log to only hold URLs that are not finished, and resets the
+        counter. If there is a visited snapshot, the visited log is moved into it. Files
+        are replaced atomically, so nothing is lost if we crash part way through.
+        """
+        self._queue_file.flush()
+        finished, finished_lines = self._queue_counter, self._finished_lines
+        # Reset the counter before replacing the log. If we crash in between, the whole old log is
+        # restored, but URLs that were visited are skipped. Only URLs that failed are tried again.
+        self._queue_counter, self._finished_lines = 0, set()
+        self._write_counter()
+        with open(self._queue_path) as f:
+            unfinished = (url for line, url in enumerate(self._urls(f))
+                          if line >= finished and line not in finished_lines)
+            self._replace(self._queue_path, unfinished)
+        self._queue_file.close()
+        self._queue_file = open(self._queue_path, 'a')
+        # Starting afresh is always correct, even though the new log's last URL is not known here.
+        self._queue_coder.reset()
+
+        # Lines move up by however many finished lines were before them.
+        skipped = sorted(finished_lines)
+
+        def kept_before(line: int) -> int:
+            return line - finished - bisect.bisect_left(skipped, line)
+
+        self._line_of = {url: kept_before(line) for url, line in self._line_of.items()}
+        self._lines = kept_before(self._lines)
+        if self._window_size:
+            # The finished URLs that were read are gone, but the rest that were read are still there.
+            self._open_queue_reader(kept_before(self._read))
+
+        if self._visited_snapshot_path is None:
+            return
+        self._replace(self._visited_snapshot_path, sorted(self._visited), gzip.open)
+        # Everything in the log is in the snapshot now. If we crash before truncating it, loading URLs twice
+        # does no harm.
+        self._visited_file.close()
+        self._visited_file = open(self._visited_path, 'w')
+        self._visited_coder.reset()
+
     def is_finished(self) -> bool:
-        return self._queue.qsize() == 0
+        # Unread lines may all be finished already.
+        self._fill_window()
+        return self._queue.qsize() == 0 and not self._unread and not self._waiting
 
-    def enqueue(self, url: str) -> None:
+    def retry_delay(self) -> Optional[datetime.timedelta]:
+        if not self._waiting:
+            return None
+        return datetime.timedelta(seconds=max(0.0, self._waiting[0][0] - time.monotonic()))
+
+    def _put(self, url: str) -> None:
+        self._schedule(url)
+        self._queued.add(url)
+
+    def _should_enqueue(self, url: str) -> bool:
         if url in self._visited:
-            return
-        if url == self._in_progress:
-            return
-        if url in self._queue.queue:
-            return
+            return False
+        if url in self._in_progress:
+            return False
+        if url in self._queued:
+            return False
         if self._failed.get(url, 0) >= self._max_failures_per_url:
+            return False
+        if self._window_size:
+            if url in self._failed:
+                return url not in self._retried
+            return url not in self._seen
+        return True
+
+    def enqueue(self, url: str) -> None:
+        self.enqueue_many([url])
+
+    def enqueue_many(self, urls: Iterable[str]) -> None:
+        lines = []
+        for url in urls:
+            if not self._should_enqueue(url):
+                continue
+            if self._window_size:
+                # Paged in from the log when there is room in the window.
+                self._seen.add(url)
+                if url in self._failed:
+                    self._retried.add(url)
+                self._unread += 1
+            else:
+                self._line_of[url] = self._lines
+                self._put(url)
+            self._lines += 1
+            lines.append(self._line(self._queue_coder, url))
+        if not lines:
             return
-        self._queue.put(url)
-        self._queue_file.write(f'{url}\n')
+        # One write, so we only flush once.
+        self._queue_file.write(''.join(lines))
         self._queue_file.flush()
 
-    def pop_next(self) -> str:
+    def try_pop(self) -> Optional[str]:
+        self._release_waiting()
+        self._fill_window()
         try:
             url = self._queue.get_nowait()
-            self._in_progress = url
-            return url
         except queue.Empty:
+            return None
+        self._queued.discard(url)
+        self._retried.discard(url)
+        self._in_progress.add(url)
+        return url
+
+    def pop_next(self) -> str:
+        url = self.try_pop()
+        if url is None:
             raise IndexError('Cannot pop from empty queue')
+        return url
 
-    def mark_failed(self, url) -> None:
-        if url != self._in_progress:
+    def mark_failed(self, url: str, error: Optional[Exception] = None) -> None:
+        if url not in self._in_progress:
             return
 
-        self._in_progress = None
-        self._failed[url] = self._failed.get(url, 0) + 1
-        self._update_counter()
+        self._in_progress.remove(url)
+        failures = self._failed.get(url, 0) + 1
+        if is_permanent(error):
+            # Permanent failures use up every attempt at once.
+            failures = max(failures, self._max_failures_per_url)
+        self._failed[url] = failures
+        wait = wait_before_retry(self._backoff, failures, error)
+        if wait is not None and failures < self._max_failures_per_url:
+            self._not_before[url] = time.monotonic() + wait.total_seconds()
+        self._finish(url)
+
+    def flush(self) -> None:
+        if isinstance(self._visited, VisitedSet):
+            self._visited.flush()
+        if isinstance(self._seen, VisitedSet):
+            self._seen.flush()
 
     def mark_completed(self, url: str) -> None:
-        if url != self._in_progress:
+        if url not in self._in_progress:
             return
 
         # We know we're finished with it. We do this here, and not
         # on popping, since otherwise a page can re-enqueue itself while
         # it is not on the queue, but before it has been marked visited.
         # Duplicate effort is bad.
-        self._in_progress = None
+        self._in_progress.remove(url)
 
         # Make sure we don't visit completed URL again.
         self._visited.add(url)
-        self._visited_file.write(f'{url}\n')
+        self._visited_file.write(self._line(self._visited_coder, url))
         self._visited_file.flush()
 
         # Update queue log with the current state of the queue.
         # We only want to do this when a URL is done, since if we
         # abort while it is in progress, we'll want to do it again.
-        # And since we can't guarantee `url` was even in the queue
-        # (though it should be), it's safer and faster to just dump
-        # the whole state, rather than try to find the entry to remove.
-        self._update_counter()
+        self._finish(url)
+
+    def _finish(self, url: str) -> None:
+        # The first URL restored can be marked before it is popped, and then again after.
+        line = self._line_of.pop(url, None)
+        if line is not None:
+            self._update_counter(line)
@@ -0,0 +1,85 @@
+"""
+Measures how long FileStateManager takes to resume from large logs, and how much
+memory it needs to do so.
+
+Each log size is loaded in a fresh process, so that peak RSS only reflects the
+resume. Half of the URLs in each generated log are finished and visited, and
+the rest are still queued.
+
+Usage:
+  python -m crawler.file_state_manager_benchmark --sizes=1000000,10000000,50000000 --work_dir=/tmp/bench
+"""
+import os
+import pathlib
+import queue
+import subprocess
+import sys
+import tempfile
+import time
+
+from absl import app
+from absl import flags
+
+from crawler.file_state_manager import FileStateManager
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_list('sizes', ['1000000', '10000000', '50000000'], 'Numbers of URLs in the logs to resume from.')
+flags.DEFINE_string('work_dir', '', 'Directory to write logs under. Defaults to a temporary directory. Logs that are '
+                    'already there are reused.')
+flags.DEFINE_string('load', '', 'Internal: resume from the logs in this directory, and print how long it took.')
+
+
+def _url(i: int) -> str:
+    return f'https://www.europotato.org/varieties/view/{i:010d}-E'
+
+
+def _write_logs(directory: pathlib.Path, size: int) -> None:
+    if (directory / 'counter.log').exists():
+        return
+    directory.mkdir(parents=True, exist_ok=True)
+    finished = size // 2
+    with open(directory / 'queue.log', 'w') as f:
+        f.writelines(f'{_url(i)}\n' for i in range(size))
+    with open(directory / 'visited.log', 'w') as f:
+        f.writelines(f'{_url(i)}\n' for i in range(finished))
+    # Written last, so that an interrupted run isn't mistaken for a complete one.
+    (directory / 'counter.log').write_text(str(finished))
+
+
+def _load(directory: pathlib.Path) -> None:
+    start = time.perf_counter()
+    FileStateManager(queue.Queue, directory / 'visited.log', directory / 'queue.log', directory / 'counter.log')
+    print(time.perf_counter() - start)
+
+
+def _benchmark(directory: pathlib.Path) -> None:
+    child = subprocess.Popen([sys.executable, '-m', 'crawler.file_state_manager_benchmark', f'--load={directory}'],
+                             stdout=subprocess.PIPE, text=True)
+    output = child.stdout.read()
+    _, status, usage = os.wait4(child.pid, 0)
+    child.returncode = os.waitstatus_to_exitcode(status)
+    if child.returncode:
+        raise RuntimeError(f'Resuming from {directory} failed with exit code {child.returncode}')
+    seconds = float(output.splitlines()[-1])
+    log_bytes = sum((directory / name).stat().st_size for name in ['queue.log', 'visited.log'])
+    peak_rss = usage.ru_maxrss * 2 ** 10  # Reported in kilobytes on Linux.
+    print(f'{directory.name:>12} {log_bytes / 2 ** 20:>10.0f} MiB {seconds:>10.2f} s {peak_rss / 2 ** 20:>10.0f} MiB')
+
+
+def main(argv):
+    if FLAGS.load:
+        _load(pathlib.Path(FLAGS.load))
+        return
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        work_dir = pathlib.Path(FLAGS.work_dir or temp_dir)
+        print(f'{"URLs":>12} {"Logs":>14} {"Resume":>12} {"Peak RSS":>14}')
+        for size in FLAGS.sizes:
+            directory = work_dir / size
+            _write_logs(directory, int(size))
+            _benchmark(directory)
+
+
+if __name__ == '__main__':
+    app.run(main)
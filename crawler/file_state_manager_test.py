@@ -1,8 +1,17 @@
+import collections
+import datetime
+import gzip
 import queue
+import random
+import time
+from unittest import mock
 
 import pytest
 
+from .backoff import Backoff
+from .fetch_error import HttpStatusError
 from .file_state_manager import FileStateManager
+from .visited_set import BloomFilter
 
 
 def test_bad_visited_path(tmp_path):
@@ -251,3 +260,732 @@ def test_restore_queue_log_with_counter(tmp_path):
     m = FileStateManager(queue.Queue, tmp_path / "visited.log", queue_path, counter_path)
 
     assert m.pop_next() == 'b'
+
+
+def test_several_pages_in_progress(tmp_path):
+    visited_path = tmp_path / "visited.log"
+    queue_path = tmp_path / "queue.log"
+    counter_path = tmp_path / "counter.log"
+    m = FileStateManager(queue.Queue, visited_path, queue_path, counter_path)
+    m.enqueue('a')
+    m.enqueue('b')
+    assert m.pop_next() == 'a'
+    assert m.pop_next() == 'b'
+
+    m.enqueue('a')
+    m.enqueue('b')
+    m.mark_completed('b')
+    m.mark_completed('a')
+
+    m2 = FileStateManager(queue.Queue, visited_path, queue_path, counter_path)
+    with pytest.raises(IndexError, match="empty queue"):
+        m2.pop_next()
+
+
+def test_enqueue_many_and_pop(tmp_path):
+    m = FileStateManager(queue.Queue, tmp_path / "visited.log", tmp_path / "queue.log", tmp_path / "counter.log")
+    m.enqueue_many(['a', 'b', 'c'])
+
+    assert m.pop_next() == 'a'
+    assert m.pop_next() == 'b'
+    assert m.pop_next() == 'c'
+
+
+def test_enqueue_many_skips_known_urls(tmp_path):
+    visited_path = tmp_path / "visited.log"
+    queue_path = tmp_path / "queue.log"
+    counter_path = tmp_path / "counter.log"
+    m = FileStateManager(queue.Queue, visited_path, queue_path, counter_path)
+    m.enqueue_many(['a', 'b', 'c'])
+    m.pop_next()
+    m.mark_completed('a')
+    m.pop_next()
+
+    m.enqueue_many(['a', 'b', 'c', 'd', 'd'])
+
+    m2 = FileStateManager(queue.Queue, visited_path, queue_path, counter_path)
+    assert m2.pop_next() == 'b'
+    assert m2.pop_next() == 'c'
+    assert m2.pop_next() == 'd'
+    with pytest.raises(IndexError, match="empty queue"):
+        m2.pop_next()
+
+
+def test_enqueue_many_writes_once(tmp_path):
+    queue_path = tmp_path / "queue.log"
+    m = FileStateManager(queue.Queue, tmp_path / "visited.log", queue_path, tmp_path / "counter.log")
+    writes = []
+    write = m._queue_file.write
+    m._queue_file = mock.Mock(wraps=m._queue_file, write=lambda s: writes.append(s) or write(s))
+
+    m.enqueue_many(['a', 'b', 'c'])
+
+    assert writes == ['a\nb\nc\n']
+    assert queue_path.read_text() == 'a\nb\nc\n'
+
+
+def test_try_pop(tmp_path):
+    m = FileStateManager(queue.Queue, tmp_path / "visited.log", tmp_path / "queue.log", tmp_path / "counter.log")
+    m.enqueue_many(['a', 'b'])
+
+    assert m.try_pop() == 'a'
+    assert m.try_pop() == 'b'
+    assert m.try_pop() is None
+
+
+def test_try_pop_claims_url(tmp_path):
+    m = FileStateManager(queue.Queue, tmp_path / "visited.log", tmp_path / "queue.log", tmp_path / "counter.log")
+    m.enqueue('a')
+    m.try_pop()
+
+    m.enqueue('a')
+
+    assert m.try_pop() is None
+
+
+class UnscannableDeque(collections.deque):
+    def __contains__(self, item):
+        raise AssertionError('Should not scan the queue')
+
+
+def test_enqueue_does_not_scan_queue(tmp_path):
+    m = FileStateManager(queue.Queue, tmp_path / "visited.log", tmp_path / "queue.log", tmp_path / "counter.log")
+    m._queue.queue = UnscannableDeque()
+    m.enqueue_many(['a', 'b'])
+
+    m.enqueue_many(['a', 'b', 'c'])
+
+    assert [m.pop_next() for _ in range(3)] == ['a', 'b', 'c']
+    assert m.is_finished()
+
+
+@pytest.mark.parametrize("queue_type", [queue.Queue, queue.LifoQueue, queue.PriorityQueue])
+def test_enqueue_skips_queued_urls(tmp_path, queue_type):
+    m = FileStateManager(queue_type, tmp_path / "visited.log", tmp_path / "queue.log", tmp_path / "counter.log")
+    m.enqueue_many(['b', 'a', 'b'])
+    m.enqueue('a')
+
+    popped = [m.pop_next(), m.pop_next()]
+
+    assert sorted(popped) == ['a', 'b']
+    assert m.is_finished()
+
+
+def test_can_enqueue_again_after_pop_and_failure(tmp_path):
+    m = FileStateManager(queue.Queue, tmp_path / "visited.log", tmp_path / "queue.log", tmp_path / "counter.log")
+    m.enqueue('a')
+    m.pop_next()
+    m.mark_failed('a')
+
+    m.enqueue('a')
+    m.enqueue('a')
+
+    assert m.pop_next() == 'a'
+    assert m.is_finished()
+
+
+def test_restored_queue_skips_queued_urls(tmp_path):
+    visited_path = tmp_path / "visited.log"
+    queue_path = tmp_path / "queue.log"
+    counter_path = tmp_path / "counter.log"
+    FileStateManager(queue.Queue, visited_path, queue_path, counter_path).enqueue_many(['a', 'b'])
+
+    m = FileStateManager(queue.Queue, visited_path, queue_path, counter_path)
+    m.enqueue('b')
+
+    assert queue_path.read_text() == 'a\nb\n'
+
+
+def test_invalid_compact_after(tmp_path):
+    with pytest.raises(ValueError, match='negative'):
+        FileStateManager(queue.Queue, tmp_path / "visited.log", tmp_path / "queue.log", tmp_path / "counter.log",
+                         compact_after=-1)
+
+
+def test_compact_keeps_pending_urls(tmp_path):
+    visited_path = tmp_path / "visited.log"
+    queue_path = tmp_path / "queue.log"
+    counter_path = tmp_path / "counter.log"
+    m = FileStateManager(queue.Queue, visited_path, queue_path, counter_path)
+    m.enqueue_many(['a', 'b', 'c', 'd'])
+    m.pop_next()
+    m.mark_completed('a')
+    m.pop_next()
+    m.mark_failed('b')
+    m.pop_next()
+
+    m.compact()
+
+    assert queue_path.read_text() == 'c\nd\n'
+    assert counter_path.read_text() == '0'
+    assert sorted(path.name for path in tmp_path.iterdir()) == ['counter.log', 'queue.log', 'visited.log']
+    m2 = FileStateManager(queue.Queue, visited_path, queue_path, counter_path)
+    assert m2.pop_next() == 'c'
+    assert m2.pop_next() == 'd'
+    assert m2.is_finished()
+
+
+def test_enqueue_and_mark_after_compact(tmp_path):
+    visited_path = tmp_path / "visited.log"
+    queue_path = tmp_path / "queue.log"
+    counter_path = tmp_path / "counter.log"
+    m = FileStateManager(queue.Queue, visited_path, queue_path, counter_path)
+    m.enqueue_many(['a', 'b'])
+    m.pop_next()
+    m.mark_completed('a')
+    m.compact()
+
+    m.enqueue('c')
+    m.pop_next()
+    m.mark_completed('b')
+
+    assert queue_path.read_text() == 'b\nc\n'
+    m2 = FileStateManager(queue.Queue, visited_path, queue_path, counter_path)
+    assert m2.pop_next() == 'c'
+    assert m2.is_finished()
+
+
+def test_compact_automatically(tmp_path):
+    queue_path = tmp_path / "queue.log"
+    counter_path = tmp_path / "counter.log"
+    m = FileStateManager(queue.Queue, tmp_path / "visited.log", queue_path, counter_path, compact_after=2)
+    m.enqueue_many(['a', 'b', 'c'])
+    m.pop_next()
+    m.mark_completed('a')
+    assert queue_path.read_text() == 'a\nb\nc\n'
+
+    m.pop_next()
+    m.mark_completed('b')
+
+    assert queue_path.read_text() == 'c\n'
+    assert counter_path.read_text() == '0'
+
+
+def test_compact_visited_snapshot(tmp_path):
+    visited_path = tmp_path / "visited.log"
+    queue_path = tmp_path / "queue.log"
+    counter_path = tmp_path / "counter.log"
+    snapshot_path = tmp_path / "visited.gz"
+    m = FileStateManager(queue.Queue, visited_path, queue_path, counter_path, visited_snapshot_path=snapshot_path)
+    m.enqueue_many(['b', 'a', 'c'])
+    for _ in range(2):
+        m.mark_completed(m.pop_next())
+
+    m.compact()
+    m.mark_completed(m.pop_next())
+
+    assert gzip.decompress(snapshot_path.read_bytes()) == b'a\nb\n'
+    assert visited_path.read_text() == 'c\n'
+    m2 = FileStateManager(queue.Queue, visited_path, queue_path, counter_path, visited_snapshot_path=snapshot_path)
+    m2.enqueue_many(['a', 'b', 'c', 'd'])
+    assert m2.pop_next() == 'd'
+    assert m2.is_finished()
+
+
+def test_compact_without_visited_snapshot_keeps_visited_log(tmp_path):
+    visited_path = tmp_path / "visited.log"
+    m = FileStateManager(queue.Queue, visited_path, tmp_path / "queue.log", tmp_path / "counter.log")
+    m.enqueue('a')
+    m.mark_completed(m.pop_next())
+
+    m.compact()
+
+    assert visited_path.read_text() == 'a\n'
+
+
+def test_restore_after_crash_while_compacting(tmp_path):
+    # The counter was reset, but the queue log was not replaced yet.
+    visited_path = tmp_path / "visited.log"
+    visited_path.write_text('a\n')
+    queue_path = tmp_path / "queue.log"
+    queue_path.write_text('a\nb\nc\n')
+    counter_path = tmp_path / "counter.log"
+    counter_path.write_text('0')
+
+    m = FileStateManager(queue.Queue, visited_path, queue_path, counter_path)
+
+    assert m.pop_next() == 'b'
+    assert m.pop_next() == 'c'
+    assert m.is_finished()
+
+
+@pytest.mark.parametrize(["queue_type", "expected"], [
+    (queue.Queue, ['b', 'c', 'a']),
+    (queue.LifoQueue, ['a', 'c', 'b']),
+    (queue.PriorityQueue, ['a', 'b', 'c']),
+])
+def test_restore_queue_log_in_queue_order(tmp_path, queue_type, expected):
+    queue_path = tmp_path / "queue.log"
+    queue_path.write_text('b\nc\na\n')
+
+    m = FileStateManager(queue_type, tmp_path / "visited.log", queue_path, tmp_path / "counter.log")
+
+    assert [m.pop_next() for _ in range(3)] == expected
+    assert m.is_finished()
+
+
+def test_restore_logs_without_trailing_newline(tmp_path):
+    visited_path = tmp_path / "visited.log"
+    visited_path.write_text('a\nb')
+    queue_path = tmp_path / "queue.log"
+    queue_path.write_text('a\nb\nc')
+    counter_path = tmp_path / "counter.log"
+    counter_path.write_text('2')
+
+    m = FileStateManager(queue.Queue, visited_path, queue_path, counter_path)
+    m.enqueue_many(['a', 'b'])
+
+    assert m.pop_next() == 'c'
+    assert m.is_finished()
+
+
+def test_visited_set(tmp_path):
+    visited = BloomFilter(1000)
+    m = FileStateManager(queue.Queue, tmp_path / "visited.log", tmp_path / "queue.log", tmp_path / "counter.log",
+                         visited_set=visited)
+    m.enqueue('a')
+    m.mark_completed(m.pop_next())
+
+    m.enqueue_many(['a', 'b'])
+
+    assert 'a' in visited
+    assert m.pop_next() == 'b'
+    assert m.is_finished()
+
+
+def test_visited_set_rebuilt_from_log(tmp_path):
+    visited_path = tmp_path / "visited.log"
+    visited_path.write_text('a\n')
+    visited = BloomFilter(1000)
+
+    FileStateManager(queue.Queue, visited_path, tmp_path / "queue.log", tmp_path / "counter.log",
+                     visited_set=visited)
+
+    assert 'a' in visited
+
+
+def test_persistent_visited_set_not_rebuilt_from_log(tmp_path):
+    visited_path = tmp_path / "visited.log"
+    visited_path.write_text('a\n')
+    visited = BloomFilter(1000, path=tmp_path / "visited.bloom")
+
+    m = FileStateManager(queue.Queue, visited_path, tmp_path / "queue.log", tmp_path / "counter.log",
+                         visited_set=visited)
+    m.enqueue('b')
+    m.mark_completed(m.pop_next())
+    m.flush()
+
+    assert 'a' not in visited
+    assert visited_path.read_text() == 'a\nb\n'
+    assert 'b' in BloomFilter(1000, path=tmp_path / "visited.bloom")
+
+
+def test_visited_set_and_snapshot(tmp_path):
+    with pytest.raises(ValueError, match='snapshot'):
+        FileStateManager(queue.Queue, tmp_path / "visited.log", tmp_path / "queue.log", tmp_path / "counter.log",
+                         visited_snapshot_path=tmp_path / "visited.gz", visited_set=BloomFilter(1000))
+
+
+def test_front_coding(tmp_path):
+    visited_path = tmp_path / "visited.log"
+    queue_path = tmp_path / "queue.log"
+    counter_path = tmp_path / "counter.log"
+    m = FileStateManager(queue.Queue, visited_path, queue_path, counter_path, front_coding=True)
+    m.enqueue_many(['https://a.com/b/1', 'https://a.com/b/2', 'https://a.com/c'])
+    m.mark_completed(m.pop_next())
+    m.enqueue('https://a.com/b/3')
+
+    assert queue_path.read_text() == '0:https://a.com/b/1\n16:2\n14:c\n14:b/3\n'
+    assert visited_path.read_text() == '0:https://a.com/b/1\n'
+    m2 = FileStateManager(queue.Queue, visited_path, queue_path, counter_path, front_coding=True)
+    m2.enqueue('https://a.com/b/1')
+    assert m2.pop_next() == 'https://a.com/b/2'
+    assert m2.pop_next() == 'https://a.com/c'
+    assert m2.pop_next() == 'https://a.com/b/3'
+    assert m2.is_finished()
+
+
+def test_front_coding_resumes_plain_logs(tmp_path):
+    visited_path = tmp_path / "visited.log"
+    queue_path = tmp_path / "queue.log"
+    counter_path = tmp_path / "counter.log"
+    m = FileStateManager(queue.Queue, visited_path, queue_path, counter_path)
+    m.enqueue_many(['https://a.com/1', 'https://a.com/2'])
+    m.mark_completed(m.pop_next())
+
+    m2 = FileStateManager(queue.Queue, visited_path, queue_path, counter_path, front_coding=True)
+    m2.enqueue_many(['https://a.com/1', 'https://a.com/3', 'https://a.com/4'])
+
+    m3 = FileStateManager(queue.Queue, visited_path, queue_path, counter_path, front_coding=True)
+    assert m3.pop_next() == 'https://a.com/2'
+    assert m3.pop_next() == 'https://a.com/3'
+    assert m3.pop_next() == 'https://a.com/4'
+    assert m3.is_finished()
+
+
+def test_front_coding_resumes_plain_logs_starting_with_digits(tmp_path):
+    visited_path = tmp_path / "visited.log"
+    queue_path = tmp_path / "queue.log"
+    counter_path = tmp_path / "counter.log"
+    m = FileStateManager(queue.Queue, visited_path, queue_path, counter_path)
+    m.enqueue_many(['12weird', '3:odd'])
+    m.mark_completed(m.pop_next())
+
+    m2 = FileStateManager(queue.Queue, visited_path, queue_path, counter_path, front_coding=True)
+    m2.enqueue_many(['12weird', '4a'])
+
+    m3 = FileStateManager(queue.Queue, visited_path, queue_path, counter_path, front_coding=True)
+    assert m3.pop_next() == '3:odd'
+    assert m3.pop_next() == '4a'
+    assert m3.is_finished()
+
+def test_front_coding_compact(tmp_path):
+    visited_path = tmp_path / "visited.log"
+    queue_path = tmp_path / "queue.log"
+    counter_path = tmp_path / "counter.log"
+    snapshot_path = tmp_path / "visited.gz"
+    m = FileStateManager(queue.Queue, visited_path, queue_path, counter_path, visited_snapshot_path=snapshot_path,
+                         front_coding=True)
+    m.enqueue_many(['https://a.com/1', 'https://a.com/2', 'https://a.com/3'])
+    m.mark_completed(m.pop_next())
+
+    m.compact()
+    m.enqueue('https://a.com/4')
+    m.mark_completed(m.pop_next())
+
+    assert queue_path.read_text() == '0:https://a.com/2\n14:3\n0:https://a.com/4\n'
+    with gzip.open(snapshot_path, 'rt') as f:
+        assert f.read() == '0:https://a.com/1\n'
+    assert visited_path.read_text() == '0:https://a.com/2\n'
+    m2 = FileStateManager(queue.Queue, visited_path, queue_path, counter_path, visited_snapshot_path=snapshot_path,
+                          front_coding=True)
+    m2.enqueue_many(['https://a.com/1', 'https://a.com/2'])
+    assert m2.pop_next() == 'https://a.com/3'
+    assert m2.pop_next() == 'https://a.com/4'
+    assert m2.is_finished()
+
+
+def test_window_pops_in_order(tmp_path):
+    m = FileStateManager(queue.Queue, tmp_path / "visited.log", tmp_path / "queue.log", tmp_path / "counter.log",
+                         window_size=2)
+    m.enqueue_many(['a', 'b', 'c', 'd', 'e'])
+
+    popped = []
+    while not m.is_finished():
+        url = m.pop_next()
+        assert m._queue.qsize() <= 2
+        m.mark_completed(url)
+        popped.append(url)
+
+    assert popped == ['a', 'b', 'c', 'd', 'e']
+
+
+def test_window_deduplicates_paged_out_urls(tmp_path):
+    m = FileStateManager(queue.Queue, tmp_path / "visited.log", tmp_path / "queue.log", tmp_path / "counter.log",
+                         window_size=1)
+    m.enqueue_many(['a', 'b', 'c'])
+    m.mark_completed(m.pop_next())
+
+    m.enqueue_many(['a', 'b', 'c', 'd'])
+
+    assert (tmp_path / "queue.log").read_text() == 'a\nb\nc\nd\n'
+    assert [m.pop_next() for _ in range(3)] == ['b', 'c', 'd']
+    assert m.is_finished()
+
+
+def test_window_retries_failed_urls(tmp_path):
+    m = FileStateManager(queue.Queue, tmp_path / "visited.log", tmp_path / "queue.log", tmp_path / "counter.log",
+                         max_failures_per_url=2, window_size=1)
+    m.enqueue('a')
+    m.mark_failed(m.pop_next())
+
+    m.enqueue('a')
+    m.enqueue('a')
+
+    assert m.pop_next() == 'a'
+    m.mark_failed('a')
+    m.enqueue('a')
+    assert m.is_finished()
+
+
+def test_window_restore(tmp_path):
+    visited_path = tmp_path / "visited.log"
+    queue_path = tmp_path / "queue.log"
+    counter_path = tmp_path / "counter.log"
+    m = FileStateManager(queue.Queue, visited_path, queue_path, counter_path, window_size=1)
+    m.enqueue_many(['a', 'b', 'c'])
+    m.mark_completed(m.pop_next())
+
+    m2 = FileStateManager(queue.Queue, visited_path, queue_path, counter_path, window_size=1)
+    m2.enqueue_many(['a', 'c', 'd'])
+
+    assert [m2.pop_next() for _ in range(3)] == ['b', 'c', 'd']
+    assert m2.is_finished()
+
+
+def test_window_restore_in_memory_log(tmp_path):
+    visited_path = tmp_path / "visited.log"
+    queue_path = tmp_path / "queue.log"
+    counter_path = tmp_path / "counter.log"
+    m = FileStateManager(queue.Queue, visited_path, queue_path, counter_path)
+    m.enqueue_many(['a', 'b', 'c'])
+    m.mark_completed(m.pop_next())
+
+    m2 = FileStateManager(queue.Queue, visited_path, queue_path, counter_path, window_size=1)
+
+    assert m2.pop_next() == 'b'
+    assert m2.pop_next() == 'c'
+    assert m2.is_finished()
+
+
+def test_window_compact(tmp_path):
+    visited_path = tmp_path / "visited.log"
+    queue_path = tmp_path / "queue.log"
+    counter_path = tmp_path / "counter.log"
+    m = FileStateManager(queue.Queue, visited_path, queue_path, counter_path, window_size=1, front_coding=True)
+    m.enqueue_many(['https://a.com/1', 'https://a.com/2', 'https://a.com/3', 'https://a.com/4'])
+    m.mark_completed(m.pop_next())
+    assert m.pop_next() == 'https://a.com/2'
+
+    m.compact()
+    m.enqueue('https://a.com/5')
+
+    assert queue_path.read_text() == '0:https://a.com/2\n14:3\n14:4\n0:https://a.com/5\n'
+    m.mark_completed('https://a.com/2')
+    assert [m.pop_next() for _ in range(3)] == ['https://a.com/3', 'https://a.com/4', 'https://a.com/5']
+    assert m.is_finished()
+
+
+def test_window_persistent_seen_set(tmp_path):
+    visited_path = tmp_path / "visited.log"
+    queue_path = tmp_path / "queue.log"
+    counter_path = tmp_path / "counter.log"
+    seen_path = tmp_path / "seen.bloom"
+    m = FileStateManager(queue.Queue, visited_path, queue_path, counter_path, window_size=1,
+                         seen_set=BloomFilter(1000, path=seen_path))
+    m.enqueue_many(['a', 'b'])
+    m.flush()
+
+    m2 = FileStateManager(queue.Queue, visited_path, queue_path, counter_path, window_size=1,
+                          seen_set=BloomFilter(1000, path=seen_path))
+    m2.enqueue_many(['b', 'c'])
+
+    assert [m2.pop_next() for _ in range(3)] == ['a', 'b', 'c']
+    assert m2.is_finished()
+
+
+@pytest.mark.parametrize('queue_type', [queue.LifoQueue, queue.PriorityQueue])
+def test_window_needs_fifo_queue(tmp_path, queue_type):
+    with pytest.raises(ValueError, match='FIFO'):
+        FileStateManager(queue_type, tmp_path / "visited.log", tmp_path / "queue.log", tmp_path / "counter.log",
+                         window_size=1)
+
+
+def test_seen_set_needs_window(tmp_path):
+    with pytest.raises(ValueError, match='window'):
+        FileStateManager(queue.Queue, tmp_path / "visited.log", tmp_path / "queue.log", tmp_path / "counter.log",
+                         seen_set=BloomFilter(1000))
+
+
+def test_backoff_holds_back_failed_url(tmp_path):
+    m = FileStateManager(queue.Queue, tmp_path / "visited.log", tmp_path / "queue.log", tmp_path / "counter.log",
+                         backoff=Backoff(datetime.timedelta(minutes=1), jitter=0))
+    m.enqueue_many(['a', 'b'])
+    m.mark_failed(m.pop_next())
+
+    m.enqueue('a')
+
+    assert m.pop_next() == 'b'
+    assert m.try_pop() is None
+    assert not m.is_finished()
+    assert datetime.timedelta(seconds=59) < m.retry_delay() <= datetime.timedelta(minutes=1)
+
+
+@pytest.mark.parametrize('window_size', [0, 1])
+def test_backoff_passes(tmp_path, window_size):
+    m = FileStateManager(queue.Queue, tmp_path / "visited.log", tmp_path / "queue.log", tmp_path / "counter.log",
+                         window_size=window_size, backoff=Backoff(datetime.timedelta(milliseconds=50), jitter=0))
+    m.enqueue('a')
+    m.mark_failed(m.pop_next())
+    m.enqueue('a')
+    assert m.try_pop() is None
+
+    time.sleep(0.1)
+
+    assert m.retry_delay() == datetime.timedelta(0)
+    assert m.pop_next() == 'a'
+    assert m.retry_delay() is None
+    assert m.is_finished()
+
+
+def test_backoff_waiting_url_not_enqueued_twice(tmp_path):
+    m = FileStateManager(queue.Queue, tmp_path / "visited.log", tmp_path / "queue.log", tmp_path / "counter.log",
+                         backoff=Backoff(datetime.timedelta(milliseconds=50), jitter=0))
+    m.enqueue('a')
+    m.mark_failed(m.pop_next())
+
+    m.enqueue('a')
+    m.enqueue('a')
+    time.sleep(0.1)
+
+    assert m.pop_next() == 'a'
+    assert m.is_finished()
+
+
+def test_no_backoff_after_last_failure(tmp_path):
+    m = FileStateManager(queue.Queue, tmp_path / "visited.log", tmp_path / "queue.log", tmp_path / "counter.log",
+                         max_failures_per_url=1, backoff=Backoff(datetime.timedelta(minutes=1), jitter=0))
+    m.enqueue('a')
+    m.mark_failed(m.pop_next())
+    m.enqueue('a')
+
+    assert m.retry_delay() is None
+    assert m.is_finished()
+
+
+def test_permanent_failure_not_retried(tmp_path):
+    m = FileStateManager(queue.Queue, tmp_path / "visited.log", tmp_path / "queue.log", tmp_path / "counter.log",
+                         max_failures_per_url=3)
+    m.enqueue('a')
+
+    m.mark_failed(m.pop_next(), HttpStatusError('404 Client Error', 404))
+    m.enqueue('a')
+
+    assert m.is_finished()
+
+
+def test_retry_after_without_backoff(tmp_path):
+    m = FileStateManager(queue.Queue, tmp_path / "visited.log", tmp_path / "queue.log", tmp_path / "counter.log")
+    m.enqueue('a')
+
+    m.mark_failed(m.pop_next(), HttpStatusError('429 Client Error', 429, datetime.timedelta(minutes=2)))
+    m.enqueue('a')
+
+    assert m.try_pop() is None
+    assert datetime.timedelta(minutes=1) < m.retry_delay() <= datetime.timedelta(minutes=2)
+
+
+@pytest.mark.parametrize('window_size', [0, 1])
+def test_restore_after_completing_out_of_order(tmp_path, window_size):
+    visited_path = tmp_path / "visited.log"
+    queue_path = tmp_path / "queue.log"
+    counter_path = tmp_path / "counter.log"
+    m = FileStateManager(queue.Queue, visited_path, queue_path, counter_path, window_size=window_size)
+    m.enqueue_many(['a', 'b', 'c'])
+    m.pop_next()
+    m.mark_completed(m.pop_next())
+
+    assert counter_path.read_text() == '0\n1'
+    m2 = FileStateManager(queue.Queue, visited_path, queue_path, counter_path, window_size=window_size)
+    assert [m2.pop_next() for _ in range(2)] == ['a', 'c']
+    assert m2.is_finished()
+
+
+@pytest.mark.parametrize('window_size', [0, 1])
+def test_restore_keeps_url_waiting_for_backoff(tmp_path, window_size):
+    visited_path = tmp_path / "visited.log"
+    queue_path = tmp_path / "queue.log"
+    counter_path = tmp_path / "counter.log"
+    m = FileStateManager(queue.Queue, visited_path, queue_path, counter_path, window_size=window_size,
+                         backoff=Backoff(datetime.timedelta(seconds=100), jitter=0))
+    m.enqueue_many(['a', 'b', 'c'])
+    m.mark_failed(m.pop_next())
+    m.enqueue('a')
+    b = m.pop_next()
+    m.enqueue('d')
+    m.mark_completed(b)
+    m.mark_completed(m.pop_next())
+    m.mark_completed(m.pop_next())
+
+    assert queue_path.read_text() == 'a\nb\nc\na\nd\n'
+    m2 = FileStateManager(queue.Queue, visited_path, queue_path, counter_path, window_size=window_size)
+    assert m2.pop_next() == 'a'
+    assert m2.is_finished()
+
+    m.compact()
+
+    assert queue_path.read_text() == 'a\n'
+    m3 = FileStateManager(queue.Queue, visited_path, queue_path, counter_path, window_size=window_size)
+    assert m3.pop_next() == 'a'
+    assert m3.is_finished()
+
+
+def test_compact_after_completing_out_of_order(tmp_path):
+    visited_path = tmp_path / "visited.log"
+    queue_path = tmp_path / "queue.log"
+    counter_path = tmp_path / "counter.log"
+    m = FileStateManager(queue.Queue, visited_path, queue_path, counter_path)
+    m.enqueue_many(['a', 'b', 'c', 'd'])
+    a, b = m.pop_next(), m.pop_next()
+    m.mark_completed(b)
+
+    m.compact()
+    m.mark_completed(m.pop_next())
+    m.mark_completed(a)
+
+    assert queue_path.read_text() == 'a\nc\nd\n'
+    assert counter_path.read_text() == '2'
+    m2 = FileStateManager(queue.Queue, visited_path, queue_path, counter_path)
+    assert m2.pop_next() == 'd'
+    assert m2.is_finished()
+
+
+def test_window_restore_then_compact(tmp_path):
+    visited_path = tmp_path / "visited.log"
+    queue_path = tmp_path / "queue.log"
+    counter_path = tmp_path / "counter.log"
+    m = FileStateManager(queue.Queue, visited_path, queue_path, counter_path, window_size=1)
+    m.enqueue_many(['a', 'b', 'c', 'd'])
+    m.pop_next()
+    m.mark_completed(m.pop_next())
+
+    m2 = FileStateManager(queue.Queue, visited_path, queue_path, counter_path, window_size=1)
+    m2.compact()
+
+    popped = []
+    while not m2.is_finished():
+        url = m2.pop_next()
+        m2.mark_completed(url)
+        popped.append(url)
+    assert popped == ['a', 'c', 'd']
+
+
+@pytest.mark.parametrize('front_coding', [False, True])
+@pytest.mark.parametrize('seed', range(10))
+def test_window_restarts_and_compactions_keep_every_url(tmp_path, front_coding, seed):
+    rng = random.Random(seed)
+    visited_path = tmp_path / "visited.log"
+    queue_path = tmp_path / "queue.log"
+    counter_path = tmp_path / "counter.log"
+
+    def open_manager():
+        return FileStateManager(queue.Queue, visited_path, queue_path, counter_path, window_size=2, compact_after=3,
+                                front_coding=front_coding, visited_snapshot_path=tmp_path / "visited.gz")
+
+    m = open_manager()
+    urls = [f'https://a.com/{i}' for i in range(40)]
+    m.enqueue_many(urls[:5])
+    in_progress = []
+    completed = set()
+    for url in urls[5:]:
+        action = rng.random()
+        if action < 0.4:
+            popped = m.try_pop()
+            if popped is not None:
+                in_progress.append(popped)
+        elif action < 0.7 and in_progress:
+            done = in_progress.pop(rng.randrange(len(in_progress)))
+            m.mark_completed(done)
+            completed.add(done)
+        elif action < 0.8:
+            # Anything in flight is crawled again after a restart.
+            m = open_manager()
+            in_progress = []
+        m.enqueue(url)
+
+    m = open_manager()
+    while not m.is_finished():
+        url = m.pop_next()
+        m.mark_completed(url)
+        completed.add(url)
+    assert completed == set(urls)
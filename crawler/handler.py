@@ -1,5 +1,9 @@
 import abc
-from typing import Callable
+from typing import Callable, List, Tuple, Union
+
+import bs4
+
+from .fetcher import RawContent
 
 
 class Handler(abc.ABC):
@@ -20,3 +24,58 @@ class Handler(abc.ABC):
         :param enqueue_callback: Callback to add a newly discovered URL to the crawl queue.
         """
         raise NotImplementedError('Cannot handle from abstract base class Handler')
+
+    def handle_raw(self, content: RawContent, url: str, enqueue_callback: Callable[[str, str], None]) -> None:
+        """
+        Processes content that has not been decoded yet. Override this to decode it more cheaply, such as by passing
+        the bytes straight to a parser. Defaults to decoding it, and passing the string to handle().
+        :param content: Raw content to be processed, as bytes, with its declared encoding.
+        :param url: The URL of the content being processed.
+        :param enqueue_callback: Callback to add a newly discovered URL to the crawl queue.
+        """
+        self.handle(content.decode(), url, enqueue_callback)
+
+
+class HtmlHandler(Handler):
+    """
+    Base for handlers that parse pages as HTML. Parses the page, from a string or straight from its bytes, and
+    passes the document to _handle_doc(), so subclasses only need to pull out what they want from it.
+    """
+
+    def handle(self, content: str, url: str, enqueue_callback: Callable[[str, str], None]) -> None:
+        self._handle_doc(bs4.BeautifulSoup(content, 'html.parser'), url, enqueue_callback)
+
+    def handle_raw(self, content: RawContent, url: str, enqueue_callback: Callable[[str, str], None]) -> None:
+        # The parser detects the encoding itself if the response didn't declare one.
+        self._handle_doc(bs4.BeautifulSoup(content.content, 'html.parser', from_encoding=content.encoding), url,
+                         enqueue_callback)
+
+    @abc.abstractmethod
+    def _handle_doc(self, doc: bs4.BeautifulSoup, url: str, enqueue_callback: Callable[[str, str], None]) -> None:
+        """
+        :param doc: The parsed page.
+        :param url: The URL of the page.
+        :param enqueue_callback: Callback to add a newly discovered URL to the crawl queue.
+        """
+        raise NotImplementedError('Cannot handle from abstract base class HtmlHandler')
+
+def collect_links(handler: Handler, content: Union[str, RawContent], url: str) -> List[Tuple[str, str]]:
+    """
+    Runs `handler` on some content, collecting the URLs it discovers instead of enqueueing
+    them. Useful when the handler runs somewhere that cannot safely reach the crawl queue,
+    such as another thread or process. Defined at module level so that it can be pickled.
+    :param handler: Handler to process the content.
+    :param content: Raw content to be processed, as a string, or as bytes to be passed to handle_raw().
+    :param url: The URL of the content being processed.
+    :return: The arguments passed to the enqueue callback, as (current_url, new_url) pairs, in order.
+    """
+    links: List[Tuple[str, str]] = []
+
+    def enqueue_callback(current_url: str, new_url: str) -> None:
+        links.append((current_url, new_url))
+
+    if isinstance(content, RawContent):
+        handler.handle_raw(content, url, enqueue_callback)
+    else:
+        handler.handle(content, url, enqueue_callback)
+    return links
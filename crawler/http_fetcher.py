@@ -1,43 +1,190 @@
+import email.message
+import time
+from typing import Iterable, Optional, Tuple
+
 import requests
+import requests.adapters
+import requests.compat
+import requests.utils
+
+from .fetch_error import FetchError, HttpStatusError, parse_retry_after
+from .fetcher import Fetcher, RawContent
 
-from .fetcher import Fetcher
+# How much of a body to read at a time, checking its size and the deadline in between. Each read waits until it has
+# this much, or the body ends, so smaller reads notice a slow body sooner.
+_CHUNK_SIZE = 8 * 1024
 
 
 class HttpFetcher(Fetcher):
     """
-    Fetches pages from URLs over HTTP or HTTPs.
+    Fetches pages from URLs over HTTP or HTTPs, keeping connections open to reuse
+    for later pages, so that each fetch need not wait for a new TLS handshake. The
+    connection pool is safe to share between threads.
+
+    Bodies are streamed, so that a fetch can be abandoned as soon as it turns out
+    to be too big, too slow, or not a type of content that the handler can use,
+    without downloading the rest of it.
     """
 
-    def __init__(self, user_agent: str = '', timeout_seconds: float = 1.0):
+    def __init__(self,
+                 user_agent: str = '',
+                 timeout_seconds: float = 1.0,
+                 max_connections_per_host: int = 10,
+                 session: Optional[requests.Session] = None,
+                 max_body_bytes: int = 0,
+                 content_types: Iterable[str] = (),
+                 deadline_seconds: float = 0):
+        """
+        :param user_agent: User agent to report when fetching pages.
+        :param timeout_seconds: How long to wait to connect, and between bytes of the response.
+        :param max_connections_per_host: Most connections to one host to keep open. Should be at least the number of
+            threads fetching at once, or the extra connections are closed after every fetch.
+        :param session: Makes the requests. Defaults to a new session, with a connection pool of the given size.
+        :param max_body_bytes: Largest body to download, after decompressing it. 0 means no limit.
+        :param content_types: Media types to download, such as `text/html`, or `text/*` for every subtype. Others are
+            abandoned once their headers arrive. Responses that don't say their type are downloaded anyway. Empty
+            allows any type.
+        :param deadline_seconds: Longest a whole fetch may take. Checked after each 8 KiB of the body, so a server
+            that sends bytes slower than that can overrun it. 0 means no limit.
+        """
+        if max_connections_per_host < 1:
+            raise ValueError(f'Need at least one connection per host, got {max_connections_per_host}')
+        if max_body_bytes < 0:
+            raise ValueError(f'Body size limit cannot be negative, got {max_body_bytes}')
+        if deadline_seconds < 0:
+            raise ValueError(f'Deadline cannot be negative, got {deadline_seconds}')
         self.user_agent = user_agent
         self.timeout_seconds = timeout_seconds
+        self.max_body_bytes = max_body_bytes
+        self.content_types = frozenset(content_type.lower() for content_type in content_types)
+        self.deadline_seconds = deadline_seconds
+        self._owns_session = session is None
+        if session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_maxsize=max_connections_per_host)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+        self._session = session
+        # Includes br when a brotli package is installed to decode it, as brotlipy is in requirements.txt.
+        self._headers = {'Accept-Encoding': requests.utils.DEFAULT_ACCEPT_ENCODING}
+        if user_agent:
+            self._headers['User-Agent'] = user_agent
+
+    def close(self) -> None:
+        """
+        Closes any open connections, unless the session was passed in. The fetcher can still be used afterwards.
+        """
+        if self._owns_session:
+            self._session.close()
 
     def fetch(self, url) -> str:
         """
         :param url: An HTTP or HTTPs URL to be fetched. Redirects will be followed.
-        :return: The raw content of the fetched URL, as a string.
+        :return: The raw content of the fetched URL, as a string. If the response does not say how it is encoded,
+            the encoding is guessed from the whole body.
+        :raises FetchError: If the page could not be fetched, saying whether it is worth trying again.
+        """
+        response, body = self._get(url)
+        return _decode(response, body)
+
+    def fetch_raw(self, url) -> RawContent:
+        """
+        :param url: An HTTP or HTTPs URL to be fetched. Redirects will be followed.
+        :return: The body of the response, as bytes, with the charset from its Content-Type, if it gave one.
+        :raises FetchError: If the page could not be fetched, saying whether it is worth trying again.
+        """
+        response, body = self._get(url)
+        return RawContent(body, _charset(response.headers.get('Content-Type')))
+
+    def _get(self, url) -> Tuple[requests.Response, bytes]:
+        """
+        :return: The response, and its whole body.
         """
         if not url:
             raise ValueError('Cannot fetch empty URL')
+        start = time.monotonic()
         try:
-            headers = {}
-            if self.user_agent:
-                headers['User-Agent'] = self.user_agent
-            response = requests.get(
+            response = self._session.get(
                 url,
                 timeout=self.timeout_seconds,
-                headers=headers)
-            response.raise_for_status()  # If it didn't work
-            return response.text
+                headers=self._headers,
+                stream=True)
+            # Closing a response whose body has been read leaves the connection open for the next fetch.
+            with response:
+                response.raise_for_status()  # If it didn't work
+                self._check_headers(url, response)
+                return response, self._read_body(url, response, start)
         except requests.exceptions.InvalidSchema:
             raise NotImplementedError('Cannot fetch non-HTTP url: ' + url)
         except requests.exceptions.ConnectionError as e:
-            raise ConnectionError(e)
+            raise FetchError(str(e)) from e
         except requests.exceptions.TooManyRedirects as e:
-            raise ConnectionError(e)
+            # Redirect loops don't fix themselves.
+            raise FetchError(str(e), transient=False) from e
         except requests.exceptions.HTTPError as e:
-            raise ConnectionError(e)
+            raise HttpStatusError(str(e), e.response.status_code,
+                                  parse_retry_after(e.response.headers.get('Retry-After'))) from e
         except requests.exceptions.Timeout as e:
             raise TimeoutError(e)
         except requests.exceptions.RequestException as e:
             raise RuntimeError(e)
+
+    def _check_headers(self, url: str, response: requests.Response) -> None:
+        """
+        Checks whether the body is worth downloading, before reading any of it.
+        :raises FetchError: If it isn't. Fetching it again would get the same answer.
+        """
+        content_type = (response.headers.get('Content-Type') or '').partition(';')[0].strip().lower()
+        # Some servers leave the type out, so only a type that is declared can rule a page out.
+        if self.content_types and content_type:
+            wildcard = content_type.partition('/')[0] + '/*'
+            if content_type not in self.content_types and wildcard not in self.content_types:
+                raise FetchError(f'Not fetching {content_type} content from {url}', transient=False)
+        content_length = response.headers.get('Content-Length')
+        # The declared length is before decompressing, so a body that passes this can still be too big.
+        if self.max_body_bytes and content_length and content_length.isdigit() \
+                and int(content_length) > self.max_body_bytes:
+            raise FetchError(f'Body of {url} is {content_length} bytes, more than the limit of {self.max_body_bytes}',
+                             transient=False)
+
+    def _read_body(self, url: str, response: requests.Response, start: float) -> bytes:
+        """
+        Reads the body a chunk at a time, giving up as soon as it is too big or too slow.
+        :param start: When the fetch started, from time.monotonic().
+        :raises FetchError: If the body is too big.
+        :raises TimeoutError: If the fetch has taken too long.
+        """
+        chunks = []
+        size = 0
+        for chunk in response.iter_content(_CHUNK_SIZE):
+            size += len(chunk)
+            if self.max_body_bytes and size > self.max_body_bytes:
+                raise FetchError(f'Body of {url} is more than the limit of {self.max_body_bytes} bytes',
+                                 transient=False)
+            if self.deadline_seconds and time.monotonic() - start > self.deadline_seconds:
+                raise TimeoutError(f'Fetching {url} took more than {self.deadline_seconds} seconds')
+            chunks.append(chunk)
+        return b''.join(chunks)
+
+
+def _decode(response: requests.Response, body: bytes) -> str:
+    """
+    Decodes a body in the same way as requests' Response.text: with the encoding its headers give, or else the one
+    that best fits the body.
+    """
+    encoding = response.encoding or requests.compat.chardet.detect(body)['encoding']
+    try:
+        return str(body, encoding or 'utf-8', errors='replace')
+    except LookupError:
+        return str(body, 'utf-8', errors='replace')
+
+
+def _charset(content_type: Optional[str]) -> Optional[str]:
+    """
+    :return: The charset parameter of a Content-Type header, if there was one.
+    """
+    if not content_type:
+        return None
+    message = email.message.Message()
+    message['Content-Type'] = content_type
+    return message.get_content_charset()
@@ -1,8 +1,16 @@
+import concurrent.futures
+import datetime
+import io
+import time
+from unittest import mock
+
 import pytest
 import pytest_httpbin
 import pytest_httpbin.certs
 import requests
 
+from .fetch_error import FetchError, HttpStatusError
+from .fetcher import RawContent
 from .http_fetcher import HttpFetcher
 
 
@@ -95,3 +103,180 @@ def test_raise_on_timeout(httpbin_secure, monkeypatch):
     fetcher = HttpFetcher(timeout_seconds=0.001)
     with pytest.raises(TimeoutError, match='timed out'):
         fetcher.fetch(httpbin_secure.url + f'/delay/0.002')
+
+
+@pytest.mark.parametrize('status_code, transient', [(404, False), (410, False), (503, True), (429, True)])
+def test_http_error_status(httpbin, status_code, transient):
+    fetcher = HttpFetcher()
+    with pytest.raises(HttpStatusError) as e:
+        fetcher.fetch(httpbin.url + f'/status/{status_code}')
+    assert e.value.status_code == status_code
+    assert e.value.transient == transient
+
+
+def test_http_error_retry_after():
+    response = requests.Response()
+    response.status_code = 503
+    response.headers['Retry-After'] = '120'
+    response.raw = io.BytesIO()
+    session = requests.Session()
+    fetcher = HttpFetcher(session=session)
+    with mock.patch.object(session, 'get', return_value=response), pytest.raises(HttpStatusError) as e:
+        fetcher.fetch('http://example.com')
+    assert e.value.retry_after == datetime.timedelta(seconds=120)
+
+
+def test_invalid_max_connections_per_host():
+    with pytest.raises(ValueError, match='at least one connection'):
+        HttpFetcher(max_connections_per_host=0)
+
+
+def test_reuses_connection(httpbin):
+    fetcher = HttpFetcher()
+    fetcher.fetch(httpbin.url + '/get')
+    fetcher.fetch(httpbin.url + '/headers')
+
+    pool = fetcher._session.get_adapter(httpbin.url).poolmanager.connection_from_url(httpbin.url)
+    assert pool.num_connections == 1
+
+
+def test_reuses_connection_https(httpbin_secure, monkeypatch):
+    monkeypatch.setenv('REQUESTS_CA_BUNDLE', pytest_httpbin.certs.where())
+    fetcher = HttpFetcher()
+    fetcher.fetch(httpbin_secure.url + '/get')
+    fetcher.fetch(httpbin_secure.url + '/headers')
+
+    pool = fetcher._session.get_adapter(httpbin_secure.url).poolmanager.connection_from_url(httpbin_secure.url)
+    assert pool.num_connections == 1
+
+
+def test_reuses_connections_between_threads(httpbin):
+    fetcher = HttpFetcher(max_connections_per_host=4)
+    with concurrent.futures.ThreadPoolExecutor(4) as executor:
+        list(executor.map(fetcher.fetch, [httpbin.url + '/delay/0.1'] * 8))
+        list(executor.map(fetcher.fetch, [httpbin.url + '/delay/0.1'] * 8))
+
+    pool = fetcher._session.get_adapter(httpbin.url).poolmanager.connection_from_url(httpbin.url)
+    assert pool.num_connections <= 4
+
+
+def test_accepts_compression(httpbin):
+    fetcher = HttpFetcher()
+    response = fetcher.fetch(httpbin.url + '/headers')
+    assert '"Accept-Encoding":"gzip, deflate, br"' in response
+
+
+@pytest.mark.parametrize('path, key', [('gzip', 'gzipped'), ('deflate', 'deflated'), ('brotli', 'brotli')])
+def test_decompresses(httpbin, path, key):
+    fetcher = HttpFetcher()
+    response = fetcher.fetch(httpbin.url + f'/{path}')
+    assert f'"{key}":true' in response
+
+
+def test_uses_given_session(httpbin):
+    session = requests.Session()
+    session.headers['X-Foo'] = 'bar'
+    fetcher = HttpFetcher(user_agent='foo', session=session)
+
+    response = fetcher.fetch(httpbin.url + '/headers')
+
+    assert '"X-Foo":"bar"' in response
+    assert '"User-Agent":"foo"' in response
+    fetcher.close()
+    assert session.get_adapter(httpbin.url).poolmanager.pools
+
+
+def test_fetch_raw(httpbin):
+    fetcher = HttpFetcher()
+    response = fetcher.fetch_raw(httpbin.url + '/response-headers?Content-Type=text/html;%20charset=ISO-8859-1')
+    assert isinstance(response, RawContent)
+    assert b'charset=ISO-8859-1' in response.content
+    assert response.encoding == 'iso-8859-1'
+
+
+def test_fetch_raw_without_charset(httpbin):
+    fetcher = HttpFetcher()
+    response = fetcher.fetch_raw(httpbin.url + '/bytes/16')
+    assert len(response.content) == 16
+    assert response.encoding is None
+
+
+def test_fetch_raw_http_error(httpbin):
+    fetcher = HttpFetcher()
+    with pytest.raises(HttpStatusError, match='404 Client Error'):
+        fetcher.fetch_raw(httpbin.url + '/status/404')
+
+
+@pytest.mark.parametrize('max_body_bytes, deadline_seconds', [(-1, 0), (0, -1)])
+def test_invalid_limits(max_body_bytes, deadline_seconds):
+    with pytest.raises(ValueError, match='negative'):
+        HttpFetcher(max_body_bytes=max_body_bytes, deadline_seconds=deadline_seconds)
+
+
+def test_body_within_limit(httpbin):
+    fetcher = HttpFetcher(max_body_bytes=1000)
+    assert len(fetcher.fetch_raw(httpbin.url + '/bytes/1000').content) == 1000
+
+
+def test_body_over_declared_limit(httpbin):
+    fetcher = HttpFetcher(max_body_bytes=1000)
+    with pytest.raises(FetchError, match='more than the limit') as e:
+        fetcher.fetch(httpbin.url + '/bytes/1001')
+    assert not e.value.transient
+
+
+def test_streamed_body_over_limit(httpbin):
+    # Chunked, so there is no Content-Length to check up front.
+    fetcher = HttpFetcher(max_body_bytes=1000)
+    with pytest.raises(FetchError, match='more than the limit') as e:
+        fetcher.fetch(httpbin.url + '/stream-bytes/5000?chunk_size=100')
+    assert not e.value.transient
+
+
+def test_decompressed_body_over_limit(httpbin):
+    fetcher = HttpFetcher(max_body_bytes=100)
+    with pytest.raises(FetchError, match='more than the limit'):
+        fetcher.fetch(httpbin.url + '/gzip')
+
+
+@pytest.mark.parametrize('path', ['/html', '/encoding/utf8'])
+def test_allowed_content_type(httpbin, path):
+    fetcher = HttpFetcher(content_types=['text/html'])
+    assert '<h1>' in fetcher.fetch(httpbin.url + path)
+
+
+def test_allowed_content_type_wildcard(httpbin):
+    fetcher = HttpFetcher(content_types=['application/json', 'Text/*'])
+    assert '<h1>' in fetcher.fetch(httpbin.url + '/html')
+    assert '"url"' in fetcher.fetch(httpbin.url + '/get')
+
+
+@pytest.mark.parametrize('path', ['/image/png', '/get', '/bytes/10'])
+def test_disallowed_content_type(httpbin, path):
+    fetcher = HttpFetcher(content_types=['text/html'])
+    with pytest.raises(FetchError, match='Not fetching') as e:
+        fetcher.fetch(httpbin.url + path)
+    assert not e.value.transient
+
+
+def test_missing_content_type_allowed():
+    response = requests.Response()
+    response.status_code = 200
+    response.raw = io.BytesIO(b'<h1>Potato</h1>')
+    session = requests.Session()
+    fetcher = HttpFetcher(session=session, content_types=['text/html'])
+    with mock.patch.object(session, 'get', return_value=response):
+        assert fetcher.fetch('http://example.com') == '<h1>Potato</h1>'
+
+def test_deadline(httpbin):
+    # Sends a byte at a time for several seconds, so never trips the timeout between bytes.
+    fetcher = HttpFetcher(deadline_seconds=0.5)
+    start = time.monotonic()
+    with pytest.raises(TimeoutError, match='took more than 0.5 seconds'):
+        fetcher.fetch(httpbin.url + '/drip?duration=5&numbytes=100000&delay=0')
+    assert time.monotonic() - start < 2
+
+
+def test_within_deadline(httpbin):
+    fetcher = HttpFetcher(deadline_seconds=5)
+    assert fetcher.fetch(httpbin.url + '/drip?duration=0.2&numbytes=2&delay=0') == '**'
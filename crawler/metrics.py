@@ -0,0 +1,214 @@
+import bisect
+import contextlib
+import contextvars
+import datetime
+import json
+import os
+import pathlib
+import threading
+import time
+from enum import Enum
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+# Upper bounds of the latency histogram buckets, in seconds. Wide enough to cover
+# both quick SQLite operations and minute-long politeness waits.
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+_current: contextvars.ContextVar[Optional[Tuple['Metrics', str]]] = contextvars.ContextVar('metrics', default=None)
+
+
+def _no_route(url: str) -> Optional[str]:
+    return None
+
+
+class Histogram:
+    """
+    Counts observations into cumulative buckets, in the same way as a Prometheus histogram.
+    Not thread-safe on its own.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        # Observations no bigger than each bucket's bound, excluding smaller buckets.
+        self._counts: List[int] = [0] * len(BUCKETS)
+
+    def observe(self, value: float) -> None:
+        self.count += 1
+        self.sum += value
+        i = bisect.bisect_left(BUCKETS, value)
+        if i < len(BUCKETS):
+            self._counts[i] += 1
+
+    def buckets(self) -> List[Tuple[float, int]]:
+        """
+        :return: (upper bound, number of observations no bigger than it) for each bucket.
+        """
+        result = []
+        total = 0
+        for bound, count in zip(BUCKETS, self._counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+class Metrics:
+    """
+    Collects counters and latency histograms for each stage of the crawl, broken down
+    by route, so that we can tell whether a crawl is slow because of the network, the
+    parsing, or the state manager. Safe to share between threads.
+
+    Stages recorded by the crawlers are:
+     - wait: waiting for the politeness scheduler.
+     - fetch: fetching a page.
+     - handle: running the handler, including any output it writes.
+     - state_*: calls to the state manager, such as state_pop or state_enqueue.
+    Handlers can record stages of their own with `timed`, such as the time spent
+    writing output. That only works when they run in the crawler's own threads.
+
+    Metrics can be written to a file periodically, as JSON or in the Prometheus text
+    format, which suits node_exporter's textfile collector.
+    """
+
+    Format = Enum('Format', ['JSON', 'PROMETHEUS'])
+
+    def __init__(self,
+                 route_fn: Callable[[str], Optional[str]] = _no_route,
+                 export_path: Optional[pathlib.Path] = None,
+                 export_format: Format = Format.JSON,
+                 export_interval: datetime.timedelta = datetime.timedelta(minutes=1)):
+        """
+        :param route_fn: Names the kind of page at a URL, for breaking down metrics. May return None if it doesn't know.
+        :param export_path: Where to write metrics. If not given, metrics are only kept in memory.
+        :param export_format: How to write metrics.
+        :param export_interval: How often to write metrics.
+        """
+        self.route_fn = route_fn
+        self.export_path = export_path
+        self.export_format = export_format
+        self.export_interval = export_interval
+        self._counters: Dict[Tuple[str, str], int] = {}
+        self._gauges: Dict[str, float] = {}
+        self._histograms: Dict[Tuple[str, str], Histogram] = {}
+        self._lock = threading.Lock()
+        self._export_lock = threading.Lock()
+        self._last_export = time.monotonic()
+
+    def route(self, url: str) -> str:
+        """
+        :return: The route to record metrics about `url` against.
+        """
+        return self.route_fn(url) or ''
+
+    def increment(self, name: str, route: str = '', amount: int = 1) -> None:
+        with self._lock:
+            self._counters[name, route] = self._counters.get((name, route), 0) + amount
+
+    def set_gauge(self, name: str, value: float) -> None:
+        with self._lock:
+            self._gauges[name] = value
+
+    def observe(self, stage: str, route: str, seconds: float) -> None:
+        with self._lock:
+            histogram = self._histograms.get((stage, route))
+            if histogram is None:
+                histogram = self._histograms[stage, route] = Histogram()
+            histogram.observe(seconds)
+
+    @contextlib.contextmanager
+    def time(self, stage: str, route: str = '') -> Iterator[None]:
+        """
+        Records how long the body of the `with` statement takes, even if it raises.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, route, time.perf_counter() - start)
+
+    @contextlib.contextmanager
+    def handling(self, route: str) -> Iterator[None]:
+        """
+        Makes `timed` record against these metrics and route, within the `with` statement.
+        """
+        token = _current.set((self, route))
+        try:
+            yield
+        finally:
+            _current.reset(token)
+
+    def to_json(self) -> str:
+        with self._lock:
+            counters: Dict[str, Dict[str, int]] = {}
+            for (name, route), value in sorted(self._counters.items()):
+                counters.setdefault(name, {})[route] = value
+            stages: Dict[str, Dict[str, Dict]] = {}
+            for (stage, route), histogram in sorted(self._histograms.items()):
+                stages.setdefault(stage, {})[route] = {
+                    'count': histogram.count,
+                    'sum': histogram.sum,
+                    'buckets': {str(bound): count for bound, count in histogram.buckets()},
+                }
+            return json.dumps({'counters': counters, 'gauges': dict(sorted(self._gauges.items())), 'stages': stages})
+
+    def to_prometheus(self) -> str:
+        lines = []
+        with self._lock:
+            for name in sorted({name for name, _ in self._counters}):
+                lines.append(f'# TYPE crawler_{name}_total counter')
+                for (counter, route), value in sorted(self._counters.items()):
+                    if counter == name:
+                        lines.append(f'crawler_{name}_total{{route="{route}"}} {value}')
+            for name, value in sorted(self._gauges.items()):
+                lines.append(f'# TYPE crawler_{name} gauge')
+                lines.append(f'crawler_{name} {value}')
+            if self._histograms:
+                lines.append('# TYPE crawler_stage_seconds histogram')
+            for (stage, route), histogram in sorted(self._histograms.items()):
+                labels = f'stage="{stage}",route="{route}"'
+                for bound, count in histogram.buckets():
+                    lines.append(f'crawler_stage_seconds_bucket{{{labels},le="{bound}"}} {count}')
+                lines.append(f'crawler_stage_seconds_bucket{{{labels},le="+Inf"}} {histogram.count}')
+                lines.append(f'crawler_stage_seconds_sum{{{labels}}} {histogram.sum}')
+                lines.append(f'crawler_stage_seconds_count{{{labels}}} {histogram.count}')
+        return ''.join(f'{line}\n' for line in lines)
+
+    def export(self) -> None:
+        """
+        Writes metrics to the export path, if there is one. Readers never see a half-written file.
+        """
+        with self._export_lock:
+            self._last_export = time.monotonic()
+            if self.export_path is None:
+                return
+            if self.export_format == Metrics.Format.PROMETHEUS:
+                content = self.to_prometheus()
+            else:
+                content = self.to_json()
+            temp_path = self.export_path.with_name(f'{self.export_path.name}.tmp')
+            with open(temp_path, 'w') as f:
+                f.write(content)
+            os.replace(temp_path, self.export_path)
+
+    def maybe_export(self) -> None:
+        """
+        Writes metrics if it has been long enough since they were last written.
+        """
+        if time.monotonic() - self._last_export >= self.export_interval.total_seconds():
+            self.export()
+
+
+@contextlib.contextmanager
+def timed(stage: str) -> Iterator[None]:
+    """
+    Records how long the body of the `with` statement takes against the page being
+    handled, if the crawler is collecting metrics in this thread. Does nothing otherwise.
+    :param stage: Name of the stage being timed, such as 'write'.
+    """
+    current = _current.get()
+    if current is None:
+        yield
+        return
+    metrics, route = current
+    with metrics.time(stage, route):
+        yield
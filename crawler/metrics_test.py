@@ -0,0 +1,190 @@
+import datetime
+import json
+import threading
+import time
+
+import pytest
+
+from .metrics import BUCKETS, Histogram, Metrics, timed
+
+
+def test_histogram_buckets_are_cumulative():
+    h = Histogram()
+    h.observe(0.002)
+    h.observe(0.002)
+    h.observe(0.3)
+    h.observe(1000)
+
+    buckets = dict(h.buckets())
+    assert h.count == 4
+    assert h.sum == pytest.approx(1000.304)
+    assert buckets[0.001] == 0
+    assert buckets[0.0025] == 2
+    assert buckets[0.25] == 2
+    assert buckets[0.5] == 3
+    assert buckets[BUCKETS[-1]] == 3  # Only counted in the implicit +Inf bucket.
+
+
+def test_histogram_bound_is_inclusive():
+    h = Histogram()
+    h.observe(0.1)
+
+    assert dict(h.buckets())[0.1] == 1
+
+
+def test_route():
+    m = Metrics(lambda url: 'view' if 'view' in url else None)
+
+    assert m.route('http://example.com/view/1') == 'view'
+    assert m.route('http://example.com/other') == ''
+
+
+def test_default_route():
+    assert Metrics().route('http://example.com/') == ''
+
+
+def test_time():
+    m = Metrics()
+    with m.time('fetch', 'view'):
+        time.sleep(0.01)
+
+    stage = json.loads(m.to_json())['stages']['fetch']['view']
+    assert stage['count'] == 1
+    assert stage['sum'] >= 0.01
+
+
+def test_time_records_errors():
+    m = Metrics()
+    with pytest.raises(ValueError):
+        with m.time('fetch'):
+            raise ValueError('oops')
+
+    assert json.loads(m.to_json())['stages']['fetch']['']['count'] == 1
+
+
+def test_timed_without_metrics():
+    with timed('write'):
+        pass
+
+
+def test_timed_records_against_handled_route():
+    m = Metrics()
+    with m.handling('imagemap'):
+        with timed('write'):
+            pass
+
+    assert json.loads(m.to_json())['stages']['write']['imagemap']['count'] == 1
+
+
+def test_timed_only_in_handling_thread():
+    m = Metrics()
+
+    def other_thread():
+        with timed('write'):
+            pass
+
+    with m.handling('imagemap'):
+        t = threading.Thread(target=other_thread)
+        t.start()
+        t.join()
+
+    assert 'write' not in json.loads(m.to_json())['stages']
+
+
+def test_handling_resets_afterwards():
+    m = Metrics()
+    with m.handling('imagemap'):
+        pass
+    with timed('write'):
+        pass
+
+    assert 'write' not in json.loads(m.to_json())['stages']
+
+
+def test_to_json():
+    m = Metrics()
+    m.increment('pages_completed', 'view')
+    m.increment('pages_completed', 'view')
+    m.increment('pages_completed', 'index')
+    m.increment('pages_failed', 'view', 3)
+    m.set_gauge('canonicalization_fetches_saved', 7)
+    m.observe('fetch', 'view', 0.2)
+
+    got = json.loads(m.to_json())
+
+    assert got['counters'] == {'pages_completed': {'index': 1, 'view': 2}, 'pages_failed': {'view': 3}}
+    assert got['gauges'] == {'canonicalization_fetches_saved': 7}
+    assert got['stages']['fetch']['view']['count'] == 1
+    assert got['stages']['fetch']['view']['sum'] == 0.2
+    assert got['stages']['fetch']['view']['buckets']['0.1'] == 0
+    assert got['stages']['fetch']['view']['buckets']['0.25'] == 1
+
+
+def test_to_prometheus():
+    m = Metrics()
+    m.increment('pages_completed', 'view', 2)
+    m.set_gauge('canonicalization_fetches_saved', 7)
+    m.observe('fetch', 'view', 0.2)
+
+    lines = m.to_prometheus().splitlines()
+
+    assert '# TYPE crawler_pages_completed_total counter' in lines
+    assert 'crawler_pages_completed_total{route="view"} 2' in lines
+    assert '# TYPE crawler_canonicalization_fetches_saved gauge' in lines
+    assert 'crawler_canonicalization_fetches_saved 7' in lines
+    assert '# TYPE crawler_stage_seconds histogram' in lines
+    assert 'crawler_stage_seconds_bucket{stage="fetch",route="view",le="0.1"} 0' in lines
+    assert 'crawler_stage_seconds_bucket{stage="fetch",route="view",le="0.25"} 1' in lines
+    assert 'crawler_stage_seconds_bucket{stage="fetch",route="view",le="+Inf"} 1' in lines
+    assert 'crawler_stage_seconds_sum{stage="fetch",route="view"} 0.2' in lines
+    assert 'crawler_stage_seconds_count{stage="fetch",route="view"} 1' in lines
+
+
+def test_to_prometheus_empty():
+    assert Metrics().to_prometheus() == ''
+
+
+def test_export_json(tmp_path):
+    path = tmp_path / 'metrics.json'
+    m = Metrics(export_path=path)
+    m.increment('pages_completed', 'view')
+    m.export()
+
+    assert json.loads(path.read_text())['counters'] == {'pages_completed': {'view': 1}}
+    assert list(tmp_path.iterdir()) == [path]
+
+
+def test_export_prometheus(tmp_path):
+    path = tmp_path / 'metrics.prom'
+    m = Metrics(export_path=path, export_format=Metrics.Format.PROMETHEUS)
+    m.increment('pages_completed', 'view')
+    m.export()
+
+    assert 'crawler_pages_completed_total{route="view"} 1\n' in path.read_text()
+
+
+def test_export_replaces_previous(tmp_path):
+    path = tmp_path / 'metrics.json'
+    m = Metrics(export_path=path)
+    m.increment('pages_completed', 'view')
+    m.export()
+    m.increment('pages_completed', 'view')
+    m.export()
+
+    assert json.loads(path.read_text())['counters'] == {'pages_completed': {'view': 2}}
+
+
+def test_export_without_path():
+    Metrics().export()
+
+
+def test_maybe_export_waits_for_interval(tmp_path):
+    path = tmp_path / 'metrics.json'
+    m = Metrics(export_path=path, export_interval=datetime.timedelta(seconds=0.1))
+
+    m.maybe_export()
+    assert not path.exists()
+
+    time.sleep(0.1)
+    m.maybe_export()
+    assert path.exists()
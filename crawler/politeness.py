@@ -0,0 +1,76 @@
+import datetime
+import threading
+import time
+import urllib.parse
+from typing import Dict, NamedTuple, Optional, Tuple
+
+
+class Rate(NamedTuple):
+    """
+    How often requests may be made to a host.
+    """
+    # Minimum average time between requests.
+    interval: datetime.timedelta
+    # How many requests may be made back-to-back after a quiet spell.
+    burst: int = 1
+
+
+class PolitenessScheduler:
+    """
+    Spaces out requests to each host, so that several pages can be crawled at once
+    without any one site seeing requests more often than its crawl delay allows.
+    Safe to share between threads.
+
+    Each host has a token bucket, which holds up to `burst` tokens and gains one
+    every `interval`. A request spends a token, waiting for one if the bucket is
+    empty. Time spent fetching and handling a page counts towards the wait for the
+    next one, rather than adding to it.
+    """
+
+    def __init__(self,
+                 default_rate: Rate = Rate(datetime.timedelta(0)),
+                 host_rates: Optional[Dict[str, Rate]] = None):
+        """
+        :param default_rate: Rate for hosts without one of their own.
+        :param host_rates: Rates for particular hosts. A rate for a domain also applies to its subdomains, which
+            then share a bucket, so `europotato.org` covers `www.europotato.org`.
+        """
+        for rate in [default_rate, *(host_rates or {}).values()]:
+            if rate.burst < 1:
+                raise ValueError(f'Burst must be at least 1, got {rate.burst}')
+        self.default_rate = default_rate
+        self.host_rates = host_rates or {}
+        # When each bucket would next be full, were no more requests made.
+        self._full_at: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def _bucket(self, url: str) -> Tuple[str, Rate]:
+        host = urllib.parse.urlsplit(url).hostname or ''
+        labels = host.split('.')
+        for i in range(len(labels)):
+            domain = '.'.join(labels[i:])
+            if domain in self.host_rates:
+                return domain, self.host_rates[domain]
+        return host, self.default_rate
+
+    def reserve(self, url: str) -> float:
+        """
+        Claims the next free slot for a request to the host of `url`.
+        :param url: The URL about to be fetched.
+        :return: How many seconds the caller must wait before making the request.
+        """
+        bucket, rate = self._bucket(url)
+        interval = rate.interval.total_seconds()
+        with self._lock:
+            now = time.monotonic()
+            full_at = max(now, self._full_at.get(bucket, now))
+            slot = max(now, full_at - (rate.burst - 1) * interval)
+            self._full_at[bucket] = full_at + interval
+        return slot - now
+
+    def wait(self, url: str) -> None:
+        """
+        Blocks until it is polite to make a request for `url`.
+        :param url: The URL about to be fetched.
+        """
+        time.sleep(self.reserve(url))
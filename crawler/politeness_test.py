@@ -0,0 +1,106 @@
+import datetime
+import time
+
+import pytest
+
+from .politeness import PolitenessScheduler, Rate
+
+
+def test_no_delay():
+    s = PolitenessScheduler()
+    assert s.reserve('http://a.com/1') == 0
+    assert s.reserve('http://a.com/2') == 0
+
+
+def test_first_request_does_not_wait():
+    s = PolitenessScheduler(Rate(datetime.timedelta(seconds=10)))
+    assert s.reserve('http://a.com/1') == 0
+
+
+def test_consecutive_requests_to_same_host():
+    s = PolitenessScheduler(Rate(datetime.timedelta(seconds=10)))
+    s.reserve('http://a.com/1')
+    assert 9 < s.reserve('http://a.com/2') <= 10
+    assert 19 < s.reserve('http://a.com/3') <= 20
+
+
+def test_hosts_are_independent():
+    s = PolitenessScheduler(Rate(datetime.timedelta(seconds=10)))
+    s.reserve('http://a.com/1')
+    s.reserve('http://a.com/2')
+    assert s.reserve('http://b.com/1') == 0
+
+
+def test_ports_share_host():
+    s = PolitenessScheduler(Rate(datetime.timedelta(seconds=10)))
+    s.reserve('http://a.com:8080/1')
+    assert s.reserve('http://a.com/2') > 9
+
+
+def test_only_waits_for_remaining_time():
+    s = PolitenessScheduler(Rate(datetime.timedelta(seconds=0.2)))
+    s.wait('http://a.com/1')
+    time.sleep(0.15)
+    assert s.reserve('http://a.com/2') < 0.1
+
+
+def test_no_wait_after_interval_has_passed():
+    s = PolitenessScheduler(Rate(datetime.timedelta(seconds=0.1)))
+    s.wait('http://a.com/1')
+    time.sleep(0.15)
+    assert s.reserve('http://a.com/2') == 0
+
+
+def test_burst():
+    s = PolitenessScheduler(Rate(datetime.timedelta(seconds=10), burst=3))
+    assert s.reserve('http://a.com/1') == 0
+    assert s.reserve('http://a.com/2') == 0
+    assert s.reserve('http://a.com/3') == 0
+    assert 9 < s.reserve('http://a.com/4') <= 10
+    assert 19 < s.reserve('http://a.com/5') <= 20
+
+
+def test_burst_refills_over_time():
+    s = PolitenessScheduler(Rate(datetime.timedelta(seconds=0.1), burst=2))
+    s.reserve('http://a.com/1')
+    s.reserve('http://a.com/2')
+    time.sleep(0.25)
+    # Bucket holds at most two tokens, however long we wait.
+    assert s.reserve('http://a.com/3') == 0
+    assert s.reserve('http://a.com/4') == 0
+    assert s.reserve('http://a.com/5') > 0
+
+
+def test_invalid_burst():
+    with pytest.raises(ValueError, match='at least 1'):
+        PolitenessScheduler(Rate(datetime.timedelta(seconds=1), burst=0))
+    with pytest.raises(ValueError, match='at least 1'):
+        PolitenessScheduler(host_rates={'a.com': Rate(datetime.timedelta(seconds=1), burst=0)})
+
+
+def test_host_rates():
+    s = PolitenessScheduler(Rate(datetime.timedelta(seconds=10)),
+                            {'europotato.org': Rate(datetime.timedelta(seconds=60)),
+                             'www.plantbreeding.wur.nl': Rate(datetime.timedelta(seconds=5))})
+    for host in ['www.europotato.org', 'www.plantbreeding.wur.nl', 'example.com']:
+        s.reserve(f'https://{host}/1')
+
+    assert 59 < s.reserve('https://www.europotato.org/2') <= 60
+    assert 4 < s.reserve('https://www.plantbreeding.wur.nl/2') <= 5
+    assert 9 < s.reserve('https://example.com/2') <= 10
+
+
+def test_subdomains_share_domain_rate():
+    s = PolitenessScheduler(host_rates={'europotato.org': Rate(datetime.timedelta(seconds=60))})
+    s.reserve('https://www.europotato.org/1')
+    assert s.reserve('https://europotato.org/2') > 59
+    assert s.reserve('https://www.example.org/1') == 0
+
+
+def test_wait():
+    s = PolitenessScheduler(Rate(datetime.timedelta(seconds=0.1)))
+    start = time.time()
+    s.wait('http://a.com/1')
+    s.wait('http://a.com/2')
+    s.wait('http://a.com/3')
+    assert time.time() - start >= 0.2
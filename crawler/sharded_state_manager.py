@@ -0,0 +1,267 @@
+import datetime
+import json
+import os
+import pathlib
+import time
+import urllib.parse
+import zlib
+from enum import Enum
+from typing import IO, Any, Dict, Iterable, List, Optional, Set
+
+from .state_manager import StateManager
+
+
+class ShardedStateManager(StateManager):
+    """
+    Splits a crawl between several processes, each of which owns one shard of the
+    URLs and keeps them in its own state manager, such as a SqlStateManager with a
+    database for each shard. Processes never write to each other's state, so they
+    don't contend for its lock, and can run on different machines that share a
+    filesystem.
+
+    URLs are assigned to shards by a hash of their host, which keeps each site on
+    one shard so that its crawl delay is respected, or by a hash of the whole URL,
+    which spreads one site across every shard.
+
+    URLs found for other shards are appended to their inboxes. An inbox is a
+    directory with a log from each shard that sends to it, so every log has one
+    writer. Each shard reads its inbox when it runs out of URLs, or once every poll
+    interval, and records how far it has read each log once what it read has been
+    enqueued and flushed. A crash can therefore only cause URLs to be enqueued twice,
+    which the underlying state manager ignores.
+
+    A process's crawl only ends once the whole crawl is idle, since a shard with
+    nothing to do may still be sent URLs by the others. Each shard keeps a status
+    file in its inbox, saying whether it is idle, with nothing queued or in flight,
+    and how much it has sent to and read from each other shard. It says it is busy
+    as soon as it gets more URLs. Until every shard is idle and has read everything
+    sent to it, retry_delay() asks the crawler to try again after the poll interval.
+    Statuses are read twice, and only trusted if none changed in between, since
+    they are not all read at the same moment. A shard whose process has not started
+    counts as busy.
+    """
+
+    Partition = Enum('Partition', ['HOST', 'URL'])
+
+    def __init__(self,
+                 shard: StateManager,
+                 shard_index: int,
+                 num_shards: int,
+                 inbox_root: pathlib.Path,
+                 partition: Partition = Partition.HOST,
+                 poll_interval: datetime.timedelta = datetime.timedelta(seconds=1)):
+        """
+        :param shard: Keeps the state of this process's shard.
+        :param shard_index: Which shard this process owns, from 0.
+        :param num_shards: How many shards the crawl is split into. Must be the same for every process.
+        :param inbox_root: Directory holding every shard's inbox. Must be shared by every process.
+        :param partition: How to assign URLs to shards. Must be the same for every process.
+        :param poll_interval: How often to read the inbox, while this shard still has URLs of its own, or to check
+            whether the other shards have finished.
+        """
+        if num_shards < 1:
+            raise ValueError(f'Need at least one shard, got {num_shards}')
+        if not 0 <= shard_index < num_shards:
+            raise ValueError(f'Shard index must be between 0 and {num_shards - 1}, got {shard_index}')
+        self._shard = shard
+        self._shard_index = shard_index
+        self._num_shards = num_shards
+        self._inbox_root = inbox_root
+        self._partition = partition
+        self._poll_interval = poll_interval
+        self._inbox = ShardedStateManager._inbox_path(inbox_root, shard_index)
+        self._inbox.mkdir(parents=True, exist_ok=True)
+        # Logs this shard sends to other shards, opened when first needed.
+        self._outboxes: Dict[int, IO[str]] = {}
+        # How many bytes of each log in the inbox have been enqueued.
+        self._offsets_path = self._inbox / 'offsets.json'
+        try:
+            self._offsets: Dict[str, int] = json.loads(self._offsets_path.read_text())
+        except FileNotFoundError:
+            self._offsets = {}
+        self._last_poll = time.monotonic()
+        # URLs popped from this shard and not yet marked.
+        self._in_flight: Set[str] = set()
+        # What this shard last told the others about itself.
+        self._status_path = self._inbox / 'status.json'
+        self._status: Optional[Dict[str, Any]] = None
+        # Any status left from an earlier run is out of date, and this shard may have URLs left from it.
+        self._publish(idle=False)
+
+    @staticmethod
+    def _inbox_path(inbox_root: pathlib.Path, shard_index: int) -> pathlib.Path:
+        return inbox_root / f'shard-{shard_index}'
+
+    def shard_of(self, url: str) -> int:
+        """
+        :return: Index of the shard that owns `url`.
+        """
+        if self._partition == ShardedStateManager.Partition.HOST:
+            key = urllib.parse.urlsplit(url).hostname or ''
+        else:
+            key = url
+        # Python's own string hashes differ between processes, so they can't be used here.
+        return zlib.crc32(key.encode()) % self._num_shards
+
+    def _outbox(self, shard_index: int) -> IO[str]:
+        outbox = self._outboxes.get(shard_index)
+        if outbox is None:
+            inbox = ShardedStateManager._inbox_path(self._inbox_root, shard_index)
+            inbox.mkdir(parents=True, exist_ok=True)
+            outbox = self._outboxes[shard_index] = open(inbox / f'from-{self._shard_index}.log', 'a')
+        return outbox
+
+    def _receive(self) -> None:
+        """
+        Enqueues any URLs that other shards have sent since the inbox was last read.
+        """
+        self._last_poll = time.monotonic()
+        urls: List[str] = []
+        offsets = dict(self._offsets)
+        for path in sorted(self._inbox.glob('from-*.log')):
+            offset = offsets.get(path.name, 0)
+            with open(path, 'rb') as f:
+                f.seek(offset)
+                data = f.read()
+            # The sender may be part way through writing a line, so leave anything after the last newline for later.
+            end = data.rfind(b'\n') + 1
+            if not end:
+                continue
+            urls.extend(data[:end].decode().splitlines())
+            offsets[path.name] = offset + end
+        if not urls:
+            return
+        self._shard.enqueue_many(urls)
+        self._shard.flush()
+        ShardedStateManager._write_json(self._offsets_path, offsets)
+        self._offsets = offsets
+        self._publish(idle=False)
+
+    @staticmethod
+    def _write_json(path: pathlib.Path, value: Any) -> None:
+        """
+        Atomically replaces the file at `path`, so that readers never see it half written.
+        """
+        temp_path = path.with_name(f'{path.name}.tmp')
+        temp_path.write_text(json.dumps(value))
+        os.replace(temp_path, path)
+
+    def _publish(self, idle: bool) -> None:
+        """
+        Tells the other shards whether this one is idle, and how many bytes it has sent to and read from each.
+        """
+        if not idle and self._status is not None and not self._status['idle']:
+            # Counts only matter once a shard is idle, so there is nothing new to say.
+            return
+        sent = {}
+        for shard_index in range(self._num_shards):
+            path = ShardedStateManager._inbox_path(self._inbox_root, shard_index) / f'from-{self._shard_index}.log'
+            if path.exists():
+                sent[str(shard_index)] = path.stat().st_size
+        status = {'idle': idle, 'sent': sent, 'received': self._offsets}
+        if status != self._status:
+            ShardedStateManager._write_json(self._status_path, status)
+            self._status = status
+
+    def _read_statuses(self) -> Optional[List[Dict[str, Any]]]:
+        """
+        :return: Every shard's status, or None if a shard's process has not started yet.
+        """
+        statuses = []
+        for shard_index in range(self._num_shards):
+            path = ShardedStateManager._inbox_path(self._inbox_root, shard_index) / 'status.json'
+            try:
+                statuses.append(json.loads(path.read_text()))
+            except FileNotFoundError:
+                return None
+        return statuses
+
+    def _crawl_finished(self) -> bool:
+        """
+        Whether every shard is idle, and has read everything the others sent it. If no status changed between two
+        reads, every shard was idle at once, after which none can be sent any more URLs.
+        """
+        self._receive()
+        idle = not self._in_flight and self._shard.is_finished()
+        self._publish(idle)
+        if not idle:
+            return False
+        statuses = self._read_statuses()
+        if statuses is None or statuses != self._read_statuses():
+            return False
+        for sender, status in enumerate(statuses):
+            if not status['idle']:
+                return False
+            for receiver, sent in status['sent'].items():
+                if statuses[int(receiver)]['received'].get(f'from-{sender}.log', 0) != sent:
+                    return False
+        return True
+
+    def is_finished(self) -> bool:
+        return self._crawl_finished()
+
+    def enqueue(self, url: str) -> None:
+        self.enqueue_many([url])
+
+    def enqueue_many(self, urls: Iterable[str]) -> None:
+        local = []
+        remote: Dict[int, List[str]] = {}
+        for url in urls:
+            shard_index = self.shard_of(url)
+            if shard_index == self._shard_index:
+                local.append(url)
+            else:
+                remote.setdefault(shard_index, []).append(url)
+        if local:
+            self._shard.enqueue_many(local)
+            self._publish(idle=False)
+        for shard_index, shard_urls in remote.items():
+            outbox = self._outbox(shard_index)
+            # One write, so we only flush once.
+            outbox.write(''.join(f'{url}\n' for url in shard_urls))
+            outbox.flush()
+
+    def try_pop(self) -> Optional[str]:
+        if time.monotonic() - self._last_poll >= self._poll_interval.total_seconds():
+            self._receive()
+        url = self._shard.try_pop()
+        if url is None:
+            self._receive()
+            url = self._shard.try_pop()
+        if url is not None:
+            self._in_flight.add(url)
+        return url
+
+    def pop_next(self) -> str:
+        url = self.try_pop()
+        if url is None:
+            raise IndexError('Cannot pop from empty queue')
+        return url
+
+    def retry_delay(self) -> Optional[datetime.timedelta]:
+        delay = self._shard.retry_delay()
+        if delay is not None:
+            # Other shards may send URLs that can be popped sooner.
+            return min(delay, self._poll_interval)
+        if self._crawl_finished():
+            return None
+        return self._poll_interval
+
+    def mark_failed(self, url: str, error: Optional[Exception] = None) -> None:
+        self._in_flight.discard(url)
+        self._shard.mark_failed(url, error)
+
+    def mark_completed(self, url: str) -> None:
+        self._in_flight.discard(url)
+        self._shard.mark_completed(url)
+
+    def flush(self) -> None:
+        self._shard.flush()
+
+    def close(self) -> None:
+        """
+        Closes the logs sent to other shards. The shard's own state manager is left for the caller to close.
+        """
+        for outbox in self._outboxes.values():
+            outbox.close()
+        self._outboxes.clear()
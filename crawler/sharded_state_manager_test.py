@@ -0,0 +1,212 @@
+import datetime
+import queue
+import threading
+from typing import Callable
+
+import pytest
+
+from .crawler import Crawler
+from .crawler_test import FakeHandler, RecordingFetcher
+from .error_handler import ThrowingHandler
+from .file_state_manager import FileStateManager
+from .sharded_state_manager import ShardedStateManager
+from .sqlite_state_manager import SqlStateManager
+
+
+def make_shards(tmp_path, num_shards=2, partition=ShardedStateManager.Partition.URL,
+                poll_interval=datetime.timedelta(seconds=1)):
+    return [ShardedStateManager(SqlStateManager(tmp_path / f'{i}.db'), i, num_shards, tmp_path / 'inbox', partition,
+                                poll_interval)
+            for i in range(num_shards)]
+
+
+def urls_for(shard, index, count=1):
+    """
+    :return: URLs that `shard` assigns to the shard at `index`.
+    """
+    urls = (f'https://a.com/{i}' for i in range(1000))
+    return [url for url in urls if shard.shard_of(url) == index][:count]
+
+
+@pytest.mark.parametrize('num_shards, shard_index', [(0, 0), (2, -1), (2, 2)])
+def test_bad_shard_index(tmp_path, num_shards, shard_index):
+    with pytest.raises(ValueError):
+        ShardedStateManager(SqlStateManager(tmp_path / 'queue.db'), shard_index, num_shards, tmp_path / 'inbox')
+
+
+def test_shard_of_is_stable(tmp_path):
+    a, b = make_shards(tmp_path)
+
+    urls = [f'https://a.com/{i}' for i in range(100)]
+
+    assert [a.shard_of(url) for url in urls] == [b.shard_of(url) for url in urls]
+    assert {a.shard_of(url) for url in urls} == {0, 1}
+
+
+def test_partition_by_host(tmp_path):
+    a, _ = make_shards(tmp_path, partition=ShardedStateManager.Partition.HOST)
+
+    assert len({a.shard_of(f'https://a.com/{i}') for i in range(100)}) == 1
+    assert a.shard_of('https://A.com:8080/') == a.shard_of('https://a.com/')
+
+
+def test_local_urls_stay_local(tmp_path):
+    a, _ = make_shards(tmp_path)
+    url, = urls_for(a, 0)
+
+    a.enqueue(url)
+
+    assert not list((tmp_path / 'inbox').glob('*/from-*.log'))
+    assert a.pop_next() == url
+
+
+def test_remote_urls_sent_to_owning_shard(tmp_path):
+    a, b = make_shards(tmp_path)
+    local = urls_for(a, 0, 2)
+    remote = urls_for(a, 1, 2)
+
+    a.enqueue_many(local + remote)
+
+    assert (tmp_path / 'inbox' / 'shard-1' / 'from-0.log').read_text() == f'{remote[0]}\n{remote[1]}\n'
+    assert not b.is_finished()
+    assert [b.pop_next(), b.pop_next()] == remote
+    for url in remote:
+        b.mark_completed(url)
+    # Shard 0 still has URLs of its own.
+    assert not b.is_finished()
+    assert [a.pop_next(), a.pop_next()] == local
+    for url in local:
+        a.mark_completed(url)
+    assert a.is_finished()
+    assert b.is_finished()
+
+
+def test_partial_line_left_for_later(tmp_path):
+    _, b = make_shards(tmp_path)
+    inbox = tmp_path / 'inbox' / 'shard-1' / 'from-0.log'
+    inbox.write_text('https://a.com/x\nhttps://a.com/')
+
+    assert b.pop_next() == 'https://a.com/x'
+    assert b.try_pop() is None
+
+    with open(inbox, 'a') as f:
+        f.write('y\n')
+    assert b.pop_next() == 'https://a.com/y'
+
+
+def test_inbox_read_once_across_restarts(tmp_path):
+    a, b = make_shards(tmp_path)
+    url, = urls_for(a, 1)
+    a.enqueue(url)
+    b.mark_completed(b.pop_next())
+
+    b2 = ShardedStateManager(SqlStateManager(tmp_path / 'new.db'), 1, 2, tmp_path / 'inbox',
+                             ShardedStateManager.Partition.URL)
+
+    assert b2.try_pop() is None
+    # Shard 0 has not said it is idle yet.
+    assert not b2.is_finished()
+    assert a.is_finished()
+    assert b2.is_finished()
+
+
+def test_inbox_polled_while_busy(tmp_path):
+    a = ShardedStateManager(SqlStateManager(tmp_path / '0.db'), 0, 2, tmp_path / 'inbox',
+                            ShardedStateManager.Partition.URL, poll_interval=datetime.timedelta(0))
+    b = ShardedStateManager(SqlStateManager(tmp_path / '1.db'), 1, 2, tmp_path / 'inbox',
+                            ShardedStateManager.Partition.URL, poll_interval=datetime.timedelta(0))
+    first, second = urls_for(a, 1, 2)
+    b.enqueue(first)
+
+    a.enqueue(second)
+
+    assert b.pop_next() == first
+    assert b.pop_next() == second
+
+
+def test_file_state_manager_shards(tmp_path):
+    shards = [ShardedStateManager(FileStateManager(queue.Queue, tmp_path / f'visited-{i}.log',
+                                                   tmp_path / f'queue-{i}.log', tmp_path / f'counter-{i}.log'),
+                                  i, 2, tmp_path / 'inbox', ShardedStateManager.Partition.URL)
+              for i in range(2)]
+    urls = urls_for(shards[0], 0, 3) + urls_for(shards[0], 1, 3)
+
+    shards[0].enqueue_many(urls)
+    shards[1].enqueue_many(urls)
+
+    popped = []
+    while not all([shard.is_finished() for shard in shards]):
+        for shard in shards:
+            url = shard.try_pop()
+            if url is not None:
+                shard.mark_completed(url)
+                popped.append(url)
+    assert sorted(popped) == sorted(urls)
+
+
+def test_not_finished_while_other_shard_busy(tmp_path):
+    a, b = make_shards(tmp_path)
+    url, = urls_for(a, 1)
+    b.enqueue(url)
+
+    assert not a.is_finished()
+    assert a.retry_delay() == datetime.timedelta(seconds=1)
+    b.mark_completed(b.pop_next())
+    assert b.is_finished()
+    assert a.is_finished()
+    assert a.retry_delay() is None
+
+
+def test_not_finished_while_url_in_flight(tmp_path):
+    a, b = make_shards(tmp_path)
+    url, = urls_for(a, 0)
+    a.enqueue(url)
+    a.pop_next()
+
+    assert not b.is_finished()
+    assert not a.is_finished()
+
+    a.mark_completed(url)
+    assert a.is_finished()
+    assert b.is_finished()
+
+
+def test_not_finished_until_sent_urls_read(tmp_path):
+    a, b = make_shards(tmp_path)
+    assert not b.is_finished()
+    url, = urls_for(a, 1)
+
+    a.enqueue(url)
+
+    assert not a.is_finished()
+    assert b.pop_next() == url
+
+
+def test_not_finished_until_every_shard_started(tmp_path):
+    a = ShardedStateManager(SqlStateManager(tmp_path / '0.db'), 0, 2, tmp_path / 'inbox')
+
+    assert not a.is_finished()
+
+
+def test_crawl_root_owned_by_other_shard(tmp_path):
+    shards = make_shards(tmp_path, poll_interval=datetime.timedelta(milliseconds=10))
+    root, = urls_for(shards[0], 1)
+    links = {0: urls_for(shards[0], 0, 3), 1: urls_for(shards[0], 1, 4)[1:]}
+
+    def handle(content: str, url: str, callback: Callable[[str, str], None]) -> None:
+        if url == root:
+            for link in links[0] + links[1]:
+                callback(url, link)
+
+    fetchers = [RecordingFetcher(), RecordingFetcher()]
+    crawls = [threading.Thread(target=Crawler(fetchers[i], FakeHandler(handle), shards[i], ThrowingHandler()).crawl,
+                               args=([root] if i == 0 else [],), daemon=True)
+              for i in range(2)]
+    for crawl in crawls:
+        crawl.start()
+    for crawl in crawls:
+        crawl.join(timeout=10)
+
+    assert not any(crawl.is_alive() for crawl in crawls)
+    assert sorted(fetchers[0].fetched) == sorted(links[0])
+    assert sorted(fetchers[1].fetched) == sorted([root] + links[1])
@@ -2,83 +2,515 @@ from enum import Enum
 import pathlib
 import sqlite3
 import datetime
+import functools
+import threading
+import time
+from typing import Callable, Iterable, List, NamedTuple, Optional, Set, TypeVar
 
+from .backoff import Backoff, wait_before_retry
+from .fetch_error import HttpStatusError, is_permanent
 from .state_manager import StateManager
+from .url_codec import PrefixCodec
+from .visited_set import VisitedSet
+
+# New URLs go after every pending URL. Unvisited rows are indexed by seq, so finding the last one is cheap.
+_NEXT_SEQ = "(SELECT COALESCE(MAX(seq), 0) + 1 FROM queue WHERE NOT visited)"
+
+# Adds the `url` parameter to the queue, unless it has already failed too often.
+_ENQUEUE = """
+    INSERT {conflict} INTO queue(url, visited, failures, enqueue_time, seq)
+    SELECT :url, false, 0, :now, {next_seq}
+    WHERE NOT EXISTS (SELECT 1 FROM dead_letters WHERE url = :url)
+"""
+_ENQUEUE_NEW = _ENQUEUE.format(conflict='', next_seq=_NEXT_SEQ)
+_ENQUEUE_OR_IGNORE = _ENQUEUE.format(conflict='OR IGNORE', next_seq=_NEXT_SEQ)
+
+# How many rows to re-encode at a time, when new URL prefixes are added.
+_REENCODE_BATCH_SIZE = 10000
+
+_T = TypeVar('_T')
+
+
+def _synchronized(method: Callable[..., _T]) -> Callable[..., _T]:
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs) -> _T:
+        with self._lock:
+            return method(self, *args, **kwargs)
+
+    return wrapper
+
+
+class DeadLetter(NamedTuple):
+    """
+    A URL that failed too many times to be crawled, and why it last failed.
+    """
+    url: str
+    # How many times it was tried.
+    attempts: int
+    # Class of the last exception, if known.
+    error_type: Optional[str]
+    # HTTP status of the last failure, if the server responded with an error.
+    status_code: Optional[int]
+    # Message of the last exception, if known.
+    message: Optional[str]
+    # When it first and last failed.
+    first_failure_time: Optional[datetime.datetime]
+    last_failure_time: datetime.datetime
 
 
 class SqlStateManager(StateManager):
     """
     Maintains crawl state using an embedded SQLite database. This should perform
     reasonably well as there is no inter-process communication and support resuming.
+
+    pop_next() claims a URL by writing a lease to the database, so it is held back
+    from later pops until it is marked completed or failed. Several workers, or
+    several processes with their own instances, can therefore share one database.
+    If a URL is not marked before its lease expires, for example because the
+    crawler died, it is handed out again. Until then, URLs leased by another
+    instance count as waiting to be retried, so a crawler restarted after a crash
+    waits for the URLs it had in flight rather than finishing without them. Safe
+    to share between threads.
+
+    URLs are ordered by an increasing sequence number, and unvisited URLs are kept
+    in a partial index on it, so popping does not slow down as the crawl grows.
+    Databases created before these columns existed are upgraded when opened.
+
+    By default, every change is committed straight away. With group commits, the
+    database uses write-ahead logging, and changes are committed in batches, so a
+    crash may lose the last few of them. A batch is committed once it is big enough
+    or old enough, even if the crawl is idle. Call flush() or close() when finished
+    to make sure nothing is lost. A batch holds the database's write lock, so other
+    processes sharing the database wait for it to be committed.
+
+    Given a persistent VisitedSet, completed URLs are moved out of the database and
+    into the set, so that the database only grows with the queue. Processes sharing
+    the database should share the set's file too.
+
+    URLs are stored with common prefixes, such as the site's address, replaced by
+    a number from the prefixes table. This keeps the table and its index several
+    times smaller. Prefixes are never removed, and URLs already stored are
+    rewritten when new prefixes are added, so each URL has only one stored form.
+
+    Given a Backoff, a URL that fails is not popped again until its backoff has
+    passed, which is stored in the database. Until then, pops skip it, and
+    retry_delay() says how long it has left. Failures the fetcher says are
+    permanent are not retried, and waits the server asks for are always kept to.
+
+    URLs that fail too many times are moved from the queue to a dead letter table,
+    which records the last error, so that the queue only holds URLs still to be
+    crawled. Use dead_letters() to see why they failed, and requeue_dead_letters()
+    to try them again, for example once a site is back up.
     """
 
     SortOrder = Enum('SortOrder', ['FIFO', 'LIFO'])
+    Durability = Enum('Durability', ['FULL', 'GROUP_COMMIT'])
 
     def __init__(self,
                  database_path: pathlib.Path,
                  sort_order: SortOrder = SortOrder.FIFO,
-                 max_failures_per_url: int = 3):
+                 max_failures_per_url: int = 3,
+                 lease: datetime.timedelta = datetime.timedelta(minutes=10),
+                 durability: Durability = Durability.FULL,
+                 commit_every: int = 100,
+                 commit_interval: datetime.timedelta = datetime.timedelta(milliseconds=200),
+                 visited_set: Optional[VisitedSet] = None,
+                 url_prefixes: Iterable[str] = (),
+                 backoff: Optional[Backoff] = None):
+        """
+        :param database_path: Where to keep the queue. Created if it does not exist.
+        :param sort_order: Which URL to pop next.
+        :param max_failures_per_url: How many times to try crawling a URL before giving up on it.
+        :param lease: How long a popped URL is held back from other pops, if it is not marked.
+        :param durability: Whether to commit every change straight away, or in batches.
+        :param commit_every: With group commits, the most changes to batch together.
+        :param commit_interval: With group commits, the longest a change waits to be committed.
+        :param visited_set: Where to remember completed URLs. Defaults to keeping them in the database.
+        :param url_prefixes: Prefixes shared by many URLs, to store compactly. Added to any already in the database.
+        :param backoff: How long to wait before popping a URL again after it fails. Defaults to not waiting.
+        """
+        if commit_every < 1:
+            raise ValueError(f'Need to commit at least every change, got {commit_every}')
+        if visited_set is not None and not visited_set.persistent:
+            raise ValueError('Visited set must be persistent, or completed URLs would be forgotten on restart')
+        self._visited_set = visited_set
         self._sort_order = sort_order
         self._max_failures_per_url = max_failures_per_url
-        self._db = sqlite3.connect(database_path)
+        self._lease = lease
+        # Stored forms of URLs this instance has leased and not yet marked.
+        self._leased: Set[str] = set()
+        self._backoff = backoff
+        self._durability = durability
+        self._commit_every = commit_every
+        self._commit_interval = commit_interval
+        # Changes not yet committed, and when the first of them was made.
+        self._uncommitted = 0
+        self._uncommitted_since = 0.0
+        # Commits the current batch once it is old enough.
+        self._commit_timer: Optional[threading.Timer] = None
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(database_path, check_same_thread=False)
+        if durability == SqlStateManager.Durability.GROUP_COMMIT:
+            # Readers don't block the writer, and the log is only synced at checkpoints. A crash can lose
+            # recent commits, but can't corrupt the database.
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
         self._db.execute("""
             CREATE TABLE IF NOT EXISTS queue (
               url string PRIMARY KEY,
               visited boolean NOT NULL,
               failures smallint NOT NULL,
-              enqueue_time timestamp NOT NULL
+              enqueue_time timestamp NOT NULL,
+              in_progress_until real,
+              seq integer,
+              not_before real,
+              first_failure_time timestamp
+            )""")
+        columns = [row[1] for row in self._db.execute("PRAGMA table_info(queue)")]
+        if 'in_progress_until' not in columns:
+            # Databases from before leases were added.
+            self._db.execute("ALTER TABLE queue ADD COLUMN in_progress_until real")
+        if 'seq' not in columns:
+            # Databases from before sequence numbers were added were ordered by enqueue time.
+            self._db.execute("ALTER TABLE queue ADD COLUMN seq integer")
+            self._db.execute("""
+                UPDATE queue
+                SET seq = ordered.seq
+                FROM (
+                    SELECT rowid AS id, ROW_NUMBER() OVER (ORDER BY enqueue_time, rowid) AS seq
+                    FROM queue
+                ) AS ordered
+                WHERE queue.rowid = ordered.id
+            """)
+        if 'not_before' not in columns:
+            # Databases from before backoff was added. Their index doesn't cover the new column.
+            self._db.execute("ALTER TABLE queue ADD COLUMN not_before real")
+            self._db.execute("DROP INDEX IF EXISTS queue_pending")
+        if 'first_failure_time' not in columns:
+            # Databases from before dead letters were added.
+            self._db.execute("ALTER TABLE queue ADD COLUMN first_failure_time timestamp")
+        # Covers everything pop_next() filters on, so it never needs to read the table itself. SQLite only treats
+        # the index as covering if it includes visited, even though that is always false here.
+        self._db.execute("""
+            CREATE INDEX IF NOT EXISTS queue_pending
+            ON queue(seq, failures, in_progress_until, not_before, visited)
+            WHERE NOT visited
+        """)
+        # Only URLs waiting to be retried, so finding the next of them is cheap.
+        self._db.execute("""
+            CREATE INDEX IF NOT EXISTS queue_retries
+            ON queue(not_before)
+            WHERE not_before IS NOT NULL AND NOT visited
+        """)
+        # Only URLs that are leased, so finding the next lease to expire is cheap.
+        self._db.execute("""
+            CREATE INDEX IF NOT EXISTS queue_leases
+            ON queue(in_progress_until)
+            WHERE in_progress_until IS NOT NULL AND NOT visited
+        """)
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS dead_letters (
+              url string PRIMARY KEY,
+              attempts smallint NOT NULL,
+              error_type text,
+              status_code integer,
+              message text,
+              first_failure_time timestamp,
+              last_failure_time timestamp NOT NULL
             )""")
+        # URLs that failed too often before dead letters were added, or before the limit was lowered.
+        self._db.execute("""
+            INSERT OR IGNORE INTO dead_letters(url, attempts, first_failure_time, last_failure_time)
+            SELECT url, failures, first_failure_time, enqueue_time
+            FROM queue
+            WHERE NOT visited AND failures >= ?
+        """, (max_failures_per_url,))
+        self._db.execute("DELETE FROM queue WHERE NOT visited AND failures >= ?", (max_failures_per_url,))
+        # Databases from before prefixes were added store URLs as they are, even ones that look encoded.
+        stored_raw = self._db.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'prefixes'").fetchone() is None
+        self._db.execute("CREATE TABLE IF NOT EXISTS prefixes (id integer PRIMARY KEY, prefix text UNIQUE NOT NULL)")
+        self._codec = self._add_prefixes(url_prefixes, stored_raw)
         self._db.commit()
 
+    def _add_prefixes(self, url_prefixes: Iterable[str], stored_raw: bool) -> PrefixCodec:
+        """
+        Adds prefixes that are not in the database yet, and rewrites stored URLs to use them.
+        :param url_prefixes: Prefixes to add.
+        :param stored_raw: Whether stored URLs are not encoded at all yet, rather than encoded with the old prefixes.
+        :return: Codec for every prefix in the database.
+        """
+        old_codec = PrefixCodec(dict(self._db.execute("SELECT id, prefix FROM prefixes")))
+        new_prefixes = [prefix for prefix in dict.fromkeys(url_prefixes) if prefix not in old_codec.prefixes.values()]
+        if not new_prefixes and not stored_raw:
+            return old_codec
+        old_decode = str if stored_raw else old_codec.decode
+        self._db.executemany("INSERT INTO prefixes(prefix) VALUES(?)", ((prefix,) for prefix in new_prefixes))
+        codec = PrefixCodec(dict(self._db.execute("SELECT id, prefix FROM prefixes")))
+        # Numbers never change meaning, so a URL's new form can't clash with another URL's old form part way through.
+        for table in ['queue', 'dead_letters']:
+            last_rowid = 0
+            while True:
+                rows = self._db.execute(f"SELECT rowid, url FROM {table} WHERE rowid > ? ORDER BY rowid LIMIT ?",
+                                        (last_rowid, _REENCODE_BATCH_SIZE)).fetchall()
+                if not rows:
+                    break
+                last_rowid = rows[-1][0]
+                updates = []
+                for rowid, stored in rows:
+                    encoded = codec.encode(old_decode(str(stored)))
+                    if encoded != stored:
+                        updates.append((encoded, rowid))
+                self._db.executemany(f"UPDATE {table} SET url = ? WHERE rowid = ?", updates)
+        return codec
+
+    def _commit(self) -> None:
+        if self._durability == SqlStateManager.Durability.FULL:
+            self._db.commit()
+            return
+        now = time.monotonic()
+        if not self._uncommitted:
+            self._uncommitted_since = now
+            self._commit_timer = threading.Timer(self._commit_interval.total_seconds(), self._commit_batch)
+            self._commit_timer.daemon = True
+            self._commit_timer.start()
+        self._uncommitted += 1
+        if (self._uncommitted >= self._commit_every
+                or now - self._uncommitted_since >= self._commit_interval.total_seconds()):
+            self.flush()
+
+    @_synchronized
+    def _commit_batch(self) -> None:
+        # The batch may have been committed already, by the time the timer gets the lock.
+        if self._uncommitted:
+            self.flush()
+
+    @_synchronized
+    def flush(self) -> None:
+        if self._commit_timer is not None:
+            self._commit_timer.cancel()
+            self._commit_timer = None
+        self._db.commit()
+        self._uncommitted = 0
+        if self._visited_set is not None:
+            self._visited_set.flush()
+
+    @_synchronized
+    def close(self) -> None:
+        """
+        Commits any outstanding changes, and closes the database.
+        """
+        self.flush()
+        self._db.close()
+
+    @_synchronized
     def is_finished(self) -> bool:
-        try:
-            self.pop_next()
-            return False
-        except IndexError:
-            return True
+        return self._peek() is None and self.retry_delay() is None
+
+    @_synchronized
+    def retry_delay(self) -> Optional[datetime.timedelta]:
+        res = self._db.execute(
+            "SELECT MIN(not_before) FROM queue WHERE not_before IS NOT NULL AND NOT visited").fetchone()
+        until = res[0]
+        # URLs leased elsewhere are waiting too, until they are marked or their lease expires. The lease may be
+        # held by another process, or by a crawler that crashed, in which case the URL must be crawled again. URLs
+        # leased here are left to whoever popped them.
+        leases = self._db.execute(
+            "SELECT url, in_progress_until FROM queue WHERE in_progress_until IS NOT NULL AND NOT visited "
+            "ORDER BY in_progress_until")
+        for stored, in_progress_until in leases:
+            if stored not in self._leased:
+                until = in_progress_until if until is None else min(until, in_progress_until)
+                break
+        if until is None:
+            return None
+        return datetime.timedelta(seconds=max(0.0, until - time.time()))
 
+    @_synchronized
     def enqueue(self, url: str) -> None:
+        if self._visited_set is not None and url in self._visited_set:
+            return
         try:
-            self._db.execute("INSERT INTO queue VALUES(?, ?, ?, ?)",
-                             (url, False, 0, datetime.datetime.now()))
-            self._db.commit()
+            self._db.execute(_ENQUEUE_NEW, {'url': self._codec.encode(url), 'now': SqlStateManager._now()})
+            self._commit()
         except sqlite3.IntegrityError:
             pass
 
+    @_synchronized
+    def enqueue_many(self, urls: Iterable[str]) -> None:
+        # One transaction, so we only wait for the disk once.
+        now = SqlStateManager._now()
+        if self._visited_set is not None:
+            urls = [url for url in urls if url not in self._visited_set]
+        self._db.executemany(_ENQUEUE_OR_IGNORE,
+                             ({'url': self._codec.encode(url), 'now': now} for url in urls))
+        self._commit()
+
+    @staticmethod
+    def _now() -> str:
+        # Written out explicitly, since sqlite3's default datetime adapter is deprecated.
+        return datetime.datetime.now().isoformat(' ')
+
     def _sortorder(self) -> str:
         if self._sort_order == SqlStateManager.SortOrder.FIFO:
             return "ASC"
         if self._sort_order == SqlStateManager.SortOrder.LIFO:
             return "DESC"
 
-    def pop_next(self) -> str:
-        res = self._db.execute(f"""
-            SELECT url
+    def _next_query(self) -> str:
+        """
+        :return: Query for the rowid of the next URL to pop, given the current time as the `now` parameter.
+        """
+        return f"""
+            SELECT rowid
             FROM queue
             WHERE
                 (NOT visited)
                 AND failures < {self._max_failures_per_url}
-            ORDER BY enqueue_time {self._sortorder()}
+                AND (in_progress_until IS NULL OR in_progress_until <= :now)
+                AND (not_before IS NULL OR not_before <= :now)
+            ORDER BY seq {self._sortorder()}
             LIMIT 1
-        """).fetchone()
+        """
+
+    def _peek(self) -> Optional[str]:
+        res = self._db.execute(f"SELECT url FROM queue WHERE rowid = ({self._next_query()})",
+                               {'now': time.time()}).fetchone()
         if res:
-            return res[0]
-        raise IndexError('Cannot pop from empty queue')
+            return self._codec.decode(res[0])
+        return None
 
-    def mark_failed(self, url) -> None:
-        self._db.execute("""
+    @_synchronized
+    def try_pop(self) -> Optional[str]:
+        # Finding and claiming the URL in one statement means no other connection can claim it in between.
+        now = time.time()
+        res = self._db.execute(f"""
+            UPDATE queue
+            SET in_progress_until = :until, not_before = NULL
+            WHERE rowid = ({self._next_query()})
+            RETURNING url
+        """, {'until': now + self._lease.total_seconds(), 'now': now}).fetchone()
+        self._commit()
+        if res:
+            self._leased.add(res[0])
+            return self._codec.decode(res[0])
+        return None
+
+    @_synchronized
+    def pop_next(self) -> str:
+        url = self.try_pop()
+        if url is None:
+            raise IndexError('Cannot pop from empty queue')
+        return url
+
+    @_synchronized
+    def mark_failed(self, url: str, error: Optional[Exception] = None) -> None:
+        now = SqlStateManager._now()
+        self._leased.discard(self._codec.encode(url))
+        res = self._db.execute(f"""
             UPDATE queue
             SET
                 failures = failures + 1,
-                enqueue_time = ?
+                enqueue_time = ?,
+                in_progress_until = NULL,
+                seq = {_NEXT_SEQ},
+                first_failure_time = COALESCE(first_failure_time, ?)
             WHERE url = ?
-        """, (datetime.datetime.now(), url))
-        self._db.commit()
+            RETURNING rowid, url, failures, first_failure_time
+        """, (now, now, self._codec.encode(url))).fetchone()
+        if not res:
+            self._commit()
+            return
+        rowid, stored, failures, first_failure_time = res
+        # Permanent failures aren't worth trying again, however few times they have been tried.
+        if failures >= self._max_failures_per_url or is_permanent(error):
+            self._db.execute("""
+                INSERT OR REPLACE INTO dead_letters(
+                    url, attempts, error_type, status_code, message, first_failure_time, last_failure_time)
+                VALUES(?, ?, ?, ?, ?, ?, ?)
+            """, (stored, failures, type(error).__name__ if error is not None else None,
+                  error.status_code if isinstance(error, HttpStatusError) else None,
+                  str(error) if error is not None else None, first_failure_time, now))
+            self._db.execute("DELETE FROM queue WHERE rowid = ?", (rowid,))
+        else:
+            wait = wait_before_retry(self._backoff, failures, error)
+            if wait is not None:
+                self._db.execute("UPDATE queue SET not_before = ? WHERE rowid = ?",
+                                 (time.time() + wait.total_seconds(), rowid))
+        self._commit()
 
+    @_synchronized
     def mark_completed(self, url: str) -> None:
+        self._leased.discard(self._codec.encode(url))
+        if self._visited_set is not None:
+            # Remember the URL before forgetting its row. If we crash in between, it is only crawled again.
+            self._visited_set.add(url)
+            self._db.execute("DELETE FROM queue WHERE url = ?", (self._codec.encode(url),))
+            self._commit()
+            return
         self._db.execute("""
                         UPDATE queue
-                        SET visited = true
+                        SET
+                            visited = true,
+                            in_progress_until = NULL
                         WHERE url = ?
-                    """, (url,))
-        self._db.commit()
+                    """, (self._codec.encode(url),))
+        self._commit()
+
+    def _find_dead_letters(self,
+                           error_type: Optional[str],
+                           status_code: Optional[int],
+                           url_prefix: Optional[str]) -> List[DeadLetter]:
+        rows = self._db.execute("""
+            SELECT url, attempts, error_type, status_code, message, first_failure_time, last_failure_time
+            FROM dead_letters
+            WHERE
+                (:error_type IS NULL OR error_type = :error_type)
+                AND (:status_code IS NULL OR status_code = :status_code)
+            ORDER BY last_failure_time
+        """, {'error_type': error_type, 'status_code': status_code})
+        letters = []
+        for url, attempts, error, status, message, first, last in rows:
+            url = self._codec.decode(url)
+            # Stored URLs may use different prefixes to the one asked for, so compare them in full.
+            if url_prefix is None or url.startswith(url_prefix):
+                letters.append(DeadLetter(url, attempts, error, status, message,
+                                          datetime.datetime.fromisoformat(first) if first else None,
+                                          datetime.datetime.fromisoformat(last)))
+        return letters
+
+    @_synchronized
+    def dead_letters(self,
+                     error_type: Optional[str] = None,
+                     status_code: Optional[int] = None,
+                     url_prefix: Optional[str] = None) -> List[DeadLetter]:
+        """
+        Lists URLs that failed too many times, oldest first, optionally only those matching every filter given.
+        :param error_type: Class name of the last exception, such as `HttpStatusError`.
+        :param status_code: HTTP status of the last failure.
+        :param url_prefix: Start of the URL.
+        :return: The matching URLs, with why they last failed.
+        """
+        return self._find_dead_letters(error_type, status_code, url_prefix)
+
+    @_synchronized
+    def requeue_dead_letters(self,
+                             error_type: Optional[str] = None,
+                             status_code: Optional[int] = None,
+                             url_prefix: Optional[str] = None) -> int:
+        """
+        Puts URLs that failed too many times back at the end of the queue, with no failures, optionally only those
+        matching every filter given.
+        :param error_type: Class name of the last exception, such as `HttpStatusError`.
+        :param status_code: HTTP status of the last failure.
+        :param url_prefix: Start of the URL.
+        :return: How many URLs were requeued.
+        """
+        letters = self._find_dead_letters(error_type, status_code, url_prefix)
+        now = SqlStateManager._now()
+        stored = [self._codec.encode(letter.url) for letter in letters]
+        self._db.executemany("DELETE FROM dead_letters WHERE url = ?", ((url,) for url in stored))
+        self._db.executemany(_ENQUEUE_OR_IGNORE,
+                             ({'url': url, 'now': now} for url in stored))
+        self._commit()
+        return len(letters)
@@ -1,8 +1,16 @@
+import concurrent.futures
+import datetime
 import sqlite3
+import threading
+import time
+import warnings
 
 import pytest
 
-from .sqlite_state_manager import SqlStateManager
+from .backoff import Backoff
+from .fetch_error import HttpStatusError
+from .sqlite_state_manager import DeadLetter, SqlStateManager
+from .visited_set import BloomFilter
 
 
 def test_bad_database_path(tmp_path):
@@ -152,13 +160,51 @@ def test_can_restore_from_disk(tmp_path):
     assert m5.pop_next() == 'd'
 
 
-def test_do_not_update_disk_on_pop(tmp_path):
+def test_pop_claims_url_on_disk(tmp_path):
     db_path = tmp_path / "queue.db"
     m = SqlStateManager(db_path)
     m.enqueue('a')
 
     m.pop_next()
 
+    m2 = SqlStateManager(db_path)
+    assert not m2.is_finished()
+    assert m2.retry_delay() > datetime.timedelta(minutes=9)
+    with pytest.raises(IndexError, match="empty queue"):
+        m2.pop_next()
+
+
+def test_own_lease_is_not_waited_for(tmp_path):
+    m = SqlStateManager(tmp_path / "queue.db")
+    m.enqueue('a')
+
+    m.pop_next()
+
+    assert m.retry_delay() is None
+    assert m.is_finished()
+
+
+def test_pop_again_after_lease_expires(tmp_path):
+    db_path = tmp_path / "queue.db"
+    m = SqlStateManager(db_path, lease=datetime.timedelta(seconds=0.1))
+    m.enqueue('a')
+    m.pop_next()
+    assert m.is_finished()
+
+    time.sleep(0.1)
+
+    m2 = SqlStateManager(db_path)
+    assert not m2.is_finished()
+    assert m2.pop_next() == 'a'
+
+
+def test_restart_with_zero_lease_picks_up_in_progress(tmp_path):
+    db_path = tmp_path / "queue.db"
+    m = SqlStateManager(db_path, lease=datetime.timedelta(0))
+    m.enqueue('a')
+
+    m.pop_next()
+
     m2 = SqlStateManager(db_path)
     assert m2.pop_next() == 'a'
 
@@ -186,3 +232,723 @@ def test_update_disk_on_mark_failed(tmp_path):
     m2 = SqlStateManager(db_path, max_failures_per_url=1)
     with pytest.raises(IndexError, match="empty queue"):
         m2.pop_next()
+
+
+def test_pop_skips_in_progress(tmp_path):
+    m = SqlStateManager(tmp_path / "queue.db")
+    m.enqueue('a')
+    m.enqueue('b')
+
+    assert m.pop_next() == 'a'
+    assert m.pop_next() == 'b'
+    assert m.is_finished()
+    with pytest.raises(IndexError, match="empty queue"):
+        m.pop_next()
+
+
+def test_in_progress_page_returns_after_failure(tmp_path):
+    m = SqlStateManager(tmp_path / "queue.db")
+    m.enqueue('a')
+    m.pop_next()
+    m.mark_failed('a')
+
+    assert not m.is_finished()
+    assert m.pop_next() == 'a'
+
+
+def test_can_use_from_other_thread(tmp_path):
+    m = SqlStateManager(tmp_path / "queue.db")
+    t = threading.Thread(target=m.enqueue, args=('a',))
+    t.start()
+    t.join()
+
+    assert m.pop_next() == 'a'
+
+
+def test_enqueue_many_and_pop(tmp_path):
+    m = SqlStateManager(tmp_path / "queue.db")
+    m.enqueue_many(['a', 'b', 'c'])
+
+    assert m.pop_next() == 'a'
+    assert m.pop_next() == 'b'
+    assert m.pop_next() == 'c'
+
+
+def test_enqueue_many_and_pop_lifo(tmp_path):
+    m = SqlStateManager(tmp_path / "queue.db", sort_order=SqlStateManager.SortOrder.LIFO)
+    m.enqueue_many(['a', 'b', 'c'])
+
+    assert m.pop_next() == 'c'
+    assert m.pop_next() == 'b'
+    assert m.pop_next() == 'a'
+
+
+def test_enqueue_many_skips_known_urls(tmp_path):
+    m = SqlStateManager(tmp_path / "queue.db")
+    m.enqueue('a')
+    m.pop_next()
+    m.mark_completed('a')
+    m.enqueue('b')
+
+    m.enqueue_many(['a', 'b', 'c', 'c'])
+
+    assert m.pop_next() == 'b'
+    assert m.pop_next() == 'c'
+    with pytest.raises(IndexError, match="empty queue"):
+        m.pop_next()
+
+
+def test_enqueue_many_commits_once(tmp_path):
+    m = SqlStateManager(tmp_path / "queue.db")
+    statements = []
+    m._db.set_trace_callback(statements.append)
+
+    m.enqueue_many(['a', 'b', 'c'])
+
+    assert statements.count('COMMIT') == 1
+    m2 = SqlStateManager(tmp_path / "queue.db")
+    assert m2.pop_next() == 'a'
+
+
+def test_mark_completed_releases_lease(tmp_path):
+    db_path = tmp_path / "queue.db"
+    m = SqlStateManager(db_path)
+    m.enqueue('a')
+    m.pop_next()
+    m.mark_completed('a')
+
+    in_progress_until, = sqlite3.connect(db_path).execute("SELECT in_progress_until FROM queue").fetchone()
+    assert in_progress_until is None
+
+
+def test_mark_failed_releases_lease(tmp_path):
+    db_path = tmp_path / "queue.db"
+    m = SqlStateManager(db_path)
+    m.enqueue('a')
+    m.pop_next()
+    m.mark_failed('a')
+
+    m2 = SqlStateManager(db_path)
+    assert m2.pop_next() == 'a'
+
+
+def test_instances_sharing_database_never_pop_same_url(tmp_path):
+    db_path = tmp_path / "queue.db"
+    urls = [f'url{i}' for i in range(200)]
+    SqlStateManager(db_path).enqueue_many(urls)
+
+    def drain():
+        m = SqlStateManager(db_path)
+        popped = []
+        while True:
+            try:
+                popped.append(m.pop_next())
+            except IndexError:
+                return popped
+
+    with concurrent.futures.ThreadPoolExecutor(4) as executor:
+        results = [executor.submit(drain) for _ in range(4)]
+        popped = [url for result in results for url in result.result()]
+
+    assert sorted(popped) == sorted(urls)
+
+
+def test_adds_lease_column_to_old_database(tmp_path):
+    db_path = tmp_path / "queue.db"
+    db = sqlite3.connect(db_path)
+    db.execute("""
+        CREATE TABLE queue (
+          url string PRIMARY KEY,
+          visited boolean NOT NULL,
+          failures smallint NOT NULL,
+          enqueue_time timestamp NOT NULL
+        )""")
+    db.execute("INSERT INTO queue VALUES('a', false, 0, '2023-01-01 00:00:00')")
+    db.commit()
+    db.close()
+
+    m = SqlStateManager(db_path)
+    assert m.pop_next() == 'a'
+    assert m.is_finished()
+
+
+def test_try_pop(tmp_path):
+    m = SqlStateManager(tmp_path / "queue.db")
+    m.enqueue_many(['a', 'b'])
+
+    assert m.try_pop() == 'a'
+    assert m.try_pop() == 'b'
+    assert m.try_pop() is None
+
+
+def test_try_pop_is_one_query(tmp_path):
+    m = SqlStateManager(tmp_path / "queue.db")
+    m.enqueue('a')
+    statements = []
+    m._db.set_trace_callback(statements.append)
+
+    m.try_pop()
+
+    assert len([statement for statement in statements if 'FROM queue' in statement]) == 1
+
+
+@pytest.mark.parametrize("sort_order", list(SqlStateManager.SortOrder))
+def test_pop_uses_pending_index(tmp_path, sort_order):
+    m = SqlStateManager(tmp_path / "queue.db", sort_order=sort_order)
+    m.enqueue_many(['a', 'b', 'c'])
+
+    plan = [row[3] for row in m._db.execute(f"EXPLAIN QUERY PLAN {m._next_query()}", {"now": 0})]
+
+    assert plan == ['SCAN queue USING COVERING INDEX queue_pending']
+
+
+def test_failed_url_goes_to_back_of_queue(tmp_path):
+    m = SqlStateManager(tmp_path / "queue.db")
+    m.enqueue_many(['a', 'b'])
+    m.pop_next()
+    m.mark_failed('a')
+    m.enqueue('c')
+
+    assert m.pop_next() == 'b'
+    assert m.pop_next() == 'a'
+    assert m.pop_next() == 'c'
+
+
+def test_sequence_continues_after_everything_visited(tmp_path):
+    m = SqlStateManager(tmp_path / "queue.db")
+    m.enqueue('a')
+    m.pop_next()
+    m.mark_completed('a')
+
+    m.enqueue_many(['b', 'c'])
+
+    assert m.pop_next() == 'b'
+    assert m.pop_next() == 'c'
+
+
+def test_does_not_use_default_datetime_adapter(tmp_path):
+    m = SqlStateManager(tmp_path / "queue.db")
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('error', DeprecationWarning)
+        m.enqueue('a')
+        m.enqueue_many(['b'])
+        m.pop_next()
+        m.mark_failed('a')
+
+
+def test_migrates_old_database_in_enqueue_order(tmp_path):
+    db_path = tmp_path / "queue.db"
+    db = sqlite3.connect(db_path)
+    db.execute("""
+        CREATE TABLE queue (
+          url string PRIMARY KEY,
+          visited boolean NOT NULL,
+          failures smallint NOT NULL,
+          enqueue_time timestamp NOT NULL
+        )""")
+    db.executemany("INSERT INTO queue VALUES(?, ?, ?, ?)", [
+        ('c', False, 0, '2023-01-03 00:00:00'),
+        ('done', True, 0, '2023-01-01 00:00:00'),
+        ('a', False, 0, '2023-01-01 00:00:00'),
+        ('b2', False, 1, '2023-01-02 00:00:00'),
+        ('b1', False, 0, '2023-01-02 00:00:00'),
+    ])
+    db.commit()
+    db.close()
+
+    m = SqlStateManager(db_path)
+    m.enqueue('d')
+
+    assert [m.pop_next() for _ in range(5)] == ['a', 'b2', 'b1', 'c', 'd']
+    assert m.is_finished()
+
+
+def test_invalid_commit_every(tmp_path):
+    with pytest.raises(ValueError, match='at least every change'):
+        SqlStateManager(tmp_path / "queue.db", commit_every=0)
+
+
+def test_group_commit_uses_wal(tmp_path):
+    m = SqlStateManager(tmp_path / "queue.db", durability=SqlStateManager.Durability.GROUP_COMMIT)
+
+    assert m._db.execute("PRAGMA journal_mode").fetchone() == ('wal',)
+    assert m._db.execute("PRAGMA synchronous").fetchone() == (1,)  # NORMAL
+
+
+def test_group_commit_every_n_changes(tmp_path):
+    db_path = tmp_path / "queue.db"
+    m = SqlStateManager(db_path, durability=SqlStateManager.Durability.GROUP_COMMIT, commit_every=3,
+                        commit_interval=datetime.timedelta(hours=1))
+    reader = sqlite3.connect(db_path)
+
+    m.enqueue('a')
+    m.enqueue('b')
+    assert reader.execute("SELECT COUNT(*) FROM queue").fetchone() == (0,)
+
+    m.enqueue('c')
+    assert reader.execute("SELECT COUNT(*) FROM queue").fetchone() == (3,)
+
+
+def test_group_commit_after_interval(tmp_path):
+    db_path = tmp_path / "queue.db"
+    m = SqlStateManager(db_path, durability=SqlStateManager.Durability.GROUP_COMMIT, commit_every=100,
+                        commit_interval=datetime.timedelta(seconds=0.2))
+    reader = sqlite3.connect(db_path)
+
+    m.enqueue('a')
+    assert reader.execute("SELECT COUNT(*) FROM queue").fetchone() == (0,)
+
+    time.sleep(0.4)
+    assert reader.execute("SELECT COUNT(*) FROM queue").fetchone() == (1,)
+
+
+def test_group_commit_flush(tmp_path):
+    db_path = tmp_path / "queue.db"
+    m = SqlStateManager(db_path, durability=SqlStateManager.Durability.GROUP_COMMIT)
+    m.enqueue_many(['a', 'b'])
+    m.pop_next()
+    m.mark_completed('a')
+
+    m.flush()
+
+    m2 = SqlStateManager(db_path)
+    assert m2.pop_next() == 'b'
+    assert m2.is_finished()
+
+
+def test_group_commit_close(tmp_path):
+    db_path = tmp_path / "queue.db"
+    m = SqlStateManager(db_path, durability=SqlStateManager.Durability.GROUP_COMMIT)
+    m.enqueue('a')
+
+    m.close()
+
+    assert SqlStateManager(db_path).pop_next() == 'a'
+
+
+def test_group_commit_lost_without_flush(tmp_path):
+    db_path = tmp_path / "queue.db"
+    m = SqlStateManager(db_path, durability=SqlStateManager.Durability.GROUP_COMMIT)
+    m.enqueue('a')
+
+    m._db.rollback()  # As if the process had crashed.
+
+    assert SqlStateManager(db_path).is_finished()
+
+
+def test_full_durability_commits_every_change(tmp_path):
+    db_path = tmp_path / "queue.db"
+    m = SqlStateManager(db_path)
+    reader = sqlite3.connect(db_path)
+
+    m.enqueue('a')
+
+    assert reader.execute("SELECT COUNT(*) FROM queue").fetchone() == (1,)
+
+
+def test_group_commit_shared_between_threads(tmp_path):
+    db_path = tmp_path / "queue.db"
+    m = SqlStateManager(db_path, durability=SqlStateManager.Durability.GROUP_COMMIT,
+                        commit_interval=datetime.timedelta(milliseconds=1))
+    urls = [f'url{i}' for i in range(100)]
+
+    with concurrent.futures.ThreadPoolExecutor(4) as executor:
+        list(executor.map(m.enqueue, urls))
+    m.close()
+
+    assert sorted(SqlStateManager(db_path).try_pop() for _ in urls) == sorted(urls)
+
+
+def test_visited_set_must_be_persistent(tmp_path):
+    with pytest.raises(ValueError, match='persistent'):
+        SqlStateManager(tmp_path / "queue.db", visited_set=BloomFilter(1000))
+
+
+def test_visited_set_replaces_visited_rows(tmp_path):
+    db_path = tmp_path / "queue.db"
+    visited = BloomFilter(1000, path=tmp_path / "visited.bloom")
+    m = SqlStateManager(db_path, visited_set=visited)
+    m.enqueue_many(['a', 'b'])
+    m.mark_completed(m.pop_next())
+
+    m.enqueue('a')
+    m.enqueue_many(['a', 'c'])
+
+    assert 'a' in visited
+    assert sqlite3.connect(db_path).execute("SELECT url FROM queue ORDER BY seq").fetchall() == [('b',), ('c',)]
+    assert m.pop_next() == 'b'
+    assert m.pop_next() == 'c'
+    assert m.is_finished()
+
+
+def test_visited_set_survives_restart(tmp_path):
+    db_path = tmp_path / "queue.db"
+    bloom_path = tmp_path / "visited.bloom"
+    m = SqlStateManager(db_path, visited_set=BloomFilter(1000, path=bloom_path))
+    m.enqueue('a')
+    m.mark_completed(m.pop_next())
+    m.close()
+
+    m2 = SqlStateManager(db_path, visited_set=BloomFilter(1000, path=bloom_path))
+    m2.enqueue('a')
+
+    assert m2.is_finished()
+
+
+def test_visited_set_with_old_visited_rows(tmp_path):
+    db_path = tmp_path / "queue.db"
+    m = SqlStateManager(db_path)
+    m.enqueue('a')
+    m.mark_completed(m.pop_next())
+
+    m2 = SqlStateManager(db_path, visited_set=BloomFilter(1000, path=tmp_path / "visited.bloom"))
+    m2.enqueue('a')
+
+    assert m2.is_finished()
+
+
+def test_url_prefixes_stored_compactly(tmp_path):
+    db_path = tmp_path / "queue.db"
+    m = SqlStateManager(db_path, url_prefixes=['https://a.com/'])
+    m.enqueue_many(['https://a.com/x', 'https://b.com/y', '1'])
+
+    assert sqlite3.connect(db_path).execute("SELECT url FROM queue ORDER BY seq").fetchall() == \
+           [('1:x',), ('https://b.com/y',), (':1',)]
+    assert m.pop_next() == 'https://a.com/x'
+    assert m.pop_next() == 'https://b.com/y'
+    assert m.pop_next() == '1'
+
+
+def test_url_prefixes_deduplicate(tmp_path):
+    m = SqlStateManager(tmp_path / "queue.db", url_prefixes=['https://a.com/'])
+    m.enqueue('https://a.com/x')
+    m.mark_completed(m.pop_next())
+
+    m.enqueue_many(['https://a.com/x', 'https://a.com/y'])
+
+    assert m.pop_next() == 'https://a.com/y'
+    assert m.is_finished()
+
+
+def test_url_prefixes_mark_failed(tmp_path):
+    m = SqlStateManager(tmp_path / "queue.db", max_failures_per_url=1, url_prefixes=['https://a.com/'])
+    m.enqueue('https://a.com/x')
+
+    m.mark_failed(m.pop_next())
+
+    assert m.is_finished()
+
+
+def test_url_prefixes_added_to_existing_database(tmp_path):
+    db_path = tmp_path / "queue.db"
+    m = SqlStateManager(db_path, url_prefixes=['https://a.com/'])
+    m.enqueue_many(['https://a.com/x', 'https://a.com/b/y'])
+    m.mark_completed(m.pop_next())
+    m.close()
+
+    m2 = SqlStateManager(db_path, url_prefixes=['https://a.com/b/'])
+    m2.enqueue_many(['https://a.com/x', 'https://a.com/b/y'])
+
+    assert sqlite3.connect(db_path).execute("SELECT id, prefix FROM prefixes").fetchall() == \
+           [(1, 'https://a.com/'), (2, 'https://a.com/b/')]
+    assert sqlite3.connect(db_path).execute("SELECT url FROM queue ORDER BY seq").fetchall() == \
+           [('1:x',), ('2:y',)]
+    assert m2.pop_next() == 'https://a.com/b/y'
+    assert m2.is_finished()
+
+
+def test_url_prefixes_for_database_without_them(tmp_path):
+    db_path = tmp_path / "queue.db"
+    m = SqlStateManager(db_path)
+    m.enqueue_many(['https://a.com/x', 'https://a.com/y'])
+    m.mark_completed(m.pop_next())
+    m.close()
+
+    m2 = SqlStateManager(db_path, url_prefixes=['https://a.com/'])
+    m2.enqueue('https://a.com/x')
+
+    assert m2.pop_next() == 'https://a.com/y'
+    assert m2.is_finished()
+
+
+@pytest.mark.parametrize('url_prefixes', [[], ['https://a.com/']])
+def test_url_prefixes_for_database_from_before_them(tmp_path, url_prefixes):
+    db_path = tmp_path / "queue.db"
+    db = sqlite3.connect(db_path)
+    db.execute("""
+        CREATE TABLE queue (
+          url string PRIMARY KEY,
+          visited boolean NOT NULL,
+          failures smallint NOT NULL,
+          enqueue_time timestamp NOT NULL
+        )""")
+    db.executemany("INSERT INTO queue VALUES(?, ?, ?, ?)", [
+        ('12weird', False, 0, '2023-01-01 00:00:00'),
+        (':odd', False, 0, '2023-01-02 00:00:00'),
+        ('https://a.com/x', False, 0, '2023-01-03 00:00:00'),
+    ])
+    db.commit()
+    db.close()
+
+    m = SqlStateManager(db_path, url_prefixes=url_prefixes)
+    m.enqueue_many(['12weird', ':odd', 'https://a.com/x'])
+
+    assert [m.pop_next() for _ in range(3)] == ['12weird', ':odd', 'https://a.com/x']
+    assert m.is_finished()
+
+def test_backoff_holds_back_failed_url(tmp_path):
+    m = SqlStateManager(tmp_path / "queue.db", backoff=Backoff(datetime.timedelta(minutes=1), jitter=0))
+    m.enqueue_many(['a', 'b'])
+    m.mark_failed(m.pop_next())
+
+    assert m.pop_next() == 'b'
+    assert m.try_pop() is None
+    assert not m.is_finished()
+    assert datetime.timedelta(seconds=59) < m.retry_delay() <= datetime.timedelta(minutes=1)
+
+
+def test_backoff_passes(tmp_path):
+    m = SqlStateManager(tmp_path / "queue.db", backoff=Backoff(datetime.timedelta(milliseconds=50), jitter=0))
+    m.enqueue('a')
+    m.mark_failed(m.pop_next())
+    time.sleep(0.1)
+
+    assert m.retry_delay() == datetime.timedelta(0)
+    assert m.pop_next() == 'a'
+    assert m.retry_delay() is None
+
+
+def test_backoff_survives_restart(tmp_path):
+    db_path = tmp_path / "queue.db"
+    m = SqlStateManager(db_path, backoff=Backoff(datetime.timedelta(minutes=1), jitter=0))
+    m.enqueue('a')
+    m.mark_failed(m.pop_next())
+    m.close()
+
+    m2 = SqlStateManager(db_path)
+
+    assert m2.try_pop() is None
+    assert m2.retry_delay() > datetime.timedelta(seconds=59)
+
+
+def test_no_backoff_after_last_failure(tmp_path):
+    m = SqlStateManager(tmp_path / "queue.db", max_failures_per_url=1,
+                        backoff=Backoff(datetime.timedelta(minutes=1), jitter=0))
+    m.enqueue('a')
+    m.mark_failed(m.pop_next())
+
+    assert m.retry_delay() is None
+    assert m.is_finished()
+
+
+def test_no_retry_delay_without_backoff(tmp_path):
+    m = SqlStateManager(tmp_path / "queue.db")
+    m.enqueue('a')
+    m.mark_failed(m.pop_next())
+
+    assert m.retry_delay() is None
+    assert m.pop_next() == 'a'
+
+
+def test_adds_backoff_column_to_old_database(tmp_path):
+    db_path = tmp_path / "queue.db"
+    db = sqlite3.connect(db_path)
+    db.execute("""
+        CREATE TABLE queue (
+          url string PRIMARY KEY,
+          visited boolean NOT NULL,
+          failures smallint NOT NULL,
+          enqueue_time timestamp NOT NULL,
+          in_progress_until real,
+          seq integer
+        )""")
+    db.execute("CREATE INDEX queue_pending ON queue(seq, failures, in_progress_until, visited) WHERE NOT visited")
+    db.execute("INSERT INTO queue VALUES('a', false, 0, '2023-01-01 00:00:00', NULL, 1)")
+    db.commit()
+    db.close()
+
+    m = SqlStateManager(db_path)
+
+    plan = [row[3] for row in m._db.execute(f"EXPLAIN QUERY PLAN {m._next_query()}", {"now": 0})]
+    assert plan == ['SCAN queue USING COVERING INDEX queue_pending']
+    assert m.pop_next() == 'a'
+
+
+def test_permanent_failure_not_retried(tmp_path):
+    m = SqlStateManager(tmp_path / "queue.db", max_failures_per_url=3)
+    m.enqueue('a')
+
+    m.mark_failed(m.pop_next(), HttpStatusError('404 Client Error', 404))
+
+    assert m.is_finished()
+
+
+def test_transient_failure_retried(tmp_path):
+    m = SqlStateManager(tmp_path / "queue.db", max_failures_per_url=3)
+    m.enqueue('a')
+
+    m.mark_failed(m.pop_next(), HttpStatusError('503 Server Error', 503))
+
+    assert m.pop_next() == 'a'
+
+
+def test_retry_after_without_backoff(tmp_path):
+    m = SqlStateManager(tmp_path / "queue.db")
+    m.enqueue('a')
+
+    m.mark_failed(m.pop_next(), HttpStatusError('429 Client Error', 429, datetime.timedelta(minutes=2)))
+
+    assert m.try_pop() is None
+    assert datetime.timedelta(minutes=1) < m.retry_delay() <= datetime.timedelta(minutes=2)
+
+
+def test_retry_after_longer_than_backoff(tmp_path):
+    m = SqlStateManager(tmp_path / "queue.db", backoff=Backoff(datetime.timedelta(seconds=1), jitter=0))
+    m.enqueue('a')
+
+    m.mark_failed(m.pop_next(), HttpStatusError('503 Server Error', 503, datetime.timedelta(minutes=2)))
+
+    assert m.retry_delay() > datetime.timedelta(minutes=1)
+
+
+def test_dead_letter_after_too_many_failures(tmp_path):
+    db_path = tmp_path / "queue.db"
+    m = SqlStateManager(db_path, max_failures_per_url=2)
+    m.enqueue('a')
+
+    m.mark_failed(m.pop_next(), ValueError('oh no'))
+    m.mark_failed(m.pop_next(), ConnectionError('timed out'))
+
+    letter, = m.dead_letters()
+    assert letter.url == 'a'
+    assert letter.attempts == 2
+    assert letter.error_type == 'ConnectionError'
+    assert letter.status_code is None
+    assert letter.message == 'timed out'
+    assert letter.first_failure_time <= letter.last_failure_time
+    assert m.is_finished()
+    m.close()
+    assert sqlite3.connect(db_path).execute("SELECT COUNT(*) FROM queue").fetchone() == (0,)
+
+
+def test_dead_letter_after_permanent_failure(tmp_path):
+    m = SqlStateManager(tmp_path / "queue.db", max_failures_per_url=3)
+    m.enqueue('a')
+
+    m.mark_failed(m.pop_next(), HttpStatusError('404 Client Error', 404))
+
+    letter, = m.dead_letters()
+    assert letter[:5] == ('a', 1, 'HttpStatusError', 404, '404 Client Error')
+
+
+def test_dead_letter_not_enqueued_again(tmp_path):
+    m = SqlStateManager(tmp_path / "queue.db", max_failures_per_url=1)
+    m.enqueue('a')
+    m.mark_failed(m.pop_next())
+
+    m.enqueue('a')
+    m.enqueue_many(['a', 'b'])
+
+    assert m.pop_next() == 'b'
+    assert m.is_finished()
+
+
+def test_dead_letters_filtered(tmp_path):
+    m = SqlStateManager(tmp_path / "queue.db", max_failures_per_url=1)
+    m.enqueue_many(['https://a.com/1', 'https://a.com/2', 'https://b.com/3'])
+    m.mark_failed(m.pop_next(), HttpStatusError('404 Client Error', 404))
+    m.mark_failed(m.pop_next(), HttpStatusError('503 Server Error', 503))
+    m.mark_failed(m.pop_next(), ValueError('oh no'))
+
+    assert [d.url for d in m.dead_letters()] == ['https://a.com/1', 'https://a.com/2', 'https://b.com/3']
+    assert [d.url for d in m.dead_letters(status_code=503)] == ['https://a.com/2']
+    assert [d.url for d in m.dead_letters(error_type='HttpStatusError')] == ['https://a.com/1', 'https://a.com/2']
+    assert [d.url for d in m.dead_letters(url_prefix='https://b.com/')] == ['https://b.com/3']
+    assert m.dead_letters(error_type='ValueError', url_prefix='https://a.com/') == []
+
+
+def test_requeue_dead_letters(tmp_path):
+    m = SqlStateManager(tmp_path / "queue.db", max_failures_per_url=1)
+    m.enqueue_many(['a', 'b', 'c'])
+    m.mark_failed(m.pop_next(), HttpStatusError('503 Server Error', 503))
+    m.mark_failed(m.pop_next(), HttpStatusError('404 Client Error', 404))
+    m.mark_failed(m.pop_next(), HttpStatusError('503 Server Error', 503))
+
+    assert m.requeue_dead_letters(status_code=503) == 2
+
+    assert [d.url for d in m.dead_letters()] == ['b']
+    assert m.pop_next() == 'a'
+    # Requeued URLs get every attempt again.
+    m.mark_failed('a')
+    assert [d.url for d in m.dead_letters()] == ['b', 'a']
+    assert m.pop_next() == 'c'
+    assert m.is_finished()
+
+
+def test_requeue_all_dead_letters(tmp_path):
+    m = SqlStateManager(tmp_path / "queue.db", max_failures_per_url=1)
+    m.enqueue_many(['a', 'b'])
+    m.mark_failed(m.pop_next())
+    m.mark_failed(m.pop_next())
+
+    assert m.requeue_dead_letters() == 2
+
+    assert m.dead_letters() == []
+    assert m.pop_next() == 'a'
+    assert m.pop_next() == 'b'
+
+
+def test_requeue_dead_letters_with_url_prefixes(tmp_path):
+    m = SqlStateManager(tmp_path / "queue.db", max_failures_per_url=1,
+                        url_prefixes=['https://a.com/', 'https://a.com/b/'])
+    m.enqueue_many(['https://a.com/x', 'https://a.com/b/y', 'https://c.com/z'])
+    for _ in range(3):
+        m.mark_failed(m.pop_next())
+
+    assert m.requeue_dead_letters(url_prefix='https://a.com/') == 2
+
+    assert m.pop_next() == 'https://a.com/x'
+    assert m.pop_next() == 'https://a.com/b/y'
+    assert m.is_finished()
+
+
+def test_dead_letters_reencoded_with_new_prefixes(tmp_path):
+    db_path = tmp_path / "queue.db"
+    m = SqlStateManager(db_path, max_failures_per_url=1)
+    m.enqueue('https://a.com/x')
+    m.mark_failed(m.pop_next())
+    m.close()
+
+    m2 = SqlStateManager(db_path, max_failures_per_url=1, url_prefixes=['https://a.com/'])
+    m2.enqueue('https://a.com/x')
+
+    assert m2.is_finished()
+    assert [d.url for d in m2.dead_letters()] == ['https://a.com/x']
+    m2.close()
+    assert sqlite3.connect(db_path).execute("SELECT url FROM dead_letters").fetchall() == [('1:x',)]
+
+
+def test_dead_letters_moved_from_old_database(tmp_path):
+    db_path = tmp_path / "queue.db"
+    db = sqlite3.connect(db_path)
+    db.execute("""
+        CREATE TABLE queue (
+          url string PRIMARY KEY,
+          visited boolean NOT NULL,
+          failures smallint NOT NULL,
+          enqueue_time timestamp NOT NULL,
+          in_progress_until real,
+          seq integer,
+          not_before real
+        )""")
+    db.execute("INSERT INTO queue VALUES('a', false, 3, '2023-01-01 00:00:00', NULL, 1, NULL)")
+    db.execute("INSERT INTO queue VALUES('b', false, 1, '2023-01-01 00:00:00', NULL, 2, NULL)")
+    db.commit()
+    db.close()
+
+    m = SqlStateManager(db_path, max_failures_per_url=3)
+
+    assert m.dead_letters() == [DeadLetter('a', 3, None, None, None, None, datetime.datetime(2023, 1, 1))]
+    assert m.pop_next() == 'b'
+    assert m.is_finished()
@@ -1,4 +1,6 @@
 import abc
+import datetime
+from typing import Iterable, Optional
 
 
 class StateManager(abc.ABC):
@@ -6,8 +8,8 @@ class StateManager(abc.ABC):
     Interface for keeping track of crawl state, and ensuring we can resume
     gracefully after a restart. Expects the following lifecycle for a given URL:
      - enqueue() when discovered.
-     - pop_next() when it is time to be crawled.
-     - mark_completed() after it has been crawled.
+     - pop_next() or try_pop() when it is time to be crawled.
+     - mark_completed() after it has been crawled, or mark_failed() if that failed.
     """
 
     def is_finished(self) -> bool:
@@ -24,6 +26,15 @@ class StateManager(abc.ABC):
         """
         raise NotImplementedError('Cannot call enqueue on abstract base class StateManager')
 
+    def enqueue_many(self, urls: Iterable[str]) -> None:
+        """
+        Adds several URLs to the list of URLs to be crawled, in order. Implementations
+        should override this if they can do so more cheaply than one at a time.
+        :param urls: URLs to be added to the crawl queue.
+        """
+        for url in urls:
+            self.enqueue(url)
+
     def pop_next(self) -> str:
         """
         Retrieves the next URL that should be visited.
@@ -31,6 +42,40 @@ class StateManager(abc.ABC):
         """
         raise NotImplementedError('Cannot call pop_next on abstract base class StateManager')
 
+    def try_pop(self) -> Optional[str]:
+        """
+        Retrieves the next URL that should be visited, if there is one. Equivalent to
+        checking is_finished() before calling pop_next(). Implementations should
+        override this if they can do both at once more cheaply.
+        :return: The next URL to be crawled, or None if there is nothing left to crawl.
+        """
+        if self.is_finished():
+            return None
+        return self.pop_next()
+
+    def retry_delay(self) -> Optional[datetime.timedelta]:
+        """
+        Lets us know how long to wait when nothing can be popped, because every URL
+        left is waiting to be retried. Does nothing unless implementations delay retries.
+        :return: How long until the next URL waiting to be retried can be popped, or None if none are waiting.
+        """
+        return None
+
+    def flush(self) -> None:
+        """
+        Makes sure any changes to crawl state that are being buffered are written out.
+        Called when a crawl stops. Does nothing unless implementations buffer changes.
+        """
+
+    def mark_failed(self, url: str, error: Optional[Exception] = None) -> None:
+        """
+        Updates crawl state so that we know crawling `url` failed. It may be tried again if it is enqueued again.
+        :param url: URL to be marked failed.
+        :param error: Why it failed, if known. Implementations should give up on URLs that failed permanently, and
+            wait as long as the server asked before trying others again.
+        """
+        raise NotImplementedError('Cannot call mark_failed on abstract base class StateManager')
+
     def mark_completed(self, url: str) -> None:
         """
         Updates crawl state so that we know `url` has been processed.
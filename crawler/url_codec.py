@@ -0,0 +1,100 @@
+import os
+from typing import Iterable, Iterator, Mapping
+
+_DIGITS = frozenset('0123456789')
+
+
+class PrefixCodec:
+    """
+    Shortens URLs for storage by replacing a known prefix with its number, so that
+    `https://www.europotato.org/varieties/view/1-E` might be stored as `0:view/1-E`.
+    Uses the longest prefix that matches. URLs without a known prefix are stored
+    as they are, unless they start with a digit or a colon, in which case they
+    are escaped with a colon.
+
+    Every URL has exactly one stored form for a given set of prefixes, so stored
+    forms can be compared to deduplicate URLs.
+    """
+
+    def __init__(self, prefixes: Mapping[int, str]):
+        """
+        :param prefixes: Prefixes to replace, by number.
+        """
+        for prefix in prefixes.values():
+            if not prefix:
+                raise ValueError('Prefixes cannot be empty')
+        self.prefixes = dict(prefixes)
+        self._longest_first = sorted(self.prefixes.items(), key=lambda item: len(item[1]), reverse=True)
+
+    def encode(self, url: str) -> str:
+        for i, prefix in self._longest_first:
+            if url.startswith(prefix):
+                return f'{i}:{url[len(prefix):]}'
+        if url[:1] in _DIGITS or url[:1] == ':':
+            return f':{url}'
+        return url
+
+    def decode(self, stored: str) -> str:
+        if stored[:1] == ':':
+            return stored[1:]
+        if stored[:1] in _DIGITS:
+            i, _, suffix = stored.partition(':')
+            return self.prefixes[int(i)] + suffix
+        return stored
+
+
+class FrontCoder:
+    """
+    Front-codes a sequence of URLs, writing each as how many characters it shares
+    with the URL before, then the rest of it. URLs found on the same page, or
+    sorted URLs, usually share most of their characters.
+    """
+
+    def __init__(self):
+        self._previous = ''
+
+    def encode(self, url: str) -> str:
+        shared = len(os.path.commonprefix([self._previous, url]))
+        self._previous = url
+        return f'{shared}:{url[shared:]}'
+
+    def reset(self) -> None:
+        """
+        Starts a new sequence, for when the next URL is written somewhere the previous ones weren't.
+        """
+        self._previous = ''
+
+
+class FrontDecoder:
+    """
+    Reverses FrontCoder, one line at a time. Lines before the first front-coded
+    line are passed through as they are, even if they start with a digit, so old
+    logs can be extended with front-coded lines. FrontCoder shares nothing with
+    the first URL it writes, so front coding starts at the first line that starts
+    with `0:`.
+    """
+
+    def __init__(self):
+        self._previous = ''
+        self._coded = False
+
+    def decode(self, line: str) -> str:
+        """
+        :param line: Stored line, without its newline.
+        :return: The URL.
+        """
+        self._coded = self._coded or line.startswith('0:')
+        if self._coded:
+            shared, _, suffix = line.partition(':')
+            line = self._previous[:int(shared)] + suffix
+        self._previous = line
+        return line
+
+
+def front_decode(lines: Iterable[str]) -> Iterator[str]:
+    """
+    Decodes a whole sequence of lines with a FrontDecoder.
+    :param lines: Stored lines, without newlines.
+    :return: The URLs.
+    """
+    return map(FrontDecoder().decode, lines)
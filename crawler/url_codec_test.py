@@ -0,0 +1,65 @@
+import pytest
+
+from .url_codec import FrontCoder, PrefixCodec, front_decode
+
+
+def test_prefix_codec_replaces_prefix():
+    codec = PrefixCodec({0: 'https://www.europotato.org/varieties/'})
+
+    assert codec.encode('https://www.europotato.org/varieties/view/1-E') == '0:view/1-E'
+    assert codec.decode('0:view/1-E') == 'https://www.europotato.org/varieties/view/1-E'
+
+
+def test_prefix_codec_uses_longest_prefix():
+    codec = PrefixCodec({0: 'https://a.com/', 1: 'https://a.com/b/'})
+
+    assert codec.encode('https://a.com/b/c') == '1:c'
+    assert codec.encode('https://a.com/c') == '0:c'
+
+
+def test_prefix_codec_unknown_prefix():
+    codec = PrefixCodec({0: 'https://a.com/'})
+
+    assert codec.encode('https://b.com/') == 'https://b.com/'
+    assert codec.decode('https://b.com/') == 'https://b.com/'
+
+
+@pytest.mark.parametrize('url', ['1', '12:34', ':a', '::', ''])
+def test_prefix_codec_escapes_ambiguous_urls(url):
+    codec = PrefixCodec({0: 'https://a.com/'})
+
+    assert codec.decode(codec.encode(url)) == url
+
+
+def test_prefix_codec_empty_prefix():
+    with pytest.raises(ValueError, match='empty'):
+        PrefixCodec({0: ''})
+
+
+def test_front_coder():
+    coder = FrontCoder()
+
+    assert coder.encode('https://a.com/b/1') == '0:https://a.com/b/1'
+    assert coder.encode('https://a.com/b/2') == '16:2'
+    assert coder.encode('https://a.com/c') == '14:c'
+
+
+def test_front_coder_reset():
+    coder = FrontCoder()
+    coder.encode('abc')
+
+    coder.reset()
+
+    assert coder.encode('abd') == '0:abd'
+
+
+def test_front_decode():
+    urls = ['https://a.com/b/1', 'https://a.com/b/2', 'https://a.com/c', 'https://b.com/', '']
+    coder = FrontCoder()
+
+    assert list(front_decode(coder.encode(url) for url in urls)) == urls
+
+
+def test_front_decode_plain_lines():
+    assert list(front_decode(['https://a.com/b', '12weird', '0:https://a.com/c', '14:d'])) == \
+           ['https://a.com/b', '12weird', 'https://a.com/c', 'https://a.com/d']
@@ -0,0 +1,127 @@
+import abc
+import hashlib
+import math
+import mmap
+import os
+import pathlib
+import struct
+from typing import Iterable, Iterator, Optional
+
+_HEADER = struct.Struct('<8sQQ')
+_MAGIC = b'potato\x00\x01'
+
+
+class VisitedSet(abc.ABC):
+    """
+    Interface for remembering which URLs have been crawled, so state managers can
+    use something more compact than a set of every URL.
+    """
+
+    @property
+    def persistent(self) -> bool:
+        """
+        :return: Whether the set keeps itself on disk, so that it survives a restart without being rebuilt.
+        """
+        return False
+
+    @abc.abstractmethod
+    def add(self, url: str) -> None:
+        """
+        :param url: URL that has been crawled.
+        """
+        raise NotImplementedError('Cannot add to abstract base class VisitedSet')
+
+    @abc.abstractmethod
+    def __contains__(self, url: str) -> bool:
+        """
+        :param url: URL to check.
+        :return: Whether `url` has been crawled. May be wrong for sets that trade accuracy for space.
+        """
+        raise NotImplementedError('Cannot check abstract base class VisitedSet')
+
+    def update(self, urls: Iterable[str]) -> None:
+        for url in urls:
+            self.add(url)
+
+    def flush(self) -> None:
+        """
+        Makes sure the set is written out, if it is persistent.
+        """
+
+
+class BloomFilter(VisitedSet):
+    """
+    Remembers URLs in a Bloom filter, which takes a few bytes per URL however long
+    the URLs are. In exchange, it sometimes claims to have seen a URL that it has
+    not, in which case that page is never crawled.
+
+    Bits are kept in a memory-mapped file if a path is given, so they survive a
+    restart, and only the pages in use need to be in memory. Filters cannot grow,
+    so the false positive rate rises above what was asked for if more URLs than
+    `capacity` are added.
+    """
+
+    def __init__(self, capacity: int, false_positive_rate: float = 1e-4, path: Optional[pathlib.Path] = None):
+        """
+        :param capacity: How many URLs the filter is sized for.
+        :param false_positive_rate: Chance of wrongly claiming to have seen a URL, once `capacity` URLs are added.
+        :param path: File to keep the filter in. Created if it does not exist, and must have been created with the
+            same capacity and false positive rate if it does. If not given, the filter is only kept in memory.
+        """
+        if capacity < 1:
+            raise ValueError(f'Capacity must be at least 1, got {capacity}')
+        if not 0 < false_positive_rate < 1:
+            raise ValueError(f'False positive rate must be between 0 and 1, got {false_positive_rate}')
+        # Sizes that minimise the false positive rate for this many bits.
+        self.num_bits = math.ceil(-capacity * math.log(false_positive_rate) / math.log(2) ** 2)
+        self.num_hashes = max(1, round(self.num_bits / capacity * math.log(2)))
+        self._path = path
+        size = _HEADER.size + (self.num_bits + 7) // 8
+
+        if path is None:
+            self._bits = bytearray(size)
+            return
+        with open(os.open(path, os.O_RDWR | os.O_CREAT), 'r+b') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                f.write(_HEADER.pack(_MAGIC, self.num_bits, self.num_hashes))
+                f.truncate(size)
+            f.seek(0)
+            magic, num_bits, num_hashes = _HEADER.unpack(f.read(_HEADER.size))
+            if magic != _MAGIC or (num_bits, num_hashes) != (self.num_bits, self.num_hashes):
+                raise ValueError(f'{path} is not a Bloom filter with this capacity and false positive rate')
+            if os.fstat(f.fileno()).st_size != size:
+                raise ValueError(f'{path} is the wrong size for its Bloom filter')
+            # The mapping stays open after the file is closed.
+            self._bits = mmap.mmap(f.fileno(), size)
+
+    @property
+    def persistent(self) -> bool:
+        return self._path is not None
+
+    def _positions(self, url: str) -> Iterator[int]:
+        # Derives every position from two hashes, which is as good as independent hashes.
+        digest = hashlib.blake2b(url.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        for i in range(self.num_hashes):
+            yield (h1 + i * h2) % self.num_bits
+
+    def add(self, url: str) -> None:
+        for position in self._positions(url):
+            self._bits[_HEADER.size + position // 8] |= 1 << (position % 8)
+
+    def __contains__(self, url: str) -> bool:
+        return all(self._bits[_HEADER.size + position // 8] & (1 << (position % 8))
+                   for position in self._positions(url))
+
+    def flush(self) -> None:
+        if self._path is not None:
+            self._bits.flush()
+
+    def close(self) -> None:
+        """
+        Writes out the filter and releases the mapping. The filter cannot be used afterwards.
+        """
+        self.flush()
+        if self._path is not None:
+            self._bits.close()
@@ -0,0 +1,99 @@
+import pytest
+
+from .visited_set import BloomFilter
+
+
+def test_invalid_capacity():
+    with pytest.raises(ValueError, match='Capacity'):
+        BloomFilter(0)
+
+
+@pytest.mark.parametrize("rate", [0, 1, 1.5, -0.1])
+def test_invalid_false_positive_rate(rate):
+    with pytest.raises(ValueError, match='False positive rate'):
+        BloomFilter(100, rate)
+
+
+def test_sizes_for_capacity_and_rate():
+    f = BloomFilter(1000, 0.01)
+
+    # About 9.6 bits and 7 hashes per URL for a 1% false positive rate.
+    assert f.num_bits == 9586
+    assert f.num_hashes == 7
+
+
+def test_contains_added_urls():
+    f = BloomFilter(1000)
+    urls = [f'https://www.europotato.org/varieties/view/{i}-E' for i in range(1000)]
+    f.update(urls)
+
+    assert all(url in f for url in urls)
+
+
+def test_false_positive_rate():
+    f = BloomFilter(10000, 0.01)
+    f.update(f'https://www.europotato.org/varieties/view/{i}-E' for i in range(10000))
+
+    false_positives = sum(f'https://www.europotato.org/varieties/index?page={i}' in f for i in range(10000))
+
+    assert false_positives < 200
+
+
+def test_in_memory_filter_not_persistent():
+    assert not BloomFilter(100).persistent
+
+
+def test_persisted_filter(tmp_path):
+    path = tmp_path / 'visited.bloom'
+    f = BloomFilter(1000, 0.001, path)
+    f.add('a')
+    f.close()
+
+    f2 = BloomFilter(1000, 0.001, path)
+
+    assert f2.persistent
+    assert 'a' in f2
+    assert 'b' not in f2
+
+
+def test_persisted_filter_is_compact(tmp_path):
+    path = tmp_path / 'visited.bloom'
+    BloomFilter(1000000, 0.0001, path).close()
+
+    assert path.stat().st_size < 2.5 * 1000000
+
+
+def test_persisted_filter_shared_between_instances(tmp_path):
+    path = tmp_path / 'visited.bloom'
+    f = BloomFilter(1000, 0.001, path)
+    f2 = BloomFilter(1000, 0.001, path)
+
+    f.add('a')
+
+    assert 'a' in f2
+
+
+def test_persisted_filter_with_other_parameters(tmp_path):
+    path = tmp_path / 'visited.bloom'
+    BloomFilter(1000, 0.001, path).close()
+
+    with pytest.raises(ValueError, match='capacity and false positive rate'):
+        BloomFilter(2000, 0.001, path)
+
+
+def test_not_a_filter(tmp_path):
+    path = tmp_path / 'visited.bloom'
+    path.write_bytes(b'https://www.europotato.org/varieties/index\n')
+
+    with pytest.raises(ValueError, match='not a Bloom filter'):
+        BloomFilter(1000, 0.001, path)
+
+
+def test_truncated_filter(tmp_path):
+    path = tmp_path / 'visited.bloom'
+    BloomFilter(1000, 0.001, path).close()
+    with open(path, 'r+b') as f:
+        f.truncate(100)
+
+    with pytest.raises(ValueError, match='wrong size'):
+        BloomFilter(1000, 0.001, path)
@@ -5,15 +5,13 @@ import bs4
 from crawler import handler
 
 
-class Handler(handler.Handler):
+class Handler(handler.HtmlHandler):
     """
     Handles index pages from europotato.org. These contain links to other index pages,
     and to pages with details about specific varieties.
     """
 
-    def handle(self, content: str, url: str, enqueue_callback: Callable[[str, str], None]) -> None:
-        doc = bs4.BeautifulSoup(content, 'html.parser')
-
+    def _handle_doc(self, doc: bs4.BeautifulSoup, url: str, enqueue_callback: Callable[[str, str], None]) -> None:
         # Enqueue links to details on varieties.
         varieties = doc.find(id='advanced-search-results')
         for variety in varieties.findAll('a', class_='result-item'):
@@ -1,44 +1,26 @@
-import datetime
-import pathlib
-
 from absl import app
-from absl import flags
 
-from crawler.crawler import Crawler
-from crawler.error_handler import LoggingHandler, RetryingHandler
-from crawler.http_fetcher import HttpFetcher
-from crawler.sqlite_state_manager import SqlStateManager
+from crawler import command_line
+from crawler.canonicalizer import UrlCanonicalizer
 from europotato.router import Handler
 
-FLAGS = flags.FLAGS
+# Shared by almost every URL on the site, so the state manager stores them compactly.
+_URL_PREFIXES = [
+    'https://www.europotato.org/varieties/',
+]
+# The handlers only parse HTML, so there is no point downloading anything else.
+_CONTENT_TYPES = ['text/html']
 
-flags.DEFINE_string('root_url', 'https://www.europotato.org/varieties/index', 'Root URL.')
-flags.DEFINE_string('state_root', '', 'Path to directory used to manage queue state.')
-flags.DEFINE_string('output_root', '', 'Path to write output files under.')
-flags.DEFINE_string('user_agent', 'http://github.com/dinosaursrarr/potato/europotato', 'User agent to report when '
-                                                                                       'fetching pages.')
-flags.DEFINE_integer('crawl_delay_seconds', 60, 'How long to delay between pages, in seconds.', lower_bound=0)
-flags.DEFINE_integer('max_failures_per_url', 3, 'How many times to try crawling a single URL before giving up.',
-                     lower_bound=0)
+command_line.define_flags(root_url='https://www.europotato.org/varieties/index',
+                          user_agent='http://github.com/dinosaursrarr/potato/europotato',
+                          crawl_delay_seconds=60)
 
 
 def main(argv):
-    if not FLAGS.state_root:
-        raise ValueError('State root must be provided')
-    if not FLAGS.output_root:
-        raise ValueError('Output root must be provided')
-    if not FLAGS.root_url:
-        raise ValueError('Root URL must be provided')
-    state_root = pathlib.Path(FLAGS.state_root)
-
-    handler = Handler(pathlib.Path(FLAGS.output_root))
-    state_manager = SqlStateManager(state_root / 'europotato.db',
-                                    max_failures_per_url=FLAGS.max_failures_per_url)
-    crawl_delay = datetime.timedelta(seconds=FLAGS.crawl_delay_seconds)
-
-    c = Crawler(HttpFetcher(FLAGS.user_agent), handler, state_manager,
-                RetryingHandler(LoggingHandler()), crawl_delay)
-    c.crawl([FLAGS.root_url])
+    # Paths and query parameters are only used as identifiers, so their order and trailing slashes don't matter.
+    canonicalizer = UrlCanonicalizer(sort_query=True, strip_trailing_slash=True)
+    command_line.run('europotato', Handler, Handler.route, 'europotato.org', _URL_PREFIXES, _CONTENT_TYPES,
+                     canonicalizer)
 
 
 if __name__ == '__main__':
@@ -1,8 +1,11 @@
+import concurrent.futures
 import inspect
 from typing import Callable, Set
 
 import pytest
 
+from crawler.fetcher import RawContent
+from crawler.handler import collect_links
 from .router import Handler
 
 
@@ -98,3 +101,39 @@ def test_pages_router(url, tmp_path):
 def test_unknown_url_pattern(url, tmp_path):
     with pytest.raises(NotImplementedError, match=f'No handler for URL: {url}'):
         Handler(output_root=tmp_path).handle('', url, None)
+
+
+def test_handle_in_other_process(tmp_path):
+    content = open('europotato/varieties.html').read()
+    url = 'https://www.europotato.org/varieties/index'
+
+    with concurrent.futures.ProcessPoolExecutor(1) as executor:
+        links = executor.submit(collect_links, Handler(output_root=tmp_path), content, url).result()
+
+    assert links
+    assert all(current_url == url for current_url, _ in links)
+
+
+@pytest.mark.parametrize(
+    ["url", "route"],
+    [
+        ('https://www.europotato.org/varieties/index', 'index'),
+        ('https://www.europotato.org/varieties/index?page=2', 'index'),
+        ('https://www.europotato.org/varieties/view/King%20Edward-E', 'view'),
+        ('https://www.europotato.org/varieties/reports', None),
+        ('http://www.google.com', None),
+    ]
+)
+def test_route(url, route):
+    assert Handler.route(url) == route
+
+
+def test_handle_raw_in_other_process(tmp_path):
+    with open('europotato/varieties.html', 'rb') as f:
+        content = RawContent(f.read(), None)
+    url = 'https://www.europotato.org/varieties/index'
+
+    with concurrent.futures.ProcessPoolExecutor(1) as executor:
+        links = executor.submit(collect_links, Handler(output_root=tmp_path), content, url).result()
+
+    assert links == collect_links(Handler(output_root=tmp_path), open('europotato/varieties.html').read(), url)
@@ -5,10 +5,10 @@ from typing import Callable, List, Optional
 
 import bs4
 
-from crawler import handler
+from crawler import handler, metrics
 
 
-class Handler(handler.Handler):
+class Handler(handler.HtmlHandler):
     """
     Handles detail pages from europotato.org. These contain details about a given
     variety of potato. Data is written as json to files named for the url.
@@ -73,14 +73,12 @@ class Handler(handler.Handler):
             results.extend([a['href'] for a in ul.findAll('a')])
         return results
 
-    def handle(self, content: str, url: str, enqueue_callback: Callable[[str, str], None]) -> None:
+    def _handle_doc(self, doc: bs4.BeautifulSoup, url: str, enqueue_callback: Callable[[str, str], None]) -> None:
         # Collect information in a dict, which we will dump to JSON.
         variety = {
             'url': url,
         }
 
-        doc = bs4.BeautifulSoup(content, 'html.parser')
-
         name = Handler._extract_name(doc)
         if name:
             variety['name'] = name
@@ -100,5 +98,5 @@ class Handler(handler.Handler):
             enqueue_callback(url, tab_link)
 
         output_path = self.output_root / f'{Handler._output_filename(url)}.json'
-        with open(output_path, 'w') as f:
+        with metrics.timed('write'), open(output_path, 'w') as f:
             json.dump(variety, f)
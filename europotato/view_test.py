@@ -1,6 +1,9 @@
 import json
 import urllib.parse
 
+import pytest
+
+from crawler.fetcher import RawContent
 from .view import Handler
 
 
@@ -93,3 +96,18 @@ def test_enqueue_tab_links(tmp_path):
     Handler(output_dir).handle(content, page_url, enqueue_callback)
 
     assert enqueued_urls == expected_urls
+
+
+@pytest.mark.parametrize('encoding', [None, 'iso-8859-1'])
+def test_handle_raw_matches_handle(tmp_path, encoding):
+    url = 'https://www.europotato.org/varieties/view/King%20Edward-E'
+    (tmp_path / 'str').mkdir()
+    (tmp_path / 'raw').mkdir()
+
+    with open('europotato/king_edward.html', encoding='iso-8859-1') as f:
+        Handler(tmp_path / 'str').handle(f.read(), url, noop_callback)
+    with open('europotato/king_edward.html', 'rb') as f:
+        Handler(tmp_path / 'raw').handle_raw(RawContent(f.read(), encoding), url, noop_callback)
+
+    assert (tmp_path / 'raw' / 'King%20Edward-E.json').read_text() == \
+           (tmp_path / 'str' / 'King%20Edward-E.json').read_text()
@@ -7,13 +7,13 @@ from typing import Any, Callable, Dict, List, Optional
 
 import bs4
 
-from crawler import handler
+from crawler import handler, metrics
 
 _VARIETY_NAME = re.compile(r'pedigree image for \'([^\']+)\'')
 _YEAR_OF_INTRODUCTION = re.compile(r'\(year: (\d+)\)  \[depth=8\]')
 
 
-class Handler(handler.Handler):
+class Handler(handler.HtmlHandler):
     """
     Handles image map pages from https://www.plantbreeding.wur.nl/PotatoPedigree.
     These contain an interactive image showing the ancestors of a given variety
@@ -81,14 +81,12 @@ class Handler(handler.Handler):
         id_param = urllib.parse.parse_qs(query)['id'][0]
         return pathlib.Path(id_param)
 
-    def handle(self, content: str, url: str, enqueue_callback: Callable[[str, str], None]) -> None:
+    def _handle_doc(self, doc: bs4.BeautifulSoup, url: str, enqueue_callback: Callable[[str, str], None]) -> None:
         # Collect information in a dict, which we will dump to JSON.
         variety = {
             'url': url,
         }
 
-        doc = bs4.BeautifulSoup(content, 'html.parser')
-
         name = Handler._extract_name(doc)
         if name:
             variety['name'] = name
@@ -102,5 +100,5 @@ class Handler(handler.Handler):
             variety['parentage'] = parentage
 
         output_path = self.output_root / f'{Handler._output_filename(url)}.json'
-        with open(output_path, 'w') as f:
+        with metrics.timed('write'), open(output_path, 'w') as f:
             json.dump(variety, f)
@@ -1,5 +1,6 @@
 import json
 
+from crawler.fetcher import RawContent
 from .imagemap import Handler
 
 
@@ -456,3 +457,16 @@ def test_extract_parentage(tmp_path):
                 "coordinates": [800, 4885, 840, 4895],
             },
         ]
+
+
+def test_handle_raw_matches_handle(tmp_path):
+    url = 'https://www.plantbreeding.wur.nl/PotatoPedigree/pedigree_imagemap.php?id=2602&depth=8&showjaar=0'
+    (tmp_path / 'str').mkdir()
+    (tmp_path / 'raw').mkdir()
+
+    with open('pedigree/imagemap.html', encoding='utf-8') as f:
+        Handler(tmp_path / 'str').handle(f.read(), url, noop_callback)
+    with open('pedigree/imagemap.html', 'rb') as f:
+        Handler(tmp_path / 'raw').handle_raw(RawContent(f.read(), 'utf-8'), url, noop_callback)
+
+    assert (tmp_path / 'raw' / '2602.json').read_text() == (tmp_path / 'str' / '2602.json').read_text()
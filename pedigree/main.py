@@ -1,46 +1,28 @@
-import datetime
-import pathlib
-import queue
-
 from absl import app
-from absl import flags
 
-from crawler.crawler import Crawler
-from crawler.error_handler import LoggingHandler, RetryingHandler
-from crawler.sqlite_state_manager import SqlStateManager
-from crawler.http_fetcher import HttpFetcher
+from crawler import command_line
+from crawler.canonicalizer import UrlCanonicalizer
 from pedigree.router import Handler
 
-FLAGS = flags.FLAGS
+# Shared by almost every URL on the site, so the state manager stores them compactly.
+_URL_PREFIXES = [
+    'https://www.plantbreeding.wur.nl/PotatoPedigree/pedigree_imagemap.php?id=',
+    'https://www.plantbreeding.wur.nl/PotatoPedigree/',
+]
+# The handlers only parse HTML, so there is no point downloading anything else.
+_CONTENT_TYPES = ['text/html']
 
-flags.DEFINE_string('root_url', 'https://www.plantbreeding.wur.nl/PotatoPedigree/multilookup.php', 'URL to begin the '
-                                                                                                   'crawl at.')
-flags.DEFINE_string('state_root', '', 'Path to directory used to manage queue state.')
-flags.DEFINE_string('output_root', '', 'Path to write output files under.')
-flags.DEFINE_string('user_agent', 'http://github.com/dinosaursrarr/potato/pedigree', 'User agent to report when '
-                                                                                     'fetching pages.')
-flags.DEFINE_integer('crawl_delay_seconds', 10, 'How long to delay between pages, in seconds.', lower_bound=0)
-flags.DEFINE_integer('max_failures_per_url', 3, 'How many times to try crawling a single URL before giving up.',
-                     lower_bound=0)
+command_line.define_flags(root_url='https://www.plantbreeding.wur.nl/PotatoPedigree/multilookup.php',
+                          user_agent='http://github.com/dinosaursrarr/potato/pedigree',
+                          crawl_delay_seconds=10)
 
 
 def main(argv):
-    if not FLAGS.state_root:
-        raise ValueError('State root must be provided')
-    if not FLAGS.output_root:
-        raise ValueError('Output root must be provided')
-    if not FLAGS.root_url:
-        raise ValueError('Root URL must be provided')
-    state_root = pathlib.Path(FLAGS.state_root)
-
-    handler = Handler(pathlib.Path(FLAGS.output_root))
-    state_manager = SqlStateManager(state_root / 'pedigree.db',
-                                    max_failures_per_url=FLAGS.max_failures_per_url)
-    crawl_delay = datetime.timedelta(seconds=FLAGS.crawl_delay_seconds)
-
-    c = Crawler(HttpFetcher(FLAGS.user_agent), handler, state_manager,
-                RetryingHandler(LoggingHandler()), crawl_delay)
-    c.crawl([FLAGS.root_url])
+    # Search results sometimes already ask for depth=8 before we add it again. The router expects id to come first,
+    # so parameters must not be reordered.
+    canonicalizer = UrlCanonicalizer(dedupe_query=True)
+    command_line.run('pedigree', Handler, Handler.route, 'plantbreeding.wur.nl', _URL_PREFIXES, _CONTENT_TYPES,
+                     canonicalizer)
 
 
 if __name__ == '__main__':
@@ -1,6 +1,6 @@
-from typing import Callable
+from typing import Callable, Optional
 
-from crawler import handler
+from crawler import fetcher, handler
 from . import imagemap, search
 
 
@@ -13,11 +13,27 @@ class Handler(handler.Handler):
     def __init__(self, output_root: str):
         self.output_root = output_root
 
-    def handle(self, content: str, url: str, enqueue_callback: Callable[[str, str], None]) -> None:
+    @staticmethod
+    def route(url: str) -> Optional[str]:
+        """
+        :return: Name of the template for the page at `url`, or None if we have no handler for it.
+        """
         if url.startswith('https://www.plantbreeding.wur.nl/PotatoPedigree/multilookup.php'):
-            search.Handler(self.output_root).handle(content, url, enqueue_callback)
-            return
+            return 'search'
         if url.startswith('https://www.plantbreeding.wur.nl/PotatoPedigree/pedigree_imagemap.php?id='):
-            imagemap.Handler(self.output_root).handle(content, url, enqueue_callback)
-            return
+            return 'imagemap'
+        return None
+
+    def _handler(self, url: str) -> handler.Handler:
+        route = Handler.route(url)
+        if route == 'search':
+            return search.Handler(self.output_root)
+        if route == 'imagemap':
+            return imagemap.Handler(self.output_root)
         raise NotImplementedError(f'No handler for URL: {url}')
+
+    def handle(self, content: str, url: str, enqueue_callback: Callable[[str, str], None]) -> None:
+        self._handler(url).handle(content, url, enqueue_callback)
+
+    def handle_raw(self, content: fetcher.RawContent, url: str, enqueue_callback: Callable[[str, str], None]) -> None:
+        self._handler(url).handle_raw(content, url, enqueue_callback)
@@ -1,3 +1,4 @@
+import concurrent.futures
 import inspect
 import os
 import re
@@ -5,6 +6,8 @@ from typing import Callable, Set
 
 import pytest
 
+from crawler.fetcher import RawContent
+from crawler.handler import collect_links
 from .router import Handler
 
 
@@ -71,3 +74,38 @@ def test_imagemap_router(url, output_file, tmp_path):
 def test_unknown_url_pattern(url, tmp_path):
     with pytest.raises(NotImplementedError, match=re.escape(f'No handler for URL: {url}')):
         Handler(output_root=tmp_path).handle('', url, None)
+
+
+def test_handle_in_other_process(tmp_path):
+    content = open('pedigree/imagemap.html').read()
+    url = 'https://www.plantbreeding.wur.nl/PotatoPedigree/pedigree_imagemap.php?id=9184&depth=8'
+
+    with concurrent.futures.ProcessPoolExecutor(1) as executor:
+        links = executor.submit(collect_links, Handler(output_root=tmp_path), content, url).result()
+
+    assert links == []
+    assert os.path.exists(tmp_path / '9184.json')
+
+
+@pytest.mark.parametrize(
+    ["url", "route"],
+    [
+        ('https://www.plantbreeding.wur.nl/PotatoPedigree/multilookup.php', 'search'),
+        ('https://www.plantbreeding.wur.nl/PotatoPedigree/pedigree_imagemap.php?id=1', 'imagemap'),
+        ('https://www.plantbreeding.wur.nl/PotatoPedigree/pedigree_imagemap.php', None),
+        ('http://www.google.com', None),
+    ]
+)
+def test_route(url, route):
+    assert Handler.route(url) == route
+
+
+def test_search_router_raw(tmp_path):
+    with open('pedigree/search.html', 'rb') as f:
+        content = RawContent(f.read(), None)
+    handled_by: Set[str] = set()
+    Handler(output_root=tmp_path).handle_raw(
+        content, 'https://www.plantbreeding.wur.nl/PotatoPedigree/multilookup.php', inspect_callback(handled_by))
+
+    assert len(handled_by) == 1
+    assert handled_by.pop().endswith('pedigree/search.py')
@@ -4,10 +4,10 @@ import urllib.parse
 
 import bs4
 
-from crawler import handler
+from crawler import handler, metrics
 
 
-class Handler(handler.Handler):
+class Handler(handler.HtmlHandler):
     """
     Handles search result pages from https://www.plantbreeding.wur.nl/PotatoPedigree.
     These contain links to pages with details about specific varieties.
@@ -16,8 +16,7 @@ class Handler(handler.Handler):
     def __init__(self, output_root: str):
         self.output_root = output_root
 
-    def handle(self, content: str, url: str, enqueue_callback: Callable[[str, str], None]) -> None:
-        doc = bs4.BeautifulSoup(content, 'html.parser')
+    def _handle_doc(self, doc: bs4.BeautifulSoup, url: str, enqueue_callback: Callable[[str, str], None]) -> None:
         table = doc.find('table')
 
         europotato_urls: Dict[int, str] = {}
@@ -38,5 +37,5 @@ class Handler(handler.Handler):
 
             europotato_urls[id_param] = europotato_name
 
-        with open(self.output_root / 'europotato_names.json', 'w') as f:
+        with metrics.timed('write'), open(self.output_root / 'europotato_names.json', 'w') as f:
             json.dump(europotato_urls, f)